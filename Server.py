@@ -1,46 +1,129 @@
 # region -----------Imports-------
-import os
 import time
+IMPORT_STARTED = time.perf_counter()
+import os
+import uuid
 from dotenv import load_dotenv
 import json
-from sqlalchemy import select 
-import subprocess
+import re
+from collections import deque
+from sqlalchemy import select, text
 from pathlib import Path
-from shutil import rmtree
 from typing import List, Set, Literal, Optional
 from contextlib import asynccontextmanager
 import asyncio
-from asyncio import Lock  
-import psutil
-from fastapi import FastAPI, HTTPException, BackgroundTasks, Depends
-from fastapi.responses import FileResponse, Response
+from datetime import datetime, timedelta
+from fastapi import FastAPI, HTTPException, BackgroundTasks, Depends, Query, Header
+from fastapi.responses import FileResponse, Response, JSONResponse, PlainTextResponse
 from pydantic import BaseModel
-import boto3
-from botocore.exceptions import ClientError
 from fastapi.middleware.cors import CORSMiddleware
 from sqlalchemy.ext.asyncio import AsyncSession
 
 # --- NEW IMPORTS ---
 from auth import UserRead, UserCreate  
-from database import get_async_db, engine, async_session_factory
-from models import Base, User, VM
-from auth import auth_backend, fastapi_users, current_active_user
+from database import get_async_db, async_session_factory, init_models
+from models import Base, User, VM, Snapshot
+from auth import auth_backend, fastapi_users, current_active_user, current_superuser, user_from_authorization
 from crud import (
     get_vm_by_name,
     get_user_vm_by_name,
     get_vms_for_user,
+    get_all_vms,
+    get_frp_shard_loads,
     get_all_used_ips,
     get_all_used_ports,
+    get_all_used_subdomains,
+    get_tunnel_loads,
+    get_committed_resources,
+    get_idle_reclaimed_vms,
+    record_boot_timing,
+    get_boot_timings,
+    get_snapshots_for_vm,
+    get_vm_snapshot_by_name,
+    get_snapshot_usage,
+    get_user_usage,
+    get_user_by_id,
     get_user_key_by_name, 
     get_keys_for_user, 
     create_ssh_key,
     is_key_in_use
 )
-from cryptography.hazmat.primitives import serialization as crypto_serialization
-from cryptography.hazmat.primitives.asymmetric import rsa
-from cryptography.hazmat.backends import default_backend as crypto_default_backend
+from frp import (
+    FRP_CONFIG_PATH,
+    FRP_EXECUTABLE_PATH,
+    pick_shard,
+    shard_count_for,
+    render_rule_proxy,
+    rule_proxy_type,
+    has_proxy,
+    sync_shard_configs,
+    _append_proxies_to_config,
+    _remove_proxies_from_config,
+    start_frpc,
+    stop_all_frpc,
+    frpc_status,
+    frpc_watchdog,
+    execute_frpc_reload,
+    reload_frpc_background,
+)
+from gateways import Gateway, GATEWAYS, get_gateway, get_ec2_client, pick_gateway, tunnels_needed, public_endpoint
+from drivers import get_driver, summarize_latency
+from coordination import (
+    RESOURCE_LOCK,
+    STARTUP_LOCK,
+    register_leader_task,
+    start_leader_election,
+    stop_leader_election,
+)
+from nodes import (
+    NODES,
+    get_agent_latency,
+    get_node,
+    get_node_resources,
+    schedule_node,
+    node_write_vagrantfile,
+    node_up,
+    node_provision,
+    node_halt,
+    node_savestate,
+    node_destroy,
+    node_has_capacity,
+    node_snapshot,
+    node_snapshot_usage,
+)
+from vm_logs import VMLogStore
+from telemetry import TELEMETRY_ENABLED, TIERS, FIELDS, read_series, telemetry_sampler
+from idle import (
+    IDLE_POLICY_ENABLED,
+    IDLE_ACTION,
+    IDLE_THRESHOLD_MINUTES,
+    IDLE_CPU_PERCENT,
+    IDLE_NET_KBPS,
+    idle_policy_loop,
+    register_activity_provider,
+)
+from ratelimit import RateLimitMiddleware
+from idempotency import IdempotencyMiddleware, idempotency_gc_loop
+from profiling import ProfilingMiddleware, list_profiles, profile_path
+from tracing import TracingMiddleware, EXPORTER, span, traced, annotate, current_trace_id, trace_tree
+from quotas import quota_limits, quota_violations
+from fair_queue import LIFECYCLE_QUEUE
+from vm_cache import VM_CACHE
+from readiness import READINESS_ENABLED, readiness_targets, wait_until_reachable, probes_in_flight
+from network_gc import NETWORK_GC_INTERVAL, collect_network_garbage, summarize_report, network_gc_loop
+from tunnel_stats import (
+    TUNNEL_STATS_INTERVAL,
+    METRICS_TOKEN,
+    tunnel_stats_loop,
+    tunnel_activity,
+    load_tunnel_stats,
+    rule_stats,
+    render_metrics,
+)
+# boto3 and cryptography are imported where they are used, since they are
+# slow to import and most requests never need them.
 
- 
+IMPORT_SECONDS = time.perf_counter() - IMPORT_STARTED
 # endregion
 
 
@@ -49,34 +132,87 @@ from cryptography.hazmat.backends import default_backend as crypto_default_backe
 #region -------------Directory and File Paths--------
 BASE_DIR = Path(__file__).parent
 VMS_DIR = BASE_DIR / ".vms"
-
-FRP_DIR = BASE_DIR / "frp_0.59.0_windows_amd64"  # Adjust this path as needed
-FRP_EXECUTABLE_PATH = FRP_DIR / "frpc.exe" # Or "frpc" on Linux/macOS
-FRP_CONFIG_PATH = FRP_DIR / "frpc.toml"
-frpc_process = None 
-RESOURCE_LOCK = asyncio.Lock()  # <-- NEW: Lock for resource allocation
+# Lifecycle logs of each VM, under VMS_DIR/<vm>/logs
+VM_LOGS = VMLogStore(VMS_DIR)
+# RESOURCE_LOCK (coordination.py) is a file lock, so it also holds across uvicorn workers
 load_dotenv()
 #endregion
 
 
 
 #region --------Lifespan and Process Management--------
+# Seconds spent in each startup phase, logged once startup finishes and shown by /readyz
+STARTUP_TIMINGS: dict = {}
+STARTUP_COMPLETE = False
+
 @asynccontextmanager
 async def lifespan(app: FastAPI):
-    async with engine.begin() as conn:
-        await conn.run_sync(Base.metadata.create_all)
+    global STARTUP_COMPLETE
+    STARTUP_TIMINGS["imports"] = round(IMPORT_SECONDS, 3)
+    started = phase_started = time.perf_counter()
+
+    def phase_done(name: str):
+        nonlocal phase_started
+        STARTUP_TIMINGS[name] = round(time.perf_counter() - phase_started, 3)
+        phase_started = time.perf_counter()
+
+    # Every worker runs this; the lock keeps them from racing on schema changes
+    async with STARTUP_LOCK:
+        await init_models(Base.metadata)
+    phase_done("init_models")
         
     if not FRP_CONFIG_PATH.exists():
         raise FileNotFoundError(f"CRITICAL: {FRP_CONFIG_PATH} not found.")
     if not FRP_EXECUTABLE_PATH.exists():
         raise FileNotFoundError(f"CRITICAL: frpc executable not found at {FRP_EXECUTABLE_PATH}")
-    start_frpc()
+    
+    VM_LOGS.start()
+    # One worker is elected to own frpc and the background loops
+    await start_leader_election(on_elected=take_frpc_ownership)
+    phase_done("leader_election")
+
+    STARTUP_TIMINGS["lifespan_total"] = round(time.perf_counter() - started, 3)
+    breakdown = ", ".join(f"{name} {seconds:.3f}s" for name, seconds in STARTUP_TIMINGS.items())
+    print(f"[STARTUP] Worker {os.getpid()} ready: {breakdown}")
+    STARTUP_COMPLETE = True
     
     yield
     
     # Code to run on shutdown
     print("Shutting down server...")
-    stop_frpc()
+    await stop_leader_election(on_resigned=release_frpc_ownership)
+    await asyncio.to_thread(VM_LOGS.stop)
+    await asyncio.to_thread(EXPORTER.flush)
+
+async def take_frpc_ownership():
+    """Run by the leader: rebuild every shard config from the DB, then start one frpc per (gateway, shard)."""
+    async with RESOURCE_LOCK:
+        async with async_session_factory() as db:
+            all_vms = await get_all_vms(db)
+        clients = {(vm.gateway, vm.frp_shard) for vm in all_vms}
+        for gateway in GATEWAYS:
+            vm_count = sum(1 for vm in all_vms if vm.gateway == gateway.name)
+            clients |= {(gateway.name, shard) for shard in range(shard_count_for(vm_count))}
+        await asyncio.to_thread(sync_shard_configs, all_vms, clients)
+    for gateway_name, shard in sorted(clients):
+        start_frpc(gateway_name, shard)
+
+async def release_frpc_ownership():
+    stop_all_frpc()
+
+register_leader_task("frpc-watchdog", frpc_watchdog)
+if TELEMETRY_ENABLED:
+    register_leader_task("telemetry-sampler", lambda: telemetry_sampler(VMS_DIR))
+if IDLE_POLICY_ENABLED:
+    register_leader_task("idle-policy", lambda: idle_policy_loop(VMS_DIR, reclaim_idle_vm))
+if NETWORK_GC_INTERVAL > 0:
+    register_leader_task("network-gc", lambda: network_gc_loop(VMS_DIR))
+if TUNNEL_STATS_INTERVAL > 0:
+    register_leader_task("tunnel-stats", tunnel_stats_loop)
+    # Open tunnel connections keep a VM awake
+    register_activity_provider(tunnel_activity)
+register_leader_task("idempotency-gc", idempotency_gc_loop)
+register_leader_task("script-watchdog", lambda: script_watchdog())
 
 app = FastAPI(
     title="Nimbus-IaaS Controller",
@@ -92,6 +228,11 @@ origins = [
     "https://nimbus-iaas.vercel.app" # The address of your React frontend
 ]
 
+# Added before CORS so that 429 responses still carry the CORS headers
+app.add_middleware(RateLimitMiddleware)
+# Outside the rate limiter, so replayed answers do not use up the caller's budget
+app.add_middleware(IdempotencyMiddleware)
+
 app.add_middleware(
     CORSMiddleware,
     allow_origins=origins,
@@ -99,6 +240,10 @@ app.add_middleware(
     allow_methods=["*"], # Allows all methods (GET, POST, etc.)
     allow_headers=["*"], # Allows all headers
 )
+# Opt-in, admin-only request profiles (see profiling.py)
+app.add_middleware(ProfilingMiddleware)
+# Outermost, so every request (and its background tasks) gets a trace
+app.add_middleware(TracingMiddleware)
 
 
 app.include_router(
@@ -129,6 +274,7 @@ class InboundRule(BaseModel):
 class AddRuleBody(BaseModel):
     vm_name: str  # Changed from 'username'
     description: str
+    type: Literal["http", "tcp", "ssh", "udp"] = "tcp"
 
 class VirtualMachine(BaseModel):
     username: str  # This will now be the 'vm_name'
@@ -158,6 +304,10 @@ async def generate_key(
     if existing_key:
         raise HTTPException(status_code=400, detail=f"Key with name '{key_name}' already exists.")
 
+    from cryptography.hazmat.primitives import serialization as crypto_serialization
+    from cryptography.hazmat.primitives.asymmetric import rsa
+    from cryptography.hazmat.backends import default_backend as crypto_default_backend
+
     try:
         # Generate private key in memory
         key = rsa.generate_private_key(
@@ -251,19 +401,28 @@ async def delete_key(
 
 
 #region --- Vagrantfile Generation ---
+# Name of the provisioner that holds the user's custom script
+CUSTOM_SCRIPT_PROVISIONER = "custom"
+
 def get_vagrantfile_content(vm: VirtualMachine, private_ip: str, public_key_str: str) -> str:
-    # --- Prepare the custom provisioning script to be injected ---
-    custom_script_injection = ""
+    # --- Prepare the custom provisioning script as its own provisioner ---
+    custom_provisioner = ""
     if vm.provisioning_script:
         # Note: We must escape backticks and dollar signs in the user's script
         # to prevent them from being interpreted by the outer shell script.
         escaped_script = vm.provisioning_script.replace("`", "\\`").replace("$", "\\$")
-        custom_script_injection = f"""
-    echo "--- Running Custom User Provisioning Script ---"
-    sudo -i -u {vm.username} bash <<'EOF'
+        # run: "never" keeps it out of `vagrant up`, so the VM becomes reachable
+        # without waiting for it; background_run_custom_script starts it afterwards.
+        custom_provisioner = f"""
+    config.vm.provision "{CUSTOM_SCRIPT_PROVISIONER}", type: "shell", run: "never", privileged: true, inline: <<-SHELL
+        echo "--- Running Custom User Provisioning Script ---"
+        sudo -i -u {vm.username} bash <<'EOF'
 {escaped_script}
 EOF
-    echo "--- Custom Script Finished ---"
+        status=$?
+        echo "--- Custom Script Finished (exit code $status) ---"
+        exit $status
+SHELL
 """
 
     # The f-string for the Vagrantfile
@@ -318,29 +477,51 @@ Vagrant.configure("2") do |config|
         systemctl restart sshd || systemctl restart ssh
 
         echo "--- Base Provisioning Complete ---"
-
-        # 5. Inject and run the custom user script
-        {custom_script_injection}
 SHELL
-end
+{custom_provisioner}end
 """
 #endregion
 
 
 
 #region --- Vagrant and VM Management ---
-async def background_provision_vm(vm_id: int, vm_path: str):
+@traced("vm.boot")
+async def background_provision_vm(vm_id: int, vm_path: str, boot_kind: str = "provision") -> float | None:
+    """
+    Boots the VM: creates it, cold boots it, or resumes it from a saved state
+    (boot_kind "provision", "cold_boot" or "resume"). The time taken is recorded per kind.
+    Returns the seconds `vagrant up` took, or None if it failed. With readiness
+    probing on, the VM stays in its booting status until background_wait_until_ready
+    finds it reachable.
+    """
     async with async_session_factory() as db:
         try:
-            # Run vagrant up in a thread (non-blocking)
-            await asyncio.to_thread(stream_vagrant_up, vm_path)
-            
             result = await db.execute(select(VM).where(VM.id == vm_id))
             vm_obj = result.scalars().first()
-            if vm_obj:
-                vm_obj.status = "Active"
-                db.add(vm_obj)
-                await db.commit()
+            if not vm_obj:
+                return
+            
+            annotate(vm=vm_obj.name, node=vm_obj.node, kind=boot_kind)
+            # Run vagrant up on the VM's node (non-blocking)
+            VM_LOGS.write(vm_obj.name, "up", f"Booting on node '{vm_obj.node}' ({boot_kind})")
+            boot_started = time.perf_counter()
+            returncode, _ = await node_up(get_node(vm_obj.node), vm_obj.name, vm_path, VM_LOGS.writer(vm_obj.name, "up"))
+            if returncode != 0:
+                raise Exception(f"vagrant up exited with code {returncode}")
+            boot_seconds = time.perf_counter() - boot_started
+            
+            if READINESS_ENABLED:
+                VM_LOGS.write(vm_obj.name, "up", f"Booted in {boot_seconds:.1f}s, waiting for SSH to answer")
+                annotate(status="Booted")
+                return boot_seconds
+            vm_obj.status = "Active"
+            vm_obj.active_since = datetime.utcnow()
+            db.add(vm_obj)
+            await db.commit()
+            await record_boot_timing(db, vm_obj, boot_kind, boot_seconds)
+            VM_LOGS.write(vm_obj.name, "up", f"Status: Active after {boot_seconds:.1f}s")
+            annotate(status="Active")
+            return boot_seconds
 
         except Exception as e:
             result = await db.execute(select(VM).where(VM.id == vm_id))
@@ -348,36 +529,177 @@ async def background_provision_vm(vm_id: int, vm_path: str):
             if vm_obj:
                 vm_obj.status = "Error"
                 await db.commit()
+                VM_LOGS.write(vm_obj.name, "up", f"Status: Error ({e})")
+            annotate(status="Error", error=str(e))
             print(f"[ERROR] VM provisioning failed for {vm_id}: {e}")
-            
+            return None
 
-            
-def stream_vagrant_up(vm_path: str):
-    try:
-        process = subprocess.Popen(["vagrant", "up"], cwd=vm_path, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, text=True)
-        for line in process.stdout:
-            print(f"[VAGRANT]: {line}", end="")
-        process.wait()
-        print(f"[INFO] Vagrant exited with code: {process.returncode}")
-    except Exception as e:
-        print(f"[ERROR] Exception during Vagrant up: {e}")
-        
-async def background_stop_vm(vm_id: int, vm_path: str):
+# Statuses a VM is in from its boot request until it is reachable
+BOOTING_STATUSES = ("Provisioning", "Starting", "Resuming", "Restoring")
+
+@traced("vm.wait_until_ready")
+async def background_wait_until_ready(vm_id: int, boot_kind: str, boot_seconds: float):
+    """
+    Marks a booted VM Active once sshd answers on its private IP and through its
+    SSH tunnel, or Error if it does not within READINESS_TIMEOUT. Records the
+    time from the start of `vagrant up` until it was reachable.
+    """
     async with async_session_factory() as db:
         result = await db.execute(select(VM).where(VM.id == vm_id))
         vm_obj = result.scalars().first()
-        if vm_obj:
-            vm_obj.status = "Stopping"
+        if not vm_obj or vm_obj.status not in BOOTING_STATUSES:
+            return
+        annotate(vm=vm_obj.name, kind=boot_kind)
+        readiness = await wait_until_reachable(vm_obj.name, readiness_targets(vm_obj))
+
+        # The VM may have been deleted, or failed, while we waited
+        result = await db.execute(select(VM).where(VM.id == vm_id).execution_options(populate_existing=True))
+        vm_obj = result.scalars().first()
+        if not vm_obj or vm_obj.status not in BOOTING_STATUSES:
+            return
+        if not readiness["reachable"]:
+            vm_obj.status = "Error"
             await db.commit()
-        
+            VM_LOGS.write(vm_obj.name, "up", f"Status: Error (not reachable {readiness['seconds']:.0f}s after booting: {readiness['error']})")
+            annotate(status="Error", error=readiness["error"])
+            return
+
+        reachable_seconds = boot_seconds + readiness["seconds"]
+        vm_obj.status = "Active"
+        vm_obj.active_since = datetime.utcnow()
+        await db.commit()
+        await record_boot_timing(db, vm_obj, boot_kind, boot_seconds, reachable_seconds)
+        stages = ", ".join(f"{stage} after {seconds:.1f}s" for stage, seconds in readiness["stages"].items())
+        VM_LOGS.write(vm_obj.name, "up", f"Status: Active, reachable {reachable_seconds:.1f}s after booting started ({stages})")
+        annotate(status="Active", reachable_seconds=round(reachable_seconds, 3))
+
+# Lines of custom script output kept on the VM, and how often they are saved while it runs
+SCRIPT_OUTPUT_TAIL_LINES = int(os.environ.get("SCRIPT_OUTPUT_TAIL_LINES", "100"))
+SCRIPT_OUTPUT_SAVE_INTERVAL = float(os.environ.get("SCRIPT_OUTPUT_SAVE_INTERVAL", "2"))
+# A Running script whose output has not been saved for this long lost its worker
+SCRIPT_STALE_SECONDS = float(os.environ.get("SCRIPT_STALE_SECONDS", "120"))
+# Printed by the custom provisioner; vagrant itself only exits with 1 on failure
+SCRIPT_EXIT_CODE_PATTERN = re.compile(r"--- Custom Script Finished \(exit code (\d+)\) ---")
+
+@traced("vm.custom_script")
+async def background_run_custom_script(vm_id: int, vm_path: str):
+    """
+    Runs the VM's pending custom provisioning script once it is Active, with
+    `vagrant provision --provision-with custom`. Its status, exit code and
+    duration go on the VM, and the tail of its output is saved every
+    SCRIPT_OUTPUT_SAVE_INTERVAL seconds while it runs (the full output goes to
+    the VM's log). The user can already SSH in meanwhile.
+    """
+    async with async_session_factory() as db:
+        result = await db.execute(select(VM).where(VM.id == vm_id))
+        vm_obj = result.scalars().first()
+        if not vm_obj or vm_obj.status != "Active" or vm_obj.script_status != "Pending":
+            return
+        annotate(vm=vm_obj.name, node=vm_obj.node)
+        vm_obj.script_status = "Running"
+        vm_obj.script_started_at = vm_obj.script_updated_at = datetime.utcnow()
+        vm_obj.script_output = ""
+        await db.commit()
+        VM_LOGS.write(vm_obj.name, "script", "Running the custom provisioning script")
+
+        tail = deque(maxlen=SCRIPT_OUTPUT_TAIL_LINES)
+        log = VM_LOGS.writer(vm_obj.name, "script")
+        def on_line(line: str):
+            tail.append(line)
+            log(line)
+
+        started = time.perf_counter()
         try:
-            await asyncio.to_thread(stream_vagrant_halt, vm_path)
+            provision = asyncio.create_task(node_provision(get_node(vm_obj.node), vm_obj.name, vm_path, CUSTOM_SCRIPT_PROVISIONER, on_line))
+            # This session is only used here, never while the provision task touches it
+            while not (await asyncio.wait({provision}, timeout=SCRIPT_OUTPUT_SAVE_INTERVAL))[0]:
+                vm_obj.script_output = "".join(tail)
+                vm_obj.script_updated_at = datetime.utcnow()
+                await db.commit()
+            returncode, output = provision.result()
+
+            match = SCRIPT_EXIT_CODE_PATTERN.search(output)
+            exit_code = int(match.group(1)) if match else returncode
+            vm_obj.script_status = "Succeeded" if returncode == 0 and exit_code == 0 else "Failed"
+            vm_obj.script_exit_code = exit_code
+            vm_obj.script_seconds = round(time.perf_counter() - started, 3)
+            vm_obj.script_output = "".join(tail)
+            vm_obj.script_updated_at = datetime.utcnow()
+            await db.commit()
+            VM_LOGS.write(vm_obj.name, "script", f"Custom script {vm_obj.script_status.lower()} with exit code {exit_code} after {vm_obj.script_seconds:.1f}s")
+            annotate(status=vm_obj.script_status, exit_code=exit_code)
 
+        except Exception as e:
+            await db.rollback()
             result = await db.execute(select(VM).where(VM.id == vm_id))
             vm_obj = result.scalars().first()
             if vm_obj:
-                vm_obj.status = "Stopped"
+                vm_obj.script_status = "Failed"
+                vm_obj.script_seconds = round(time.perf_counter() - started, 3)
+                vm_obj.script_output = "".join(tail) + f"\n{e}\n"
                 await db.commit()
+                VM_LOGS.write(vm_obj.name, "script", f"Custom script failed ({e})")
+            annotate(status="Failed", error=str(e))
+            print(f"[ERROR] Custom script failed for {vm_id}: {e}")
+
+async def fail_stale_scripts() -> int:
+    """
+    Marks Running scripts Failed when their worker stopped saving their output
+    (it died or was restarted), so their VMs do not stay locked by
+    raise_if_script_running. Returns how many.
+    """
+    cutoff = datetime.utcnow() - timedelta(seconds=SCRIPT_STALE_SECONDS)
+    async with async_session_factory() as db:
+        result = await db.execute(select(VM).where(VM.script_status == "Running", VM.script_updated_at < cutoff))
+        stale = result.scalars().all()
+        for vm_obj in stale:
+            vm_obj.script_status = "Failed"
+            vm_obj.script_output = (vm_obj.script_output or "") + "\nThe worker running this script exited before it finished.\n"
+            VM_LOGS.write(vm_obj.name, "script", f"Custom script marked failed: no progress saved since {vm_obj.script_updated_at.isoformat()}")
+        await db.commit()
+        return len(stale)
+
+async def script_watchdog():
+    """Leader-only loop around fail_stale_scripts."""
+    while True:
+        try:
+            failed = await fail_stale_scripts()
+            if failed:
+                print(f"[SCRIPT] Marked {failed} abandoned custom scripts as failed")
+        except Exception as e:
+            print(f"[SCRIPT] Stale script check failed: {e}")
+        await asyncio.sleep(SCRIPT_STALE_SECONDS / 2)
+
+def raise_if_script_running(vm: VM):
+    """vagrant runs one action per VM at a time, so most operations must wait for the script."""
+    if vm.script_status == "Running":
+        raise HTTPException(status_code=409, detail=f"The custom script of VM '{vm.name}' is still running; wait for it to finish (or stop it over SSH).")
+            
+
+            
+@traced("vm.stop")
+async def background_stop_vm(vm_id: int, vm_path: str, idle_reason: str | None = None):
+    async with async_session_factory() as db:
+        result = await db.execute(select(VM).where(VM.id == vm_id))
+        vm_obj = result.scalars().first()
+        if not vm_obj:
+            return
+        annotate(vm=vm_obj.name, node=vm_obj.node, idle=bool(idle_reason))
+        vm_obj.status = "Stopping"
+        await db.commit()
+        
+        try:
+            returncode, _ = await node_halt(get_node(vm_obj.node), vm_obj.name, vm_path, VM_LOGS.writer(vm_obj.name, "halt"))
+            if returncode != 0:
+                raise Exception(f"vagrant halt exited with code {returncode}")
+
+            vm_obj.status = "Stopped"
+            if idle_reason:
+                vm_obj.idle_reason = idle_reason
+                vm_obj.idle_action_at = datetime.utcnow()
+            await db.commit()
+            VM_LOGS.write(vm_obj.name, "halt", "Status: Stopped" + (f" ({idle_reason})" if idle_reason else ""))
+            annotate(status="Stopped")
             
         except Exception as e:
             result = await db.execute(select(VM).where(VM.id == vm_id))
@@ -385,21 +707,78 @@ async def background_stop_vm(vm_id: int, vm_path: str):
             if vm_obj:
                 vm_obj.status = "Error"
                 await db.commit()
+                VM_LOGS.write(vm_obj.name, "halt", f"Status: Error ({e})")
+            annotate(status="Error", error=str(e))
             print(f"[ERROR] VM Halting failed for {vm_id}: {e}")
-
-def stream_vagrant_halt(vm_path: str):
-    try:
-        process = subprocess.Popen(["vagrant", "halt"], cwd=vm_path, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, text=True)
-        for line in process.stdout:
-            print(f"[VAGRANT HALT]: {line}", end="")
-        process.wait()
-        print(f"[INFO] Vagrant halt exited with code: {process.returncode}")
-    except Exception as e:
-        print(f"[ERROR] Exception during Vagrant halt: {e}")
         
         
         
+@traced("vm.suspend")
+async def background_suspend_vm(vm_id: int, vm_path: str, idle_reason: str | None = None):
+    """Saves the VM's memory to disk and stops it. Starting it again resumes where it left off."""
+    async with async_session_factory() as db:
+        result = await db.execute(select(VM).where(VM.id == vm_id))
+        vm_obj = result.scalars().first()
+        if not vm_obj:
+            return
+        annotate(vm=vm_obj.name, node=vm_obj.node, idle=bool(idle_reason))
+        vm_obj.status = "Suspending"
+        await db.commit()
+
+        try:
+            returncode, _ = await node_savestate(get_node(vm_obj.node), vm_obj.name, vm_path, VM_LOGS.writer(vm_obj.name, "suspend"))
+            if returncode != 0:
+                raise Exception(f"savestate exited with code {returncode}")
+
+            vm_obj.status = "Suspended"
+            if idle_reason:
+                vm_obj.idle_reason = idle_reason
+                vm_obj.idle_action_at = datetime.utcnow()
+            await db.commit()
+            VM_LOGS.write(vm_obj.name, "suspend", "Status: Suspended" + (f" ({idle_reason})" if idle_reason else ""))
+            annotate(status="Suspended")
+
+        except Exception as e:
+            result = await db.execute(select(VM).where(VM.id == vm_id))
+            vm_obj = result.scalars().first()
+            if vm_obj:
+                vm_obj.status = "Error"
+                await db.commit()
+                VM_LOGS.write(vm_obj.name, "suspend", f"Status: Error ({e})")
+            annotate(status="Error", error=str(e))
+            print(f"[ERROR] VM suspend failed for {vm_id}: {e}")
+
+async def reclaim_idle_vm(vm_id: int, reason: str):
+    """
+    Called by the idle policy (idle.py) for a VM that has been idle too long.
+    The suspend or stop goes through the lifecycle queue like the owner's own
+    jobs, so it never runs alongside one of them.
+    """
+    async with async_session_factory() as db:
+        result = await db.execute(select(VM).where(VM.id == vm_id))
+        vm_obj = result.scalars().first()
+        if not vm_obj or vm_obj.status != "Active":
+            return
+        owner = await db.get(User, vm_obj.owner_id)
+    weight = (owner.fair_share_weight if owner else None) or 1.0
+    await LIFECYCLE_QUEUE.run(vm_obj.owner_id, weight, _reclaim_if_still_idle, vm_id, reason)
+
+async def _reclaim_if_still_idle(vm_id: int, reason: str):
+    async with async_session_factory() as db:
+        result = await db.execute(select(VM).where(VM.id == vm_id))
+        vm_obj = result.scalars().first()
+    # The VM may have been stopped, deleted or handed to another job while this one was queued
+    if not vm_obj or vm_obj.status != "Active" or vm_obj.script_status == "Running":
+        return
+    vm_path = str(VMS_DIR / vm_obj.name)
+    if IDLE_ACTION == "stop":
+        await background_stop_vm(vm_id, vm_path, idle_reason=reason)
+    else:
+        await background_suspend_vm(vm_id, vm_path, idle_reason=reason)
+
+
 # --- NEW: delete_vm_background (MUST be async) ---
+@traced("vm.delete")
 async def delete_vm_background(vm_id: int):
     """
     Fully self-contained background task to delete a VM and all its resources.
@@ -423,46 +802,62 @@ async def delete_vm_background(vm_id: int):
 
             vm_name = vm_to_delete.name
             vm_path = VMS_DIR / vm_name
+            annotate(vm=vm_name, node=vm_to_delete.node)
             
-            # 2. Destroy Vagrant VM
-            # --- (Your vagrant/rmtree logic is correct) ---
-            if vm_path.exists():
-                destroy_proc = subprocess.run(["vagrant", "destroy", "-f"], cwd=vm_path, capture_output=True, text=True)
-                if destroy_proc.returncode != 0:
-                    print(f"Warning: Vagrant destroy failed for {vm_name}. Error: {destroy_proc.stderr.strip()}")
-                rmtree(vm_path)
+            # 2. Destroy Vagrant VM on its node. Its logs go with its directory,
+            # so close the log file first.
+            await asyncio.to_thread(VM_LOGS.close, vm_name)
+            returncode, output = await node_destroy(get_node(vm_to_delete.node), vm_name, vm_path)
+            if returncode != 0:
+                print(f"Warning: Vagrant destroy failed for {vm_name}. Output: {output.strip()[-500:]}")
             
             # 3. Clean up AWS and frpc.toml
+            gateway = get_gateway(vm_to_delete.gateway)
             proxy_names_to_delete = set()
             for rule in vm_to_delete.inbound_rules:
-                if "remotePort" in rule:
+                if has_proxy(rule):
                     proxy_names_to_delete.add(f"{vm_name}-{rule['vm_port']}")
-                    remove_inbound_security_rule(port=rule["remotePort"])
+                if "remotePort" in rule:
+                    remove_inbound_security_rule(gateway, port=rule["remotePort"], protocol=rule_proxy_type(rule))
             
+            frp_shard = vm_to_delete.frp_shard
             if proxy_names_to_delete:
                 # --- THIS IS THE FIX ---
                 # Run the blocking file I/O in a separate thread
-                await asyncio.to_thread(
-                    _remove_proxies_from_config, 
-                    proxy_names_to_delete
-                )
+                async with RESOURCE_LOCK:
+                    await asyncio.to_thread(
+                        _remove_proxies_from_config, 
+                        gateway.name,
+                        frp_shard,
+                        proxy_names_to_delete
+                    )
                 # --- END FIX ---
-                print(f"Removed proxies for '{vm_name}' from frpc.toml")
+                print(f"Removed proxies for '{vm_name}' from frpc {gateway.name}/{frp_shard}")
             
             # 4. Delete from Database
             # --- (Your DB delete logic is correct) ---
+            for snapshot in await get_snapshots_for_vm(db, vm_to_delete.id):
+                await db.delete(snapshot)  # vagrant destroy removed them from the hypervisor
             await db.delete(vm_to_delete)
             await db.commit()
             
             print(f"[BG Task] Successfully deleted VM {vm_name} (ID: {vm_id}).")
             
-            # 5. Reload frpc (Run as a sync command)
-            execute_frpc_reload()
+            # 5. Reload only this VM's frpc shard (Run as a sync command)
+            execute_frpc_reload(gateway.name, frp_shard)
 
         except Exception as e:
-            # ... (your exception logic is correct) ...
             print(f"[BG Task ERROR] Failed to delete VM ID {vm_id}: {e}")
+            annotate(status="Error", error=str(e))
             await db.rollback()
+            # e.g. the node's agent is unreachable. Left in Deleting with its
+            # directory still there, nothing would ever finish the job, so mark
+            # it Error: deleting it again retries.
+            result = await db.execute(select(VM).where(VM.id == vm_id))
+            vm_obj = result.scalars().first()
+            if vm_obj:
+                vm_obj.status = "Error"
+                await db.commit()
 #endregion
 
 
@@ -480,23 +875,62 @@ def find_port_from_set(all_used_ports: set[int], start=2222, end=3000):
         if port not in all_used_ports:
             return port
     raise Exception("No available remote ports for tunnels.")
+
+def find_gateway_port(gateway: Gateway, used_ports: set[int]):
+    """Finds a free remote port in a gateway's port range."""
+    return find_port_from_set(used_ports, gateway.port_start, gateway.port_end + 1)
+
+# A subdomain is one DNS label
+SUBDOMAIN_MAX_LENGTH = 63
+
+def make_subdomain(vm_name: str, vm_port: int, used_subdomains: set[str]) -> str:
+    """
+    "<vm name>-<port>", lowercased and cut to a valid DNS label. VM names that
+    differ only in case or punctuation map to the same label, so a taken one
+    gets a "-2", "-3"... suffix.
+    """
+    name = re.sub(r"[^a-z0-9-]", "-", vm_name.lower())
+    attempt = 1
+    while True:
+        suffix = f"-{vm_port}" if attempt == 1 else f"-{vm_port}-{attempt}"
+        subdomain = (name[:SUBDOMAIN_MAX_LENGTH - len(suffix)] + suffix).lstrip("-")
+        if subdomain not in used_subdomains:
+            return subdomain
+        attempt += 1
+
+def allocate_tunnel(rule: dict, vm_name: str, gateway: Gateway, used_ports: set[int], used_subdomains: set[str]) -> dict:
+    """
+    Fills in the public side of an inbound rule on a gateway.
+    http rules are routed by subdomain on the gateway's shared vhost port, so they
+    use no remote port (or security-group rule). tcp/ssh/udp rules get a remotePort.
+    The port or subdomain is also reserved in used_ports or used_subdomains.
+    """
+    if rule["type"] == "http" and gateway.subdomain_host:
+        rule["subdomain"] = make_subdomain(vm_name, rule["vm_port"], used_subdomains)
+        used_subdomains.add(rule["subdomain"])
+        return rule
+    rule["remotePort"] = find_gateway_port(gateway, used_ports)
+    used_ports.add(rule["remotePort"])
+    return rule
 #endregion
 
 
 
 #region --- AWS Security Group Management ---
-EC2_CLIENT = boto3.client("ec2", region_name="ap-south-1") # Use your region
-SECURITY_GROUP_ID = os.environ.get("SECURITY_GROUP_ID")
-
-def add_inbound_security_rule(port: int, description: str):
-    """Adds an inbound rule to the AWS Security Group."""
+@traced("aws.authorize_ingress")
+def add_inbound_security_rule(gateway: Gateway, port: int, description: str, protocol: str = "tcp"):
+    """Adds an inbound rule to the gateway's AWS Security Group."""
+    if not gateway.security_group_id:
+        # e.g. a local frps used for testing: nothing to open
+        return True
+    from botocore.exceptions import ClientError
     try:
         print(f"AWS: Authorizing inbound traffic on port {port}...")
-        EC2_CLIENT.authorize_security_group_ingress(
-            GroupId=SECURITY_GROUP_ID,
+        get_ec2_client(gateway.region).authorize_security_group_ingress(
+            GroupId=gateway.security_group_id,
             IpPermissions=[
                 {
-                    "IpProtocol": "tcp",
+                    "IpProtocol": protocol,
                     "FromPort": port,
                     "ToPort": port,
                     "IpRanges": [{"CidrIp": "0.0.0.0/0", "Description": description}],
@@ -514,15 +948,19 @@ def add_inbound_security_rule(port: int, description: str):
             print(f"AWS: Error adding rule for port {port}: {e}")
             return False
 
-def remove_inbound_security_rule(port: int):
-    """Removes an inbound rule from the AWS Security Group."""
+@traced("aws.revoke_ingress")
+def remove_inbound_security_rule(gateway: Gateway, port: int, protocol: str = "tcp"):
+    """Removes an inbound rule from the gateway's AWS Security Group."""
+    if not gateway.security_group_id:
+        return True
+    from botocore.exceptions import ClientError
     try:
         print(f"AWS: Revoking inbound traffic on port {port}...")
-        EC2_CLIENT.revoke_security_group_ingress(
-            GroupId=SECURITY_GROUP_ID,
+        get_ec2_client(gateway.region).revoke_security_group_ingress(
+            GroupId=gateway.security_group_id,
             IpPermissions=[
                 {
-                    "IpProtocol": "tcp",
+                    "IpProtocol": protocol,
                     "FromPort": port,
                     "ToPort": port,
                     "IpRanges": [{"CidrIp": "0.0.0.0/0"}],
@@ -540,99 +978,6 @@ def remove_inbound_security_rule(port: int):
             print(f"AWS: Error removing rule for port {port}: {e}")
             return False
 #endregion    
-
-
-
-#region --- FRPC Process Management Functions ---
-def _append_proxies_to_config(proxy_toml_list: List[str]):
-    """
-    Appends a list of proxy definitions to the frpc.toml file.
-    This is a blocking function intended to be run in a thread.
-    """
-    with open(FRP_CONFIG_PATH, "a") as f:
-        for proxy_toml in proxy_toml_list:
-            f.write(proxy_toml)
-
-def _remove_proxies_from_config(proxy_names_to_delete: Set[str]):
-    """
-    Removes proxy sections from frpc.toml by name.
-    This is a blocking function intended to be run in a thread.
-    """
-    with open(FRP_CONFIG_PATH, "r") as f:
-        content = f.read()
-    
-    parts = content.split("\n[[proxies]]\n")
-    server_config = parts[0]
-    proxy_blocks = parts[1:]
-
-    kept_blocks = []
-    for block in proxy_blocks:
-        if not any(f'name = "{name}"' in block for name in proxy_names_to_delete):
-            kept_blocks.append(block)
-
-    new_content = server_config
-    if kept_blocks:
-        new_content += "\n[[proxies]]\n" + "\n[[proxies]]\n".join(kept_blocks)
-    
-    with open(FRP_CONFIG_PATH, "w") as f:
-        f.write(new_content)
-def start_frpc():
-    global frpc_process
-    if frpc_process and psutil.pid_exists(frpc_process.pid):
-        print("frpc is already running.")
-        return
-    print(f"Starting frpc with config: {FRP_CONFIG_PATH}")
-    frpc_process = subprocess.Popen([str(FRP_EXECUTABLE_PATH), "-c", str(FRP_CONFIG_PATH)])
-    print(f"frpc started successfully with PID: {frpc_process.pid}")
-
-def stop_frpc():
-    global frpc_process
-    if not frpc_process or not psutil.pid_exists(frpc_process.pid):
-        print("frpc is not running or PID not found.")
-        return
-    print(f"Stopping frpc process with PID: {frpc_process.pid}")
-    try:
-        p = psutil.Process(frpc_process.pid)
-        p.terminate()
-        p.wait(timeout=5)
-    except psutil.NoSuchProcess:
-        pass
-    except psutil.TimeoutExpired:
-        print("frpc did not terminate gracefully, killing it.")
-        p.kill()
-    print("frpc stopped.")
-    frpc_process = None
-
-
-    
-    
-def execute_frpc_reload():
-    """Executes the frpc reload command."""
-    if not frpc_process or not psutil.pid_exists(frpc_process.pid):
-        print("frpc is not running, so not reloading. It will start on the next request or app start.")
-        return
-
-    print("Attempting to hot-reload frpc configuration...")
-    try:
-        # This command tells the running frpc process to reload its config
-        reload_command = [str(FRP_EXECUTABLE_PATH), "reload", "-c", str(FRP_CONFIG_PATH)]
-        result = subprocess.run(reload_command, capture_output=True, text=True)
-
-        if result.returncode == 0:
-            print("frpc reloaded successfully.")
-        else:
-            print(f"ERROR: frpc reload failed. Stderr: {result.stderr.strip()}")
-            print("Please ensure the '[admin]' section is configured in frpc.toml.")
-
-    except Exception as e:
-        print(f"An exception occurred while trying to reload frpc: {e}")
-
-def reload_frpc_background(background_tasks: BackgroundTasks):
-    """Schedules a non-blocking frpc reload task."""
-    # We add a tiny delay to ensure the file write has completed before reload.
-    background_tasks.add_task(time.sleep, 1)
-    background_tasks.add_task(execute_frpc_reload)
-#endregion
     
     
     
@@ -641,8 +986,23 @@ def reload_frpc_background(background_tasks: BackgroundTasks):
 async def list_vms(current_user: User = Depends(current_active_user), db: AsyncSession = Depends(get_async_db)):
     """Returns the VMs for the CURRENT LOGGED-IN USER ONLY."""
     user_vms_data = await get_vms_for_user(db, current_user.id)
+    tunnel_stats = await asyncio.to_thread(load_tunnel_stats)
     # Convert SQLAlchemy models to dicts for JSON response
-    return [vm.__dict__ for vm in user_vms_data]
+    return [serialize_vm(vm, tunnel_stats) for vm in user_vms_data]
+
+def serialize_vm(vm: VM, tunnel_stats: dict | None = None) -> dict:
+    """VM row as a dict, with the public endpoint (and tunnel stats) of each rule filled in."""
+    gateway = get_gateway(vm.gateway)
+    vm_data = dict(vm.__dict__)
+    vm_data["inbound_rules"] = [
+        {
+            **rule,
+            "endpoint": public_endpoint(gateway, rule),
+            "stats": rule_stats(tunnel_stats, vm.name, rule) if tunnel_stats and has_proxy(rule) else None,
+        }
+        for rule in vm.inbound_rules or []
+    ]
+    return vm_data
 
 
 
@@ -665,17 +1025,23 @@ async def add_inbound_rule(
         if not vm:
             raise HTTPException(status_code=403, detail="Forbidden: VM not found or you do not own it.")
         
-        # Get all used ports from DB
-        used_ports = await get_all_used_ports(db)
-        remotePort = find_port_from_set(used_ports)
+        # Get the used ports on this VM's gateway from DB
+        gateway = get_gateway(vm.gateway)
+        used_ports = await get_all_used_ports(db, gateway.name)
+        used_subdomains = await get_all_used_subdomains(db, gateway.name)
         
         current_rules = list(vm.inbound_rules) # Get a mutable copy
         for rule in current_rules:
             if rule.get("vm_port") == port:
                 return {"message": f"Inbound rule for port {port} already exists."}
         
-        # Add new rule to the list
-        new_rule = {"type": "tcp", "vm_port": port, "description": body.description, "remotePort": remotePort}
+        # Add new rule to the list (http rules get a subdomain instead of a port)
+        new_rule = allocate_tunnel(
+            {"type": body.type, "vm_port": port, "description": body.description},
+            vm.name, gateway, used_ports, used_subdomains
+        )
+        if "remotePort" in new_rule:
+            raise_if_over_quota(current_user, await get_user_usage(db, current_user.id), ports=1)
         current_rules.append(new_rule)
         
         # Update the VM's JSON field and commit to DB
@@ -684,26 +1050,24 @@ async def add_inbound_rule(
         await db.commit()
         
         # Add AWS rule
-        success = add_inbound_security_rule(remotePort, description=body.description)
-        if not success:
-            raise HTTPException(status_code=500, detail="Failed to add AWS rule.")
-            # Note: A true rollback would remove the rule from the DB here.
-
-        # Add to frpc.toml
-        proxy_name = f"{vm.name}-{port}" # Use vm.name
-        new_proxy_toml = f"""
-[[proxies]]
-name = "{proxy_name}"
-type = "tcp"
-localIP = "{vm.private_ip}"
-localPort = {port}
-remotePort = {remotePort}
-"""
-        await asyncio.to_thread(_append_proxies_to_config, [new_proxy_toml])
-        print(f"Appended proxy for '{vm.name}' to frpc.toml")
+        if "remotePort" in new_rule:
+            success = add_inbound_security_rule(
+                gateway, new_rule["remotePort"], description=body.description, protocol=rule_proxy_type(new_rule)
+            )
+            if not success:
+                raise HTTPException(status_code=500, detail="Failed to add AWS rule.")
+                # Note: A true rollback would remove the rule from the DB here.
 
-    reload_frpc_background(background_tasks)
-    return {"message": f"Inbound rule for port {port} added successfully."}
+        # Add to the VM's frpc shard
+        new_proxy_toml = render_rule_proxy(vm.name, vm.private_ip, new_rule)
+        await asyncio.to_thread(_append_proxies_to_config, gateway.name, vm.frp_shard, [new_proxy_toml])
+        print(f"Appended proxy for '{vm.name}' to frpc {gateway.name}/{vm.frp_shard}")
+
+    reload_frpc_background(background_tasks, gateway.name, vm.frp_shard)
+    return {
+        "message": f"Inbound rule for port {port} added successfully.",
+        "endpoint": public_endpoint(gateway, new_rule),
+    }
 
 
 @app.delete("/remove-inbound-rule/{vm_name}/{remote_port}")
@@ -721,9 +1085,8 @@ async def remove_inbound_rule(
             raise HTTPException(status_code=403, detail="Forbidden: VM not found or you do not own it.")
 
         # --- (Your rule finding logic is correct) ---
-        current_rules = list(vm.inbound_rules)
         rule_to_remove = None
-        for rule in current_rules:
+        for rule in vm.inbound_rules:
             if rule.get("remotePort") == remote_port:
                 rule_to_remove = rule
                 break
@@ -731,35 +1094,162 @@ async def remove_inbound_rule(
         if not rule_to_remove:
             raise HTTPException(status_code=404, detail=f"Rule with public port {remote_port} not found.")
 
-        try:
-            # 1. Remove from AWS
-            remove_inbound_security_rule(port=remote_port)
-            
-            # 2. Remove from frpc.toml
-            vm_port = rule_to_remove["vm_port"]
-            proxy_name_to_delete = f"{vm.name}-{vm_port}"
-            
-            # --- THIS IS THE FIX ---
-            await asyncio.to_thread(
-                _remove_proxies_from_config,
-                {proxy_name_to_delete}
-            )
-            # --- END FIX ---
-            
-            # 3. Remove from DB
-            # --- (Your DB update logic is correct) ---
-            current_rules.remove(rule_to_remove)
-            vm.inbound_rules = current_rules
-            db.add(vm)
-            await db.commit()
-
-        except Exception as e:
-            raise HTTPException(status_code=500, detail=f"An error occurred: {str(e)}")
+        await _remove_rule_from_vm(db, vm, rule_to_remove)
     
-    reload_frpc_background(background_tasks)
+    reload_frpc_background(background_tasks, vm.gateway, vm.frp_shard)
     return {"message": f"Successfully removed rule for public port {remote_port}."}
 
 
+@app.delete("/remove-http-rule/{vm_name}/{vm_port}")
+async def remove_http_rule(
+    vm_name: str, 
+    vm_port: int, 
+    background_tasks: BackgroundTasks,
+    current_user: User = Depends(current_active_user),
+    db: AsyncSession = Depends(get_async_db)
+):
+    """Removes a subdomain-routed http rule, which has no public port of its own."""
+    async with RESOURCE_LOCK:
+        vm = await get_user_vm_by_name(db, vm_name, current_user.id)
+        if not vm:
+            raise HTTPException(status_code=403, detail="Forbidden: VM not found or you do not own it.")
+
+        rule_to_remove = None
+        for rule in vm.inbound_rules:
+            if rule.get("vm_port") == vm_port and "subdomain" in rule:
+                rule_to_remove = rule
+                break
+
+        if not rule_to_remove:
+            raise HTTPException(status_code=404, detail=f"HTTP rule for VM port {vm_port} not found.")
+
+        await _remove_rule_from_vm(db, vm, rule_to_remove)
+    
+    reload_frpc_background(background_tasks, vm.gateway, vm.frp_shard)
+    return {"message": f"Successfully removed HTTP rule for VM port {vm_port}."}
+
+
+async def _remove_rule_from_vm(db: AsyncSession, vm: VM, rule_to_remove: dict):
+    """Removes one rule from AWS, the VM's frpc shard and the DB. Call with RESOURCE_LOCK held."""
+    gateway = get_gateway(vm.gateway)
+    try:
+        # 1. Remove from AWS
+        if "remotePort" in rule_to_remove:
+            remove_inbound_security_rule(
+                gateway, port=rule_to_remove["remotePort"], protocol=rule_proxy_type(rule_to_remove)
+            )
+        
+        # 2. Remove from frpc.toml
+        vm_port = rule_to_remove["vm_port"]
+        proxy_name_to_delete = f"{vm.name}-{vm_port}"
+        
+        # --- THIS IS THE FIX ---
+        await asyncio.to_thread(
+            _remove_proxies_from_config,
+            gateway.name,
+            vm.frp_shard,
+            {proxy_name_to_delete}
+        )
+        # --- END FIX ---
+        
+        # 3. Remove from DB
+        # --- (Your DB update logic is correct) ---
+        current_rules = list(vm.inbound_rules)
+        current_rules.remove(rule_to_remove)
+        vm.inbound_rules = current_rules
+        db.add(vm)
+        await db.commit()
+
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"An error occurred: {str(e)}")
+
+
+
+
+
+#region --- Quotas and Lifecycle Queue ---
+class QuotaUpdate(BaseModel):
+    # Omitted fields are left alone; null resets a limit to the QUOTA_* default
+    vms: Optional[int] = None
+    vcpu: Optional[int] = None
+    ram_mb: Optional[int] = None
+    ports: Optional[int] = None
+    fair_share_weight: Optional[float] = None
+
+def raise_if_over_quota(user: User, usage: dict, **requested: int):
+    violations = quota_violations(user, usage, **requested)
+    if violations:
+        raise HTTPException(status_code=409, detail=f"Quota exceeded: {', '.join(violations)}.")
+
+def queue_lifecycle_job(background_tasks: BackgroundTasks, user: User, job, *args):
+    """Runs a lifecycle job in the background once the user's fair share of the queue allows."""
+    background_tasks.add_task(LIFECYCLE_QUEUE.run, user.id, user.fair_share_weight or 1.0, job, *args)
+
+def queue_boot_job(background_tasks: BackgroundTasks, user: User, vm_id: int, vm_path: str, boot_kind: str):
+    """
+    Boots the VM through the lifecycle queue. Waiting for it to become reachable
+    and running its custom script happen outside the queue, so slow-starting
+    guests and long scripts do not hold up other jobs.
+    """
+    background_tasks.add_task(_run_boot_stages, user.id, user.fair_share_weight or 1.0, vm_id, vm_path, boot_kind)
+
+async def _run_boot_stages(owner_id, weight: float, vm_id: int, vm_path: str, boot_kind: str):
+    boot_seconds = await LIFECYCLE_QUEUE.run(owner_id, weight, background_provision_vm, vm_id, vm_path, boot_kind)
+    if boot_seconds is None:
+        return
+    if READINESS_ENABLED:
+        await background_wait_until_ready(vm_id, boot_kind, boot_seconds)
+    await background_run_custom_script(vm_id, vm_path)
+
+def _quota_report(user: User, usage: dict) -> dict:
+    return {
+        "limits": quota_limits(user),
+        "usage": usage,
+        "fair_share_weight": user.fair_share_weight,
+    }
+
+@app.get("/quota")
+async def get_quota(
+    current_user: User = Depends(current_active_user),
+    db: AsyncSession = Depends(get_async_db)
+):
+    """The user's limits on VMs, vCPUs, RAM and gateway ports, and what they currently hold."""
+    return _quota_report(current_user, await get_user_usage(db, current_user.id))
+
+
+@app.put("/users/{user_id}/quota")
+async def set_user_quota(
+    user_id: str,
+    body: QuotaUpdate,
+    current_user: User = Depends(current_superuser),
+    db: AsyncSession = Depends(get_async_db)
+):
+    """Admin: overrides a user's quotas and fair-share weight."""
+    try:
+        user = await get_user_by_id(db, uuid.UUID(user_id))
+    except ValueError:
+        user = None
+    if not user:
+        raise HTTPException(status_code=404, detail=f"User '{user_id}' not found.")
+    for field in body.model_fields_set:
+        value = getattr(body, field)
+        if field == "fair_share_weight":
+            if value is not None and value <= 0:
+                raise HTTPException(status_code=400, detail="fair_share_weight must be positive.")
+            user.fair_share_weight = value if value is not None else 1.0
+        else:
+            if value is not None and value < 0:
+                raise HTTPException(status_code=400, detail=f"{field} cannot be negative.")
+            setattr(user, f"quota_{field}", value)
+    await db.commit()
+    return _quota_report(user, await get_user_usage(db, user.id))
+
+
+@app.get("/lifecycle-queue")
+async def lifecycle_queue(current_user: User = Depends(current_superuser)):
+    """Admin: lifecycle jobs running and queued in this worker, and queue waits per owner."""
+    return LIFECYCLE_QUEUE.stats()
+#endregion
 
 
 
@@ -771,6 +1261,9 @@ async def create_vm(
     current_user: User = Depends(current_active_user),
     db: AsyncSession = Depends(get_async_db)
 ):
+    if any(rule.type == "icmp" for rule in vm.inbound_rules):
+        raise HTTPException(status_code=400, detail="icmp rules cannot be tunnelled; use tcp, udp or http.")
+
     try:
         vm_path = VMS_DIR / vm.username # vm.username is the 'vm_name'
         if vm_path.exists():
@@ -789,38 +1282,46 @@ async def create_vm(
             if existing_vm:
                 raise HTTPException(status_code=400, detail=f"VM name '{vm.username}' is already taken.")
             
-            # Get all used IPs from DB and find a new one
-            used_ips = await get_all_used_ips(db)
-            private_ip = find_ip_from_set(used_ips)
-            
-            # Get all used ports from DB
-            used_ports = await get_all_used_ports(db)
+            with span("allocate") as allocation:
+                # Get all used IPs from DB and find a new one
+                used_ips = await get_all_used_ips(db)
+                private_ip = find_ip_from_set(used_ips)
+                
+                # Pick the hypervisor node that will run the VM
+                node = await schedule_node(vm.ram, vm.cpu, await get_committed_resources(db))
+                
+                # Place the VM's tunnels on the least-loaded gateway, then pick
+                # the frpc shard (for that gateway) that will carry its proxies
+                rule_types = [rule.type for rule in vm.inbound_rules]
+                gateway = pick_gateway(await get_tunnel_loads(db), rule_types)
+                used_ports = await get_all_used_ports(db, gateway.name)
+                used_subdomains = await get_all_used_subdomains(db, gateway.name)
+                # Checked under the lock, so parallel creates cannot both slip under the quota
+                raise_if_over_quota(
+                    current_user, await get_user_usage(db, current_user.id),
+                    vms=1, vcpu=vm.cpu, ram_mb=vm.ram, ports=tunnels_needed(gateway, rule_types),
+                )
+                frp_shard = pick_shard(current_user.id, await get_frp_shard_loads(db, gateway.name))
+                allocation.set(vm=vm.username, ip=private_ip, node=node.name, gateway=gateway.name, frp_shard=frp_shard)
             
             proxies_to_add = []
             vm_rules_list = [] # This will be stored in the DB
             
             for rule_pydantic in vm.inbound_rules:
-                rule = rule_pydantic.model_dump()
-                remotePort = find_port_from_set(used_ports)
-                used_ports.add(remotePort) # Reserve it for this request
+                # Reserves the remote port or subdomain for this request
+                rule = allocate_tunnel(rule_pydantic.model_dump(), vm.username, gateway, used_ports, used_subdomains)
                 
                 # Add AWS rule
-                add_inbound_security_rule(remotePort, f"Tunnel for {vm.username} port {remotePort}")
+                if "remotePort" in rule:
+                    remotePort = rule["remotePort"]
+                    add_inbound_security_rule(
+                        gateway, remotePort, f"Tunnel for {vm.username} port {remotePort}", protocol=rule_proxy_type(rule)
+                    )
                 
-                rule["remotePort"] = remotePort
                 vm_rules_list.append(rule)
                 
                 # Prepare frpc.toml entry
-                proxy_name = f"{vm.username}-{rule['vm_port']}"
-                new_proxy_toml = f"""
-[[proxies]]
-name = "{proxy_name}"
-type = "tcp"
-localIP = "{private_ip}"
-localPort = {rule['vm_port']}
-remotePort = {remotePort}
-"""
-                proxies_to_add.append(new_proxy_toml)
+                proxies_to_add.append(render_rule_proxy(vm.username, private_ip, rule))
             
             # Create the new VM record in the DB
             new_vm_record = VM(
@@ -832,13 +1333,19 @@ remotePort = {remotePort}
                 private_ip=private_ip,
                 inbound_rules=vm_rules_list,
                 owner_id=current_user.id,
-                status="Provisioning"
+                node=node.name,
+                gateway=gateway.name,
+                frp_shard=frp_shard,
+                status="Provisioning",
+                trace_id=current_trace_id(),
+                provisioning_script=vm.provisioning_script,
+                script_status="Pending" if vm.provisioning_script else None,
             )
             db.add(new_vm_record)
             
-            # Write all proxies to frpc.toml
+            # Write all proxies to this VM's shard config
             # Use the non-blocking helper
-            await asyncio.to_thread(_append_proxies_to_config, proxies_to_add)
+            await asyncio.to_thread(_append_proxies_to_config, gateway.name, frp_shard, proxies_to_add)
             
             # Commit DB changes *after* other blocking I/O
             await db.commit()
@@ -851,13 +1358,27 @@ remotePort = {remotePort}
         vagrantfile_content = get_vagrantfile_content(vm, private_ip, ssh_key.public_key)
         with open(vm_path / "Vagrantfile", "w") as f:
             f.write(vagrantfile_content)
+        await node_write_vagrantfile(node, vm.username, vagrantfile_content)
+        VM_LOGS.write(vm.username, "create", f"Scheduled on node '{node.name}', gateway '{gateway.name}', frpc shard {frp_shard}, IP {private_ip}")
+
+        # Reload first: background tasks run in order, and the readiness probe
+        # checks the SSH tunnel, which needs the new proxies loaded
+        reload_frpc_background(background_tasks, gateway.name, frp_shard)
+        queue_boot_job(background_tasks, current_user, new_vm_record.id, str(vm_path), "provision")
+
+        ssh_rule = next((rule for rule in vm_rules_list if rule["vm_port"] == 22 and "remotePort" in rule), None)
+        message = (
+            f"ssh -i {vm.key_name} {vm.username}@{gateway.address} -p {ssh_rule['remotePort']}"
+            if ssh_rule else f"VM '{vm.username}' is provisioning."
+        )
+        return {
+            "message": message,
+            "endpoints": [public_endpoint(gateway, rule) for rule in vm_rules_list],
+        }
 
-        background_tasks.add_task(background_provision_vm, new_vm_record.id, str(vm_path))
-        reload_frpc_background(background_tasks)
-
-        ssh_port = vm_rules_list[0]['remotePort']
-        return {"message": f"ssh -i {vm.key_name} {vm.username}@13.233.204.203 -p {ssh_port}"}
-
+    except HTTPException:
+        await db.rollback()
+        raise
     except Exception as e:
         await db.rollback() # Rollback in case of error
         raise HTTPException(status_code=500, detail=str(e))
@@ -877,9 +1398,10 @@ async def delete_vm(
     vm_to_delete = await get_user_vm_by_name(db, vm_name, current_user.id)
     if not vm_to_delete:
         raise HTTPException(status_code=403, detail="Forbidden: VM not found or you do not own it.")
+    raise_if_script_running(vm_to_delete)
     
     # Pass the serializable VM ID to the background task
-    background_tasks.add_task(delete_vm_background, vm_to_delete.id)
+    queue_lifecycle_job(background_tasks, current_user, delete_vm_background, vm_to_delete.id)
     
     return {"message": f"VM '{vm_name}' deletion scheduled."}
 # endregion
@@ -888,6 +1410,32 @@ async def delete_vm(
 
 
 #region --- Start VM Endpoints ---
+async def boot_vm(vm: VM, db: AsyncSession, background_tasks: BackgroundTasks, user: User, boot_kind: str, status: str):
+    """Shared by /start-vm and /resume-vm: checks capacity, marks the VM and boots it in the background."""
+    vm_path = VMS_DIR / vm.name
+    if not vm_path.exists():
+        raise HTTPException(status_code=404, detail="VM directory not found.")
+    raise_if_script_running(vm)
+
+    await claim_node_capacity(vm, db, status)
+    queue_boot_job(background_tasks, user, vm.id, str(vm_path), boot_kind)
+
+async def claim_node_capacity(vm: VM, db: AsyncSession, status: str):
+    """
+    Moves a VM that is about to run into `status`. Stopped and suspended VMs give
+    their CPU and RAM back, so someone else may have taken it: raises 409 then.
+    """
+    async with RESOURCE_LOCK:
+        if vm.status in ("Stopped", "Suspended"):
+            committed = await get_committed_resources(db)
+            if not await node_has_capacity(get_node(vm.node), vm.ram, vm.cpu, committed):
+                raise HTTPException(status_code=409, detail=f"Node '{vm.node}' does not have enough free CPU and RAM to start this VM right now.")
+        vm.status = status
+        vm.idle_reason = None
+        vm.idle_action_at = None
+        vm.trace_id = current_trace_id()
+        await db.commit()
+
 @app.post("/start-vm/{vm_name}")
 async def start_vm(
     vm_name: str,
@@ -899,26 +1447,633 @@ async def start_vm(
     if not vm:
         raise HTTPException(status_code=403, detail="Forbidden: VM not found or you do not own it.")
     
-    result = await db.execute(select(VM).where(VM.id == vm.id))
-    vm_obj = result.scalars().first()
-    if vm_obj:
-        vm_obj.status = "Starting"
-        await db.commit()
-    
-    vm_path = VMS_DIR / vm.name
-    if not vm_path.exists():
-        raise HTTPException(status_code=404, detail="VM directory not found.")
-    
-    background_tasks.add_task(background_provision_vm,vm.id ,str(vm_path))
+    # Starting a suspended VM restores its saved state, same as /resume-vm
+    if vm.status == "Suspended":
+        await boot_vm(vm, db, background_tasks, current_user, "resume", "Resuming")
+        return {"message": f"VM '{vm.name}' is resuming..."}
+    await boot_vm(vm, db, background_tasks, current_user, "cold_boot", "Starting")
     return {"message": f"VM '{vm.name}' is booting..."}
+
+@app.post("/resume-vm/{vm_name}")
+async def resume_vm(
+    vm_name: str,
+    background_tasks: BackgroundTasks,
+    current_user: User = Depends(current_active_user),
+    db: AsyncSession = Depends(get_async_db)
+):
+    """Restores a suspended VM's saved memory state, which is much faster than a cold boot."""
+    vm = await get_user_vm_by_name(db, vm_name, current_user.id)
+    if not vm:
+        raise HTTPException(status_code=403, detail="Forbidden: VM not found or you do not own it.")
+    if vm.status != "Suspended":
+        raise HTTPException(status_code=409, detail=f"VM '{vm.name}' is {vm.status}, not Suspended.")
+    await boot_vm(vm, db, background_tasks, current_user, "resume", "Resuming")
+    return {"message": f"VM '{vm.name}' is resuming..."}
+
+@app.get("/boot-latency")
+async def boot_latency(
+    current_user: User = Depends(current_active_user),
+    db: AsyncSession = Depends(get_async_db)
+):
+    """
+    Time `vagrant up` took, and until the VM was reachable, for first
+    provisioning, cold boots and resumes, for the user's VMs (every VM for admins).
+    """
+    timings = await get_boot_timings(db, None if current_user.is_superuser else current_user.id)
+    by_kind: dict = {}
+    reachable_by_kind: dict = {}
+    for timing in timings:
+        by_kind.setdefault(timing.kind, []).append(timing.seconds)
+        if timing.reachable_seconds is not None:
+            reachable_by_kind.setdefault(timing.kind, []).append(timing.reachable_seconds)
+    report = {kind: summarize_latency(samples) for kind, samples in by_kind.items()}
+    if "resume" in report and "cold_boot" in report and report["resume"]["p50"] > 0:
+        report["resume_speedup_p50"] = round(report["cold_boot"]["p50"] / report["resume"]["p50"], 2)
+    # Until sshd answered, which is what users actually wait for
+    report["time_to_reachable"] = {kind: summarize_latency(samples) for kind, samples in reachable_by_kind.items()}
+    return report
+
+
+@app.get("/readiness-probes")
+async def readiness_probes(current_user: User = Depends(current_superuser)):
+    """Admin: booted VMs this worker is still waiting on to become reachable."""
+    return probes_in_flight()
+#endregion
+
+
+#region --- Health Endpoints ---
+# Each readiness check gives up after this many seconds
+READY_CHECK_TIMEOUT = float(os.environ.get("READY_CHECK_TIMEOUT", "5"))
+# The AWS check calls the EC2 API, so its result is reused for this long
+AWS_READY_CACHE_SECONDS = float(os.environ.get("AWS_READY_CACHE_SECONDS", "60"))
+# Checks that must pass for /readyz to return 200. The others are only reported.
+READYZ_REQUIRED = {name.strip() for name in os.environ.get("READYZ_REQUIRED", "db,frpc").split(",") if name.strip()}
+
+_aws_check_cache: dict = {"checked_at": 0.0, "result": None}
+
+async def check_db() -> dict:
+    async with async_session_factory() as db:
+        await db.execute(text("SELECT 1"))
+    return {"ok": True}
+
+async def check_frpc() -> dict:
+    clients = await asyncio.to_thread(frpc_status)
+    return {"ok": bool(clients) and all(clients.values()), "clients": clients}
+
+def _describe_security_groups() -> dict:
+    """One describe call per gateway security group. Blocking; run in a thread."""
+    groups = {}
+    for gateway in GATEWAYS:
+        if gateway.security_group_id:
+            get_ec2_client(gateway.region).describe_security_groups(GroupIds=[gateway.security_group_id])
+            groups[gateway.name] = gateway.security_group_id
+    return groups
+
+async def check_aws() -> dict:
+    if not any(gateway.security_group_id for gateway in GATEWAYS):
+        return {"ok": True, "detail": "No gateway uses a security group."}
+    now = time.monotonic()
+    if _aws_check_cache["result"] is None or now - _aws_check_cache["checked_at"] > AWS_READY_CACHE_SECONDS:
+        try:
+            groups = await asyncio.wait_for(asyncio.to_thread(_describe_security_groups), READY_CHECK_TIMEOUT)
+            result = {"ok": True, "security_groups": groups}
+        except Exception as e:
+            result = {"ok": False, "error": str(e) or type(e).__name__}
+        _aws_check_cache.update(checked_at=now, result=result)
+    return _aws_check_cache["result"]
+
+@app.get("/healthz")
+async def healthz():
+    """Liveness: the process is up and serving requests. Touches no dependencies."""
+    return {"status": "ok", "pid": os.getpid()}
+
+@app.get("/readyz")
+async def readyz():
+    """
+    Readiness: reports the database, frpc and AWS separately.
+    Returns 503 until startup has finished and every check in READYZ_REQUIRED passes.
+    """
+    checks = {"db": check_db, "frpc": check_frpc, "aws": check_aws}
+    results = await asyncio.gather(
+        *(asyncio.wait_for(check(), READY_CHECK_TIMEOUT) for check in checks.values()), return_exceptions=True
+    )
+    report = {}
+    for name, result in zip(checks, results):
+        if isinstance(result, BaseException):
+            result = {"ok": False, "error": str(result) or type(result).__name__}
+        report[name] = {**result, "required": name in READYZ_REQUIRED}
+    ready = STARTUP_COMPLETE and all(report[name]["ok"] for name in READYZ_REQUIRED if name in report)
+    return JSONResponse(
+        status_code=200 if ready else 503,
+        content={
+            "status": "ready" if ready else "not_ready",
+            "startup_complete": STARTUP_COMPLETE,
+            "startup_seconds": STARTUP_TIMINGS,
+            "checks": report,
+        },
+    )
+#endregion
+
+
+#region --- Snapshot Endpoints ---
+SNAPSHOT_MAX_PER_USER = int(os.environ.get("SNAPSHOT_MAX_PER_USER", "10"))
+SNAPSHOT_MAX_DISK_MB_PER_USER = int(os.environ.get("SNAPSHOT_MAX_DISK_MB_PER_USER", "20480"))
+SNAPSHOT_NAME_PATTERN = re.compile(r"^[A-Za-z0-9][A-Za-z0-9_-]{0,62}$")
+# A snapshot can't be taken or restored while the VM is in the middle of one of these
+VM_BUSY_STATUSES = ("Provisioning", "Starting", "Stopping", "Suspending", "Resuming", "Restoring", "Deleting")
+
+class SnapshotBody(BaseModel):
+    name: str
+    description: Optional[str] = None
+
+def serialize_snapshot(snapshot: Snapshot) -> dict:
+    return {
+        "name": snapshot.name,
+        "description": snapshot.description,
+        "status": snapshot.status,
+        "size_mb": round(snapshot.size_bytes / (1024 * 1024), 1),
+        "created_at": snapshot.created_at,
+    }
+
+async def _get_owned_vm(db: AsyncSession, vm_name: str, user: User) -> VM:
+    """The user's VM, if neither it nor one of its snapshots is mid-operation."""
+    vm = await get_user_vm_by_name(db, vm_name, user.id)
+    if not vm:
+        raise HTTPException(status_code=403, detail="Forbidden: VM not found or you do not own it.")
+    if vm.status in VM_BUSY_STATUSES:
+        raise HTTPException(status_code=409, detail=f"VM '{vm.name}' is {vm.status}; try again once it settles.")
+    raise_if_script_running(vm)
+    # The hypervisor handles one snapshot operation per VM at a time
+    busy = next((s for s in await get_snapshots_for_vm(db, vm.id) if s.status in ("Creating", "Deleting")), None)
+    if busy:
+        raise HTTPException(status_code=409, detail=f"Snapshot '{busy.name}' of VM '{vm.name}' is {busy.status}; try again once it finishes.")
+    return vm
+
+async def background_snapshot_save(snapshot_id: int, vm_id: int):
+    async with async_session_factory() as db:
+        snapshot = await db.get(Snapshot, snapshot_id)
+        vm_obj = await db.get(VM, vm_id)
+        if not snapshot or not vm_obj:
+            return
+        node, vm_path = get_node(vm_obj.node), str(VMS_DIR / vm_obj.name)
+        try:
+            usage_before = await node_snapshot_usage(node, vm_obj.name, vm_path)
+            returncode, _ = await node_snapshot(node, vm_obj.name, vm_path, "save", snapshot.name, VM_LOGS.writer(vm_obj.name, "snapshot"))
+            if returncode != 0:
+                raise Exception(f"snapshot save exited with code {returncode}")
+            usage_after = await node_snapshot_usage(node, vm_obj.name, vm_path)
+            snapshot.size_bytes = max(0, usage_after - usage_before)
+            snapshot.status = "Ready"
+            await db.commit()
+            VM_LOGS.write(vm_obj.name, "snapshot", f"Snapshot '{snapshot.name}' saved")
+        except Exception as e:
+            snapshot.status = "Error"
+            await db.commit()
+            VM_LOGS.write(vm_obj.name, "snapshot", f"Snapshot '{snapshot.name}' failed: {e}")
+            print(f"[ERROR] Snapshot '{snapshot.name}' of VM {vm_id} failed: {e}")
+
+async def background_snapshot_restore(snapshot_id: int, vm_id: int) -> float | None:
+    """
+    Rolls the VM back to the snapshot. Its IP, tunnels and security-group rules
+    are untouched. Returns the seconds the restore took, or None if it failed.
+    With readiness probing on, the VM stays Restoring until
+    background_wait_until_ready finds it reachable.
+    """
+    async with async_session_factory() as db:
+        snapshot = await db.get(Snapshot, snapshot_id)
+        vm_obj = await db.get(VM, vm_id)
+        if not snapshot or not vm_obj:
+            return None
+        node, vm_path = get_node(vm_obj.node), str(VMS_DIR / vm_obj.name)
+        try:
+            restore_started = time.perf_counter()
+            returncode, _ = await node_snapshot(node, vm_obj.name, vm_path, "restore", snapshot.name, VM_LOGS.writer(vm_obj.name, "restore"))
+            if returncode != 0:
+                raise Exception(f"snapshot restore exited with code {returncode}")
+            restore_seconds = time.perf_counter() - restore_started
+            if READINESS_ENABLED:
+                VM_LOGS.write(vm_obj.name, "restore", f"Restored snapshot '{snapshot.name}' after {restore_seconds:.1f}s; waiting for it to become reachable")
+                return restore_seconds
+            vm_obj.status = "Active"
+            vm_obj.active_since = datetime.utcnow()
+            await db.commit()
+            await record_boot_timing(db, vm_obj, "restore", restore_seconds)
+            VM_LOGS.write(vm_obj.name, "restore", f"Restored snapshot '{snapshot.name}'; Status: Active after {restore_seconds:.1f}s")
+            return restore_seconds
+        except Exception as e:
+            vm_obj.status = "Error"
+            await db.commit()
+            VM_LOGS.write(vm_obj.name, "restore", f"Status: Error ({e})")
+            print(f"[ERROR] Restoring snapshot '{snapshot.name}' of VM {vm_id} failed: {e}")
+            return None
+
+async def _run_restore_stages(owner_id, weight: float, snapshot_id: int, vm_id: int):
+    restore_seconds = await LIFECYCLE_QUEUE.run(owner_id, weight, background_snapshot_restore, snapshot_id, vm_id)
+    if restore_seconds is not None and READINESS_ENABLED:
+        await background_wait_until_ready(vm_id, "restore", restore_seconds)
+
+async def background_snapshot_delete(snapshot_id: int, vm_id: int):
+    async with async_session_factory() as db:
+        snapshot = await db.get(Snapshot, snapshot_id)
+        vm_obj = await db.get(VM, vm_id)
+        if not snapshot or not vm_obj:
+            return
+        try:
+            returncode, _ = await node_snapshot(
+                get_node(vm_obj.node), vm_obj.name, str(VMS_DIR / vm_obj.name), "delete", snapshot.name,
+                VM_LOGS.writer(vm_obj.name, "snapshot")
+            )
+            if returncode != 0:
+                raise Exception(f"snapshot delete exited with code {returncode}")
+            await db.delete(snapshot)
+            await db.commit()
+            VM_LOGS.write(vm_obj.name, "snapshot", f"Snapshot '{snapshot.name}' deleted")
+        except Exception as e:
+            snapshot.status = "Error"
+            await db.commit()
+            print(f"[ERROR] Deleting snapshot '{snapshot.name}' of VM {vm_id} failed: {e}")
+
+@app.post("/vms/{vm_name}/snapshots")
+async def create_snapshot(
+    vm_name: str,
+    body: SnapshotBody,
+    background_tasks: BackgroundTasks,
+    current_user: User = Depends(current_active_user),
+    db: AsyncSession = Depends(get_async_db)
+):
+    """Takes a named snapshot of the VM (live, if it is running)."""
+    vm = await _get_owned_vm(db, vm_name, current_user)
+    if not SNAPSHOT_NAME_PATTERN.match(body.name):
+        raise HTTPException(status_code=400, detail="Snapshot names are 1-63 letters, digits, '-' or '_', starting with a letter or digit.")
+
+    # Checked and inserted under the lock, so parallel requests cannot both slip under the quota
+    async with RESOURCE_LOCK:
+        if await get_vm_snapshot_by_name(db, vm.id, body.name):
+            raise HTTPException(status_code=400, detail=f"VM '{vm.name}' already has a snapshot named '{body.name}'.")
+
+        count, size_bytes = await get_snapshot_usage(db, current_user.id)
+        if count >= SNAPSHOT_MAX_PER_USER:
+            raise HTTPException(status_code=409, detail=f"Snapshot quota reached ({SNAPSHOT_MAX_PER_USER} snapshots). Delete one first.")
+        if size_bytes >= SNAPSHOT_MAX_DISK_MB_PER_USER * 1024 * 1024:
+            raise HTTPException(status_code=409, detail=f"Snapshot disk quota reached ({SNAPSHOT_MAX_DISK_MB_PER_USER} MB). Delete one first.")
+
+        snapshot = Snapshot(vm_id=vm.id, owner_id=current_user.id, name=body.name, description=body.description, status="Creating")
+        db.add(snapshot)
+        await db.commit()
+    await db.refresh(snapshot)
+    queue_lifecycle_job(background_tasks, current_user, background_snapshot_save, snapshot.id, vm.id)
+    return {"message": f"Snapshot '{snapshot.name}' of VM '{vm.name}' is being taken.", "snapshot": serialize_snapshot(snapshot)}
+
+@app.get("/vms/{vm_name}/snapshots")
+async def list_snapshots(
+    vm_name: str,
+    current_user: User = Depends(current_active_user),
+    db: AsyncSession = Depends(get_async_db)
+):
+    vm = await get_user_vm_by_name(db, vm_name, current_user.id)
+    if not vm:
+        raise HTTPException(status_code=403, detail="Forbidden: VM not found or you do not own it.")
+    count, size_bytes = await get_snapshot_usage(db, current_user.id)
+    return {
+        "snapshots": [serialize_snapshot(snapshot) for snapshot in await get_snapshots_for_vm(db, vm.id)],
+        "quota": {
+            "count": count,
+            "max_count": SNAPSHOT_MAX_PER_USER,
+            "used_mb": round(size_bytes / (1024 * 1024), 1),
+            "max_mb": SNAPSHOT_MAX_DISK_MB_PER_USER,
+        },
+    }
+
+@app.post("/vms/{vm_name}/snapshots/{snapshot_name}/restore")
+async def restore_snapshot(
+    vm_name: str,
+    snapshot_name: str,
+    background_tasks: BackgroundTasks,
+    current_user: User = Depends(current_active_user),
+    db: AsyncSession = Depends(get_async_db)
+):
+    """Resets the VM to the snapshot and leaves it running, keeping its IP and tunnels."""
+    vm = await _get_owned_vm(db, vm_name, current_user)
+    snapshot = await get_vm_snapshot_by_name(db, vm.id, snapshot_name)
+    if not snapshot:
+        raise HTTPException(status_code=404, detail=f"Snapshot '{snapshot_name}' not found.")
+    if snapshot.status != "Ready":
+        raise HTTPException(status_code=409, detail=f"Snapshot '{snapshot_name}' is {snapshot.status}.")
+    await claim_node_capacity(vm, db, "Restoring")
+    # Like a boot, the restore holds a queue slot and the wait for SSH does not
+    background_tasks.add_task(_run_restore_stages, current_user.id, current_user.fair_share_weight or 1.0, snapshot.id, vm.id)
+    return {"message": f"VM '{vm.name}' is being restored to '{snapshot.name}'."}
+
+@app.delete("/vms/{vm_name}/snapshots/{snapshot_name}")
+async def delete_snapshot(
+    vm_name: str,
+    snapshot_name: str,
+    background_tasks: BackgroundTasks,
+    current_user: User = Depends(current_active_user),
+    db: AsyncSession = Depends(get_async_db)
+):
+    vm = await _get_owned_vm(db, vm_name, current_user)
+    snapshot = await get_vm_snapshot_by_name(db, vm.id, snapshot_name)
+    if not snapshot:
+        raise HTTPException(status_code=404, detail=f"Snapshot '{snapshot_name}' not found.")
+    snapshot.status = "Deleting"
+    await db.commit()
+    queue_lifecycle_job(background_tasks, current_user, background_snapshot_delete, snapshot.id, vm.id)
+    return {"message": f"Snapshot '{snapshot_name}' is being deleted."}
+#endregion
+
+
+#region --- Idle Policy Endpoints ---
+class IdlePolicyBody(BaseModel):
+    opted_out: bool
+
+def _idle_policy_settings() -> dict:
+    return {
+        "enabled": IDLE_POLICY_ENABLED,
+        "action": IDLE_ACTION,
+        "threshold_minutes": IDLE_THRESHOLD_MINUTES,
+        "cpu_percent": IDLE_CPU_PERCENT,
+        "net_kbps": IDLE_NET_KBPS,
+    }
+
+@app.get("/idle-policy")
+async def get_idle_policy(current_user: User = Depends(current_active_user)):
+    """The idle policy's settings and whether the current user has opted out of it."""
+    return {**_idle_policy_settings(), "opted_out": current_user.idle_opt_out}
+
+@app.put("/idle-policy")
+async def set_idle_policy(
+    body: IdlePolicyBody,
+    current_user: User = Depends(current_active_user),
+    db: AsyncSession = Depends(get_async_db)
+):
+    """Opts all of the current user's VMs out of (or back into) automatic suspend/stop."""
+    user = await db.get(User, current_user.id)
+    user.idle_opt_out = body.opted_out
+    await db.commit()
+    return {**_idle_policy_settings(), "opted_out": user.idle_opt_out}
+
+@app.get("/idle-policy/reclaimed")
+async def idle_reclaimed_capacity(
+    current_user: User = Depends(current_superuser),
+    db: AsyncSession = Depends(get_async_db)
+):
+    """Admin view: VMs the idle policy has suspended or stopped, and the CPU/RAM that freed per node."""
+    vms = await get_idle_reclaimed_vms(db)
+    by_node: dict = {}
+    for vm in vms:
+        node = by_node.setdefault(vm.node, {"vms": 0, "cpu": 0, "ram_mb": 0})
+        node["vms"] += 1
+        node["cpu"] += vm.cpu
+        node["ram_mb"] += vm.ram
+    return {
+        "policy": _idle_policy_settings(),
+        "total": {
+            "vms": len(vms),
+            "cpu": sum(vm.cpu for vm in vms),
+            "ram_mb": sum(vm.ram for vm in vms),
+        },
+        "by_node": by_node,
+        "vms": [
+            {
+                "name": vm.name,
+                "owner_id": str(vm.owner_id),
+                "node": vm.node,
+                "status": vm.status,
+                "cpu": vm.cpu,
+                "ram_mb": vm.ram,
+                "idle_reason": vm.idle_reason,
+                "idle_action_at": vm.idle_action_at,
+            }
+            for vm in vms
+        ],
+    }
+#endregion
+
+
+#region --- VM Metrics Endpoints ---
+@app.get("/vms/{vm_name}/metrics")
+async def get_vm_metrics(
+    vm_name: str,
+    resolution: Literal["raw", "1m", "1h"] = "raw",
+    since: float = Query(0, description="Only points at or after this Unix time."),
+    current_user: User = Depends(current_active_user),
+    db: AsyncSession = Depends(get_async_db)
+):
+    """CPU, memory, disk and network series of the VM's hypervisor process."""
+    vm = await get_user_vm_by_name(db, vm_name, current_user.id)
+    if not vm:
+        raise HTTPException(status_code=403, detail="Forbidden: VM not found or you do not own it.")
+    points = await asyncio.to_thread(read_series, VMS_DIR, vm.name, resolution, since)
+    return {
+        "vm_name": vm.name,
+        "resolution": resolution,
+        "interval_seconds": next(seconds for name, seconds, _ in TIERS if name == resolution),
+        "fields": list(FIELDS),
+        "points": points,
+    }
+#endregion
+
+
+#region --- VM Log Endpoints ---
+@app.get("/vms/{vm_name}/logs")
+async def get_vm_logs(
+    vm_name: str,
+    offset: int = Query(0, description="Byte offset to read from. Negative values count back from the end."),
+    limit: int = Query(64 * 1024, ge=0),
+    file: int = Query(0, ge=0, description="0 for the current log, 1.. for rotated ones (1 is the newest)."),
+    current_user: User = Depends(current_active_user),
+    db: AsyncSession = Depends(get_async_db)
+):
+    """A byte range of the VM's lifecycle log. Poll with offset=next_offset to follow it."""
+    vm = await get_user_vm_by_name(db, vm_name, current_user.id)
+    if not vm:
+        raise HTTPException(status_code=403, detail="Forbidden: VM not found or you do not own it.")
+    files = await asyncio.to_thread(VM_LOGS.files, vm.name)
+    if file > 0 and file >= len(files):
+        raise HTTPException(status_code=404, detail=f"Log file {file} not found.")
+    chunk = await asyncio.to_thread(VM_LOGS.read, vm.name, offset, limit, file)
+    chunk["files"] = files
+    return chunk
+#endregion
+
+
+
+#region --- Custom Script Endpoints ---
+@app.get("/vms/{vm_name}/script")
+async def get_vm_script(
+    vm_name: str,
+    current_user: User = Depends(current_active_user),
+    db: AsyncSession = Depends(get_async_db)
+):
+    """Progress of the VM's custom provisioning script, with the tail of its output."""
+    vm = await get_user_vm_by_name(db, vm_name, current_user.id)
+    if not vm:
+        raise HTTPException(status_code=403, detail="Forbidden: VM not found or you do not own it.")
+    if vm.script_status is None:
+        raise HTTPException(status_code=404, detail=f"VM '{vm.name}' has no custom provisioning script.")
+    seconds = vm.script_seconds
+    if vm.script_status == "Running" and vm.script_started_at:
+        seconds = round((datetime.utcnow() - vm.script_started_at).total_seconds(), 1)
+    return {
+        "status": vm.script_status,
+        "exit_code": vm.script_exit_code,
+        "started_at": vm.script_started_at,
+        "seconds": seconds,
+        "output": vm.script_output,
+    }
+#endregion
+
+
+
+#region --- VM Trace Endpoints ---
+@app.get("/vms/{vm_name}/trace")
+async def get_vm_trace(
+    vm_name: str,
+    current_user: User = Depends(current_active_user),
+    db: AsyncSession = Depends(get_async_db)
+):
+    """
+    The spans of the VM's last create, start or resume, from the request through
+    the background boot, so time-to-Active can be broken down phase by phase.
+    """
+    vm = await get_user_vm_by_name(db, vm_name, current_user.id)
+    if not vm:
+        raise HTTPException(status_code=403, detail="Forbidden: VM not found or you do not own it.")
+    if not vm.trace_id:
+        raise HTTPException(status_code=404, detail=f"No trace recorded for VM '{vm_name}'.")
+    spans = await asyncio.to_thread(EXPORTER.read_trace, vm.trace_id)
+    if not spans:
+        raise HTTPException(status_code=404, detail=f"Trace {vm.trace_id} has expired.")
+
+    time_to_active = None
+    # With readiness probing on, the VM becomes Active in vm.wait_until_ready, otherwise in vm.boot
+    activation = next(
+        (s for s in spans if s["name"] in ("vm.boot", "vm.wait_until_ready") and s["attributes"].get("status") == "Active"),
+        None,
+    )
+    if activation is not None:
+        time_to_active = round((activation["start"] + activation["duration"] - spans[0]["start"]) * 1000, 1)
+    return {
+        "trace_id": vm.trace_id,
+        "status": vm.status,
+        "time_to_active_ms": time_to_active,
+        "spans": trace_tree(spans),
+    }
+#endregion
+
+
+#region --- Node Endpoints ---
+@app.get("/nodes")
+async def list_nodes(
+    current_user: User = Depends(current_superuser),
+    db: AsyncSession = Depends(get_async_db)
+):
+    """Admin view of every hypervisor node: reported free resources and what is allocated to VMs."""
+    committed = await get_committed_resources(db)
+    reports = await asyncio.gather(*(get_node_resources(node) for node in NODES), return_exceptions=True)
+    nodes = []
+    for node, report in zip(NODES, reports):
+        used_cpu, used_ram = committed.get(node.name, (0, 0))
+        nodes.append({
+            "name": node.name,
+            "url": node.url,
+            "reachable": not isinstance(report, Exception),
+            "resources": None if isinstance(report, Exception) else report,
+            "allocated_cpu": used_cpu,
+            "allocated_ram_mb": used_ram,
+        })
+    return nodes
+
+
+@app.get("/nodes/latency")
+async def node_latency(current_user: User = Depends(current_superuser)):
+    """Per-operation hypervisor driver latency on every node, for comparing drivers."""
+    reports = await asyncio.gather(
+        *(get_agent_latency(node) for node in NODES if not node.is_local), return_exceptions=True
+    )
+    latency = {}
+    remote_nodes = [node for node in NODES if not node.is_local]
+    for node, report in zip(remote_nodes, reports):
+        latency[node.name] = None if isinstance(report, Exception) else report
+    for node in NODES:
+        if node.is_local:
+            latency[node.name] = {"driver": get_driver().name, "operations": get_driver().latency_report()}
+    return latency
+#endregion
+
+
+
+#region --- Network GC Endpoints ---
+@app.post("/network-gc")
+async def run_network_gc(
+    dry_run: bool = Query(True, description="Only report orphans, without reclaiming them"),
+    current_user: User = Depends(current_superuser),
+):
+    """Admin: reconciles VM rows, frpc shard configs and gateway security groups, and reports (or reclaims) orphans."""
+    report = await collect_network_garbage(VMS_DIR, dry_run=dry_run)
+    print(f"[NETWORK GC] Run by {current_user.email}: {summarize_report(report)}")
+    return report
+#endregion
+
+
+
+#region --- Profiling Endpoints ---
+@app.get("/profiles")
+async def get_profiles(current_user: User = Depends(current_superuser)):
+    """Admin: stored request profiles, newest first."""
+    return await asyncio.to_thread(list_profiles)
+
+
+@app.get("/profiles/{profile_id}")
+async def get_profile(profile_id: str, current_user: User = Depends(current_superuser)):
+    """Admin: one profile's timings and hotspots."""
+    path = profile_path(profile_id, ".json")
+    if path is None:
+        raise HTTPException(status_code=404, detail=f"Profile '{profile_id}' not found.")
+    return json.loads(await asyncio.to_thread(path.read_text))
+
+
+@app.get("/profiles/{profile_id}/download")
+async def download_profile(profile_id: str, current_user: User = Depends(current_superuser)):
+    """Admin: the profile's collapsed stacks, for flamegraph.pl or speedscope."""
+    path = profile_path(profile_id, ".folded")
+    if path is None:
+        raise HTTPException(status_code=404, detail=f"Profile '{profile_id}' not found.")
+    return FileResponse(path, media_type="text/plain", filename=path.name)
+#endregion
+
+
+
+#region --- Metrics Endpoints ---
+@app.get("/metrics", response_class=PlainTextResponse)
+async def metrics(authorization: Optional[str] = Header(None)):
+    """Tunnel stats in the Prometheus text format, for METRICS_TOKEN holders and admins."""
+    if not (METRICS_TOKEN and authorization == f"Bearer {METRICS_TOKEN}"):
+        user = await user_from_authorization(authorization)
+        if user is None or not user.is_superuser:
+            raise HTTPException(status_code=403, detail="Metrics need the METRICS_TOKEN or an admin login.")
+    stats = await asyncio.to_thread(load_tunnel_stats)
+    return PlainTextResponse(render_metrics(stats), media_type="text/plain; version=0.0.4")
 #endregion
 
 
+
+#region --- VM Cache Endpoints ---
+@app.get("/vm-cache")
+async def vm_cache_stats(current_user: User = Depends(current_superuser)):
+    """Admin: size and hit ratio of this worker's VM lookup cache."""
+    return VM_CACHE.stats()
+#endregion
+
+
+
 #region --- Stop VM Endpoints ---
 @app.post("/stop-vm/{vm_name}")
 async def stop_vm(
     vm_name: str,
     background_tasks: BackgroundTasks,
+    mode: Literal["halt", "suspend"] = Query("halt", description="halt shuts the VM down; suspend saves its state for a fast resume."),
     current_user: User = Depends(current_active_user),
     db: AsyncSession = Depends(get_async_db)
 ):
@@ -929,10 +2084,29 @@ async def stop_vm(
     vm_path = VMS_DIR / vm.name
     if not vm_path.exists():
         raise HTTPException(status_code=404, detail="VM directory not found.")
+    raise_if_script_running(vm)
         
-    # You should create a 'stream_vagrant_halt' function for this
-    background_tasks.add_task(background_stop_vm, vm.id, str(vm_path))
+    if mode == "suspend":
+        if vm.status != "Active":
+            raise HTTPException(status_code=409, detail=f"Only Active VMs can be suspended; '{vm.name}' is {vm.status}.")
+        queue_lifecycle_job(background_tasks, current_user, background_suspend_vm, vm.id, str(vm_path))
+        return {"message": f"VM '{vm.name}' is suspending."}
+
+    queue_lifecycle_job(background_tasks, current_user, background_stop_vm, vm.id, str(vm_path))
+    if vm.status == "Suspended":
+        # Every driver's halt discards the saved state, so it boots fresh next time
+        return {"message": f"VM '{vm.name}' is stopping; its saved state will be discarded."}
     return {"message": f"VM '{vm.name}' is stopping."}
+
+@app.post("/suspend-vm/{vm_name}")
+async def suspend_vm(
+    vm_name: str,
+    background_tasks: BackgroundTasks,
+    current_user: User = Depends(current_active_user),
+    db: AsyncSession = Depends(get_async_db)
+):
+    """Saves the VM's memory to disk and frees its CPU and RAM. /resume-vm picks up where it left off."""
+    return await stop_vm(vm_name, background_tasks, "suspend", current_user, db)
 #endregion
 
 #endregion
\ No newline at end of file
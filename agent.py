@@ -0,0 +1,141 @@
+"""
+Nimbus node agent.
+
+Runs on every hypervisor host and performs Vagrant operations there on behalf
+of the controller. Start it with:
+
+    NODE_AGENT_TOKEN=... uvicorn agent:app --host 0.0.0.0 --port 9000
+"""
+import os
+import asyncio
+from pathlib import Path
+from shutil import rmtree
+
+import psutil
+from dotenv import load_dotenv
+from fastapi import FastAPI, HTTPException, Depends, Header
+from pydantic import BaseModel
+
+from drivers import get_driver
+from telemetry import read_counters
+
+load_dotenv()
+
+#region -------------Settings--------
+BASE_DIR = Path(__file__).parent
+VMS_DIR = Path(os.environ.get("AGENT_VMS_DIR", BASE_DIR / ".vms"))
+AGENT_TOKEN = os.environ.get("NODE_AGENT_TOKEN")
+
+app = FastAPI(
+    title="Nimbus-IaaS Node Agent",
+    description="Runs Vagrant operations on this host for the Nimbus controller.",
+)
+
+def verify_token(x_agent_token: str | None = Header(default=None)):
+    if AGENT_TOKEN and x_agent_token != AGENT_TOKEN:
+        raise HTTPException(status_code=401, detail="Invalid agent token.")
+
+class VagrantfileBody(BaseModel):
+    vagrantfile: str
+#endregion
+
+
+
+#region --- Endpoints ---
+@app.get("/resources", dependencies=[Depends(verify_token)])
+async def resources():
+    """Total and currently free CPU and RAM on this host."""
+    memory = psutil.virtual_memory()
+    cpu_total = psutil.cpu_count(logical=True) or 1
+    cpu_percent = psutil.cpu_percent(interval=None)
+    return {
+        "cpu_total": cpu_total,
+        "cpu_free": round(cpu_total * (1 - cpu_percent / 100), 2),
+        "ram_total_mb": memory.total // (1024 * 1024),
+        "ram_free_mb": memory.available // (1024 * 1024),
+    }
+
+def _vm_path(vm_name: str) -> Path:
+    vm_path = VMS_DIR / vm_name
+    if vm_path.resolve().parent != VMS_DIR.resolve():
+        raise HTTPException(status_code=400, detail="Invalid VM name.")
+    return vm_path
+
+@app.put("/vms/{vm_name}", dependencies=[Depends(verify_token)])
+async def put_vagrantfile(vm_name: str, body: VagrantfileBody):
+    """Creates (or replaces) the VM's Vagrant directory."""
+    vm_path = _vm_path(vm_name)
+    vm_path.mkdir(parents=True, exist_ok=True)
+    with open(vm_path / "Vagrantfile", "w") as f:
+        f.write(body.vagrantfile)
+    return {"message": f"Vagrantfile for '{vm_name}' written."}
+
+async def _run(vm_name: str, operation: str, *args: str):
+    vm_path = _vm_path(vm_name)
+    if not vm_path.exists():
+        raise HTTPException(status_code=404, detail="VM directory not found.")
+    returncode, output = await getattr(get_driver(), operation)(vm_name, str(vm_path), *args)
+    return {"returncode": returncode, "output": output}
+
+@app.post("/vms/{vm_name}/up", dependencies=[Depends(verify_token)])
+async def vm_up(vm_name: str):
+    return await _run(vm_name, "up")
+
+@app.post("/vms/{vm_name}/halt", dependencies=[Depends(verify_token)])
+async def vm_halt(vm_name: str):
+    return await _run(vm_name, "halt")
+
+@app.post("/vms/{vm_name}/provision/{provisioner}", dependencies=[Depends(verify_token)])
+async def vm_provision(vm_name: str, provisioner: str):
+    return await _run(vm_name, "provision", provisioner)
+
+@app.post("/vms/{vm_name}/savestate", dependencies=[Depends(verify_token)])
+async def vm_savestate(vm_name: str):
+    return await _run(vm_name, "savestate")
+
+@app.get("/vms/{vm_name}/snapshots/usage", dependencies=[Depends(verify_token)])
+async def vm_snapshot_usage(vm_name: str):
+    vm_path = _vm_path(vm_name)
+    if not vm_path.exists():
+        return {"bytes": 0}
+    return {"bytes": await get_driver().snapshot_usage(vm_name, str(vm_path))}
+
+@app.post("/vms/{vm_name}/snapshots/{snapshot}", dependencies=[Depends(verify_token)])
+async def vm_snapshot_save(vm_name: str, snapshot: str):
+    return await _run(vm_name, "snapshot_save", snapshot)
+
+@app.post("/vms/{vm_name}/snapshots/{snapshot}/restore", dependencies=[Depends(verify_token)])
+async def vm_snapshot_restore(vm_name: str, snapshot: str):
+    return await _run(vm_name, "snapshot_restore", snapshot)
+
+@app.delete("/vms/{vm_name}/snapshots/{snapshot}", dependencies=[Depends(verify_token)])
+async def vm_snapshot_delete(vm_name: str, snapshot: str):
+    return await _run(vm_name, "snapshot_delete", snapshot)
+
+@app.get("/vms/{vm_name}/status", dependencies=[Depends(verify_token)])
+async def vm_status(vm_name: str):
+    vm_path = _vm_path(vm_name)
+    if not vm_path.exists():
+        return {"status": "not_created"}
+    return {"status": await get_driver().status(vm_name, str(vm_path))}
+
+@app.get("/latency", dependencies=[Depends(verify_token)])
+async def latency():
+    """Per-operation latency of this host's hypervisor driver."""
+    return {"driver": get_driver().name, "operations": get_driver().latency_report()}
+
+@app.get("/samples", dependencies=[Depends(verify_token)])
+async def samples(names: str = ""):
+    """Raw CPU, memory, disk and network counters of the named VMs (comma separated)."""
+    vm_paths = {name: _vm_path(name) for name in names.split(",") if name}
+    return await asyncio.to_thread(read_counters, vm_paths)
+
+@app.delete("/vms/{vm_name}", dependencies=[Depends(verify_token)])
+async def vm_destroy(vm_name: str):
+    vm_path = _vm_path(vm_name)
+    if not vm_path.exists():
+        return {"returncode": 0, "output": ""}
+    result = await _run(vm_name, "destroy")
+    rmtree(vm_path)
+    return result
+#endregion
@@ -0,0 +1,11 @@
+from typing import Optional
+
+#region --- ASGI Helpers ---
+# Shared by the raw ASGI middlewares (tracing, profiling, rate limits, idempotency)
+def get_header(scope: dict, name: bytes) -> Optional[str]:
+    """The first value of a request header; name must be lowercase bytes."""
+    for key, value in scope.get("headers", []):
+        if key == name:
+            return value.decode("latin-1")
+    return None
+#endregion
@@ -1,4 +1,5 @@
 import uuid
+import jwt
 from dotenv import load_dotenv
 from fastapi import Depends, Request
 from fastapi_users import BaseUserManager, FastAPIUsers, UUIDIDMixin
@@ -8,6 +9,7 @@ from fastapi_users.authentication import (
     JWTStrategy,
 )
 from fastapi_users.db import SQLAlchemyUserDatabase
+from fastapi_users.jwt import decode_jwt
 
 # --- NEW IMPORTS ---
 from fastapi_users import schemas  # <-- THIS IS THE CORRECT IMPORT
@@ -15,7 +17,7 @@ from fastapi_users import schemas  # <-- THIS IS THE CORRECT IMPORT
 
 from sqlalchemy.ext.asyncio import AsyncSession
 
-from database import get_async_db
+from database import get_async_db, async_session_factory
 from models import User
 import os
 
@@ -80,4 +82,38 @@ auth_backend = AuthenticationBackend(
 fastapi_users = FastAPIUsers[User, uuid.UUID](get_user_manager, [auth_backend])
 
 # --- Dependency ---
-current_active_user = fastapi_users.current_user(active=True)
\ No newline at end of file
+current_active_user = fastapi_users.current_user(active=True)
+current_superuser = fastapi_users.current_user(active=True, superuser=True)
+
+def _bearer_token(authorization: str | None) -> str | None:
+    scheme, _, token = (authorization or "").partition(" ")
+    return token if scheme.lower() == "bearer" and token else None
+
+def user_id_from_token(authorization: str | None) -> str | None:
+    """
+    The user id in an "Authorization: Bearer <jwt>" header issued by this server,
+    or None. Checks the signature and expiry but not the database, so it is cheap
+    enough to run on every request (e.g. to key rate limits).
+    """
+    token = _bearer_token(authorization)
+    if token is None:
+        return None
+    strategy = get_jwt_strategy()
+    try:
+        data = decode_jwt(token, strategy.decode_key, strategy.token_audience, algorithms=[strategy.algorithm])
+    except jwt.PyJWTError:
+        return None
+    return data.get("sub")
+
+async def user_from_authorization(authorization: str | None) -> User | None:
+    """
+    The active user behind an "Authorization: Bearer <jwt>" header, or None.
+    For code outside FastAPI's dependency injection, such as ASGI middleware.
+    """
+    token = _bearer_token(authorization)
+    if token is None:
+        return None
+    async with async_session_factory() as session:
+        user_manager = UserManager(SQLAlchemyUserDatabase(session, User))
+        user = await get_jwt_strategy().read_token(token, user_manager)
+    return user if user is not None and user.is_active else None
@@ -0,0 +1,54 @@
+"""
+Compares per-operation latency of the hypervisor drivers.
+
+    python bench_drivers.py --drivers sim --vms 50
+    python bench_drivers.py --drivers vagrant vboxmanage --vm-path .vms/myvm --rounds 3
+
+The simulated driver runs --vms in-memory VMs concurrently. The vagrant and
+vboxmanage drivers need an existing, already-created VM (--vm-path), which is
+cycled through status -> halt -> up -> savestate -> up --rounds times.
+"""
+import argparse
+import asyncio
+from pathlib import Path
+
+from drivers import DRIVERS, SimulatedDriver
+
+
+async def cycle(driver, vm_name: str, vm_path: str, rounds: int):
+    for _ in range(rounds):
+        await driver.status(vm_name, vm_path)
+        await driver.halt(vm_name, vm_path)
+        await driver.up(vm_name, vm_path)
+        await driver.savestate(vm_name, vm_path)
+        await driver.up(vm_name, vm_path)
+
+async def bench(driver_name: str, vm_path: str | None, vms: int, rounds: int) -> dict:
+    driver = DRIVERS[driver_name]()
+    if isinstance(driver, SimulatedDriver):
+        names = [f"sim-{i}" for i in range(vms)]
+        await asyncio.gather(*(driver.up(name, "") for name in names))
+        await asyncio.gather(*(cycle(driver, name, "", rounds) for name in names))
+    else:
+        if not vm_path:
+            raise SystemExit(f"--vm-path is required for the {driver_name} driver")
+        await cycle(driver, Path(vm_path).name, vm_path, rounds)
+    return driver.latency_report()
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--drivers", nargs="+", default=["sim"], choices=list(DRIVERS))
+    parser.add_argument("--vm-path", help="Vagrant directory of an existing VM")
+    parser.add_argument("--vms", type=int, default=20, help="Concurrent VMs for the simulated driver")
+    parser.add_argument("--rounds", type=int, default=3)
+    args = parser.parse_args()
+
+    print(f"{'driver':<12}{'operation':<12}{'count':>7}{'mean s':>10}{'p50 s':>10}{'p95 s':>10}{'max s':>10}")
+    for driver_name in args.drivers:
+        report = asyncio.run(bench(driver_name, args.vm_path, args.vms, args.rounds))
+        for operation, stats in sorted(report.items()):
+            print(f"{driver_name:<12}{operation:<12}{stats['count']:>7}{stats['mean']:>10}"
+                  f"{stats['p50']:>10}{stats['p95']:>10}{stats['max']:>10}")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,154 @@
+import os
+import asyncio
+from pathlib import Path
+from typing import Awaitable, Callable, Dict, List
+
+from dotenv import load_dotenv
+
+from tracing import span
+
+if os.name == "nt":
+    import msvcrt
+else:
+    import fcntl
+
+load_dotenv()
+
+#region -------------Settings--------
+BASE_DIR = Path(__file__).parent
+LOCK_DIR = Path(os.environ.get("NIMBUS_LOCK_DIR", BASE_DIR / ".locks"))
+# How often a follower worker retries to become the leader
+LEADER_RETRY_INTERVAL = float(os.environ.get("LEADER_RETRY_INTERVAL", "5"))
+#endregion
+
+
+
+#region --- File Locks ---
+def _lock_file(path: Path, blocking: bool = True):
+    """
+    Opens path and takes an exclusive OS-level lock on it. Returns the open file,
+    or None if blocking is False and another process holds the lock.
+    The OS drops the lock if the holding process dies.
+    This is a blocking function intended to be run in a thread.
+    """
+    path.parent.mkdir(parents=True, exist_ok=True)
+    f = open(path, "a+")
+    try:
+        if os.name == "nt":
+            mode = msvcrt.LK_LOCK if blocking else msvcrt.LK_NBLCK
+            while True:
+                try:
+                    f.seek(0)
+                    msvcrt.locking(f.fileno(), mode, 1)
+                    break
+                except OSError:
+                    # LK_LOCK gives up after ~10 seconds; keep waiting
+                    if not blocking:
+                        raise
+        else:
+            fcntl.flock(f.fileno(), fcntl.LOCK_EX if blocking else fcntl.LOCK_EX | fcntl.LOCK_NB)
+        return f
+    except OSError:
+        f.close()
+        return None
+
+def _unlock_file(f):
+    try:
+        if os.name == "nt":
+            f.seek(0)
+            msvcrt.locking(f.fileno(), msvcrt.LK_UNLCK, 1)
+        else:
+            fcntl.flock(f.fileno(), fcntl.LOCK_UN)
+    finally:
+        f.close()
+
+class InterProcessLock:
+    """
+    An asyncio lock that also excludes other processes (e.g. other uvicorn workers).
+    Coroutines in this process queue on an asyncio.Lock first, so at most one
+    thread per process waits on the file lock.
+    """
+    def __init__(self, path: Path):
+        self.path = path
+        self._local_lock = asyncio.Lock()
+        self._file = None
+
+    async def __aenter__(self):
+        with span("lock.wait", lock=self.path.name):
+            await self._local_lock.acquire()
+            try:
+                self._file = await asyncio.to_thread(_lock_file, self.path)
+            except BaseException:
+                self._local_lock.release()
+                raise
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        try:
+            _unlock_file(self._file)
+        finally:
+            self._file = None
+            self._local_lock.release()
+
+# Guards IP/port allocation and every frpc config write, across all workers
+RESOURCE_LOCK = InterProcessLock(LOCK_DIR / "resources.lock")
+# Serialises one-off startup work such as schema creation
+STARTUP_LOCK = InterProcessLock(LOCK_DIR / "startup.lock")
+#endregion
+
+
+
+#region --- Leader Election ---
+# Work that must run in exactly one worker: owning the frpc processes and the
+# periodic background loops. Loops register here and are started on election.
+_leader_tasks: Dict[str, Callable[[], Awaitable[None]]] = {}
+_leader_file = None
+_running_tasks: List[asyncio.Task] = []
+_election_task: asyncio.Task | None = None
+
+def register_leader_task(name: str, coro_factory: Callable[[], Awaitable[None]]):
+    """Runs coro_factory() in the leader worker for as long as it is leader."""
+    _leader_tasks[name] = coro_factory
+
+def is_leader() -> bool:
+    return _leader_file is not None
+
+async def _try_become_leader(on_elected: Callable[[], Awaitable[None]]) -> bool:
+    global _leader_file
+    leader_file = await asyncio.to_thread(_lock_file, LOCK_DIR / "leader.lock", False)
+    if leader_file is None:
+        return False
+    _leader_file = leader_file
+    print(f"[LEADER] Worker {os.getpid()} is now the leader.")
+    await on_elected()
+    for name, coro_factory in _leader_tasks.items():
+        _running_tasks.append(asyncio.create_task(coro_factory(), name=name))
+    return True
+
+async def _follow(on_elected: Callable[[], Awaitable[None]]):
+    """Followers retry periodically; the lock frees up when the leader exits or dies."""
+    while not await _try_become_leader(on_elected):
+        await asyncio.sleep(LEADER_RETRY_INTERVAL)
+
+async def start_leader_election(on_elected: Callable[[], Awaitable[None]]):
+    """Becomes leader now if possible, otherwise keeps trying in the background."""
+    global _election_task
+    if not await _try_become_leader(on_elected):
+        print(f"[LEADER] Worker {os.getpid()} is a follower.")
+        _election_task = asyncio.create_task(_follow(on_elected))
+
+async def stop_leader_election(on_resigned: Callable[[], Awaitable[None]]):
+    """Cancels the leader loops, runs on_resigned if leader, and releases leadership."""
+    global _leader_file, _election_task
+    if _election_task:
+        _election_task.cancel()
+        _election_task = None
+    for task in _running_tasks:
+        task.cancel()
+    await asyncio.gather(*_running_tasks, return_exceptions=True)
+    _running_tasks.clear()
+    if _leader_file is not None:
+        await on_resigned()
+        _unlock_file(_leader_file)
+        _leader_file = None
+#endregion
@@ -1,6 +1,7 @@
 from sqlalchemy.ext.asyncio import AsyncSession
-from sqlalchemy import select  # <-- IMPORT SELECT HERE TOO
-from models import VM, User, SSHKey
+from sqlalchemy import select, func, or_  # <-- IMPORT SELECT HERE TOO
+from models import VM, User, SSHKey, BootTiming, Snapshot
+from vm_cache import VM_CACHE, VM_CACHE_ENABLED, cached_user_vm
 
 async def get_vm_by_name(db: AsyncSession, vm_name: str) -> VM | None:
     """Fetches a single VM by its name."""
@@ -10,29 +11,124 @@ async def get_vm_by_name(db: AsyncSession, vm_name: str) -> VM | None:
 
 
 async def get_user_vm_by_name(db: AsyncSession, vm_name: str, user_id: str) -> VM | None:
-    """Fetches a single VM by name, ONLY if it belongs to the specified user."""
+    """
+    Fetches a single VM by name, ONLY if it belongs to the specified user.
+    Served from VM_CACHE when it holds a current copy (see vm_cache.py).
+    """
+    key = (str(user_id), vm_name)
+    if VM_CACHE_ENABLED:
+        vm = await cached_user_vm(db, key)
+        if vm is not None:
+            return vm
+        # Read before the query, so a write committed meanwhile marks this copy stale
+        version = VM_CACHE.version(key)
     result = await db.execute(
         select(VM).where(VM.name == vm_name, VM.owner_id == user_id)
     )
-    return result.scalars().first()
+    vm = result.scalars().first()
+    if vm is not None and VM_CACHE_ENABLED:
+        VM_CACHE.put(key, version, vm)
+    return vm
 
 async def get_vms_for_user(db: AsyncSession, user_id: str) -> list[VM]:
     """Fetches all VMs owned by a specific user."""
     result = await db.execute(select(VM).where(VM.owner_id == user_id))
     return result.scalars().all()
 
+async def get_all_vms(db: AsyncSession) -> list[VM]:
+    """Fetches every VM, regardless of owner."""
+    result = await db.execute(select(VM))
+    return result.scalars().all()
+
+async def get_vms_by_status(db: AsyncSession, *statuses: str) -> list[VM]:
+    """Fetches every VM in one of the given statuses, regardless of owner."""
+    result = await db.execute(select(VM).where(VM.status.in_(statuses)))
+    return result.scalars().all()
+
+async def get_idle_candidates(db: AsyncSession) -> list[VM]:
+    """Active VMs whose owners have not opted out of the idle policy and that are not running their custom script."""
+    result = await db.execute(
+        select(VM).join(User, VM.owner_id == User.id)
+        .where(VM.status == "Active", User.idle_opt_out.is_(False))
+        .where(or_(VM.script_status.is_(None), VM.script_status != "Running"))
+    )
+    return result.scalars().all()
+
+async def get_idle_reclaimed_vms(db: AsyncSession) -> list[VM]:
+    """VMs the idle policy suspended or stopped that are still down."""
+    result = await db.execute(
+        select(VM).where(VM.idle_reason.is_not(None), VM.status.in_(RELEASED_STATUSES))
+    )
+    return result.scalars().all()
+
+async def record_boot_timing(db: AsyncSession, vm: VM, kind: str, seconds: float, reachable_seconds: float | None = None):
+    db.add(BootTiming(vm_name=vm.name, owner_id=str(vm.owner_id), node=vm.node, kind=kind, seconds=seconds, reachable_seconds=reachable_seconds))
+    await db.commit()
+
+async def get_boot_timings(db: AsyncSession, owner_id: str | None = None) -> list[BootTiming]:
+    """Every recorded boot, optionally only those of one user's VMs."""
+    query = select(BootTiming)
+    if owner_id is not None:
+        query = query.where(BootTiming.owner_id == str(owner_id))
+    result = await db.execute(query)
+    return result.scalars().all()
+
+async def get_snapshots_for_vm(db: AsyncSession, vm_id: int) -> list[Snapshot]:
+    result = await db.execute(select(Snapshot).where(Snapshot.vm_id == vm_id).order_by(Snapshot.created_at))
+    return result.scalars().all()
+
+async def get_vm_snapshot_by_name(db: AsyncSession, vm_id: int, name: str) -> Snapshot | None:
+    result = await db.execute(select(Snapshot).where(Snapshot.vm_id == vm_id, Snapshot.name == name))
+    return result.scalars().first()
+
+async def get_snapshot_usage(db: AsyncSession, user_id: str) -> tuple[int, int]:
+    """Returns (number of snapshots, bytes they use) for one user."""
+    result = await db.execute(
+        select(func.count(Snapshot.id), func.sum(Snapshot.size_bytes)).where(Snapshot.owner_id == user_id)
+    )
+    count, size = result.one()
+    return count, size or 0
+
+async def get_user_usage(db: AsyncSession, user_id: str) -> dict[str, int]:
+    """What a user holds against their quota: VMs (in any state), vCPUs, RAM and gateway ports."""
+    result = await db.execute(select(VM.cpu, VM.ram, VM.inbound_rules).where(VM.owner_id == user_id))
+    rows = result.all()
+    return {
+        "vms": len(rows),
+        "vcpu": sum(cpu for cpu, _, _ in rows),
+        "ram_mb": sum(ram for _, ram, _ in rows),
+        "ports": sum(1 for _, _, rules in rows for rule in rules or [] if "remotePort" in rule),
+    }
+
+async def get_user_by_id(db: AsyncSession, user_id) -> User | None:
+    result = await db.execute(select(User).where(User.id == user_id))
+    return result.scalars().first()
+
+async def get_frp_shard_loads(db: AsyncSession, gateway: str) -> dict[int, int]:
+    """Returns {frp_shard: number of VMs on that shard} for one gateway."""
+    result = await db.execute(
+        select(VM.frp_shard, func.count(VM.id))
+        .where(VM.gateway == gateway)
+        .group_by(VM.frp_shard)
+    )
+    return {shard: count for shard, count in result.all()}
+
 async def get_all_used_ips(db: AsyncSession) -> set[str]:
     """Returns a set of all private_ip strings currently in the DB."""
     result = await db.execute(select(VM.private_ip))
     return set(result.scalars().all())
 
-async def get_all_used_ports(db: AsyncSession) -> set[int]:
+async def get_all_used_ports(db: AsyncSession, gateway: str | None = None) -> set[int]:
     """
-    Returns a set of all remotePort integers currently in use.
+    Returns a set of all remotePort integers currently in use,
+    optionally only those on one gateway.
     This queries the JSON field, so it's a bit more complex.
     """
     used_ports = set()
-    result = await db.execute(select(VM.inbound_rules))
+    query = select(VM.inbound_rules)
+    if gateway is not None:
+        query = query.where(VM.gateway == gateway)
+    result = await db.execute(query)
     
     # The result contains lists of rule-dictionaries
     for rules_list in result.scalars().all():
@@ -43,6 +139,31 @@ async def get_all_used_ports(db: AsyncSession) -> set[int]:
                 used_ports.add(rule["remotePort"])
     return used_ports
 
+async def get_all_used_subdomains(db: AsyncSession, gateway: str) -> set[str]:
+    """Returns the subdomains of every http rule on one gateway."""
+    result = await db.execute(select(VM.inbound_rules).where(VM.gateway == gateway))
+    return {rule["subdomain"] for rules_list in result.scalars().all() for rule in rules_list or [] if "subdomain" in rule}
+
+async def get_tunnel_loads(db: AsyncSession) -> dict[str, int]:
+    """Returns {gateway name: number of remote ports in use on it}."""
+    loads: dict[str, int] = {}
+    result = await db.execute(select(VM.gateway, VM.inbound_rules))
+    for gateway, rules_list in result.all():
+        loads[gateway] = loads.get(gateway, 0) + sum(1 for rule in rules_list or [] if "remotePort" in rule)
+    return loads
+
+# Stopped and suspended VMs hold no CPU or RAM on their host
+RELEASED_STATUSES = ("Stopped", "Suspended")
+
+async def get_committed_resources(db: AsyncSession) -> dict[str, tuple[int, int]]:
+    """Returns {node name: (vCPUs, RAM MB) allocated to running or booting VMs on that node}."""
+    result = await db.execute(
+        select(VM.node, func.sum(VM.cpu), func.sum(VM.ram))
+        .where(VM.status.not_in(RELEASED_STATUSES))
+        .group_by(VM.node)
+    )
+    return {node: (cpu or 0, ram or 0) for node, cpu, ram in result.all()}
+
 async def get_user_key_by_name(db: AsyncSession, key_name: str, user_id: str) -> SSHKey | None:
     """Fetches a single SSH key by name, only if it belongs to the user."""
     result = await db.execute(
@@ -1,12 +1,26 @@
 import os
+from sqlalchemy import inspect, text
 from sqlalchemy.ext.asyncio import create_async_engine, async_sessionmaker, AsyncSession
 from typing import AsyncGenerator  # <-- 1. ADD THIS IMPORT
+from dotenv import load_dotenv
+
+from tracing import trace_sqlalchemy
+
+load_dotenv()
 
 # Use a file-based SQLite database named "nimbus.db"
 DATABASE_URL = "sqlite+aiosqlite:///./nimbus.db"
 
-# Create the async engine
-engine = create_async_engine(DATABASE_URL, echo=True)
+# Create the async engine.
+# With several uvicorn workers sharing nimbus.db, a writer may have to wait for
+# another worker's transaction, so allow SQLite to wait instead of failing.
+engine = create_async_engine(
+    DATABASE_URL,
+    echo=os.environ.get("SQL_ECHO", "true").lower() == "true",
+    connect_args={"timeout": 30},
+)
+# Every statement becomes a "db.query" span of the trace that ran it
+trace_sqlalchemy(engine.sync_engine)
 
 # Create a sessionmaker to generate new sessions.
 # This is what your background task will use.
@@ -23,4 +37,28 @@ async def get_async_db() -> AsyncGenerator[AsyncSession, None]:  # <-- 2. FIX TH
             await session.commit()
         except Exception:
             await session.rollback()
-            raise
\ No newline at end of file
+            raise
+
+async def init_models(metadata):
+    """Creates missing tables, then adds any columns the models gained since."""
+    async with engine.begin() as conn:
+        await conn.run_sync(metadata.create_all)
+        await conn.run_sync(_add_missing_columns, metadata)
+
+def _add_missing_columns(sync_conn, metadata):
+    """
+    create_all never alters an existing table, so a nimbus.db created before a
+    column was added to the models would be missing it. Add those columns here.
+    """
+    inspector = inspect(sync_conn)
+    for table in metadata.sorted_tables:
+        existing_columns = {column["name"] for column in inspector.get_columns(table.name)}
+        for column in table.columns:
+            if column.name in existing_columns:
+                continue
+            column_type = column.type.compile(dialect=sync_conn.dialect)
+            ddl = f"ALTER TABLE {table.name} ADD COLUMN {column.name} {column_type}"
+            if column.server_default is not None:
+                default = column.server_default.arg
+                ddl += f" DEFAULT {default.text if hasattr(default, 'text') else repr(default)}"
+            sync_conn.execute(text(ddl))
@@ -0,0 +1,392 @@
+import os
+import time
+import asyncio
+import subprocess
+from collections import deque
+from pathlib import Path
+from statistics import mean, median
+from typing import Callable, Deque, Dict, Iterable, List, Optional, Tuple
+
+from dotenv import load_dotenv
+
+from vagrant import stream_vagrant
+
+load_dotenv()
+
+#region -------------Settings--------
+# "vagrant", "vboxmanage" or "sim"
+HYPERVISOR_DRIVER = os.environ.get("HYPERVISOR_DRIVER", "vagrant")
+VBOXMANAGE_PATH = os.environ.get("VBOXMANAGE_PATH", "VBoxManage")
+# How long an ACPI shutdown may take before the VM is powered off
+VBOX_ACPI_TIMEOUT = float(os.environ.get("VBOX_ACPI_TIMEOUT", "60"))
+# Per-operation delay of the simulated driver, in seconds
+SIM_DRIVER_LATENCY = float(os.environ.get("SIM_DRIVER_LATENCY", "0.05"))
+# Most recent durations kept per operation for latency_report()
+DRIVER_TIMING_WINDOW = int(os.environ.get("DRIVER_TIMING_WINDOW", "1000"))
+
+Result = Tuple[int, str]  # (exit code, output), same as vagrant.stream_vagrant
+LogCallback = Optional[Callable[[str], None]]  # Receives output lines as they are produced
+#endregion
+
+
+
+#region --- Driver Interface ---
+def summarize_latency(samples: Iterable[float]) -> dict:
+    """count/mean/p50/p95/max of a non-empty collection of durations in seconds."""
+    ordered = sorted(samples)
+    return {
+        "count": len(ordered),
+        "mean": round(mean(ordered), 4),
+        "p50": round(median(ordered), 4),
+        "p95": round(ordered[min(len(ordered) - 1, int(len(ordered) * 0.95))], 4),
+        "max": round(ordered[-1], 4),
+    }
+
+class HypervisorDriver:
+    """
+    Lifecycle operations on one VM, identified by its name and Vagrant directory.
+    Every operation is timed, so drivers can be compared with latency_report()
+    over the last DRIVER_TIMING_WINDOW runs of each. Operations take an
+    optional log callback that receives their output.
+    """
+    name = "base"
+
+    def __init__(self):
+        self.timings: Dict[str, Deque[float]] = {}
+
+    async def _timed(self, operation: str, coro):
+        started = time.perf_counter()
+        try:
+            return await coro
+        finally:
+            self.timings.setdefault(operation, deque(maxlen=DRIVER_TIMING_WINDOW)).append(time.perf_counter() - started)
+
+    def latency_report(self) -> Dict[str, dict]:
+        """{operation: count/mean/p50/p95/max in seconds}, over the most recent runs"""
+        return {operation: summarize_latency(samples) for operation, samples in self.timings.items()}
+
+    # Create (first call) or boot the VM. Resumes it if it is saved.
+    async def up(self, vm_name: str, vm_path: str, log: LogCallback = None) -> Result:
+        return await self._timed("up", self._up(vm_name, vm_path, log))
+
+    async def halt(self, vm_name: str, vm_path: str, log: LogCallback = None) -> Result:
+        return await self._timed("halt", self._halt(vm_name, vm_path, log))
+
+    # Save the VM's memory to disk and stop it
+    async def savestate(self, vm_name: str, vm_path: str, log: LogCallback = None) -> Result:
+        return await self._timed("savestate", self._savestate(vm_name, vm_path, log))
+
+    async def destroy(self, vm_name: str, vm_path: str, log: LogCallback = None) -> Result:
+        return await self._timed("destroy", self._destroy(vm_name, vm_path, log))
+
+    # Run one named provisioner in the running VM (e.g. one declared with run: "never")
+    async def provision(self, vm_name: str, vm_path: str, provisioner: str, log: LogCallback = None) -> Result:
+        return await self._timed("provision", self._provision(vm_name, vm_path, provisioner, log))
+
+    # One of "running", "saved", "poweroff", "not_created" (or the hypervisor's own word)
+    async def status(self, vm_name: str, vm_path: str) -> str:
+        return await self._timed("status", self._status(vm_name, vm_path))
+
+    # Named snapshots of the VM's disks (and memory, if it is running)
+    async def snapshot_save(self, vm_name: str, vm_path: str, snapshot: str, log: LogCallback = None) -> Result:
+        return await self._timed("snapshot_save", self._snapshot_save(vm_name, vm_path, snapshot, log))
+
+    # Leaves the VM running from the snapshot
+    async def snapshot_restore(self, vm_name: str, vm_path: str, snapshot: str, log: LogCallback = None) -> Result:
+        return await self._timed("snapshot_restore", self._snapshot_restore(vm_name, vm_path, snapshot, log))
+
+    async def snapshot_delete(self, vm_name: str, vm_path: str, snapshot: str, log: LogCallback = None) -> Result:
+        return await self._timed("snapshot_delete", self._snapshot_delete(vm_name, vm_path, snapshot, log))
+
+    # Bytes used by all of the VM's snapshots
+    async def snapshot_usage(self, vm_name: str, vm_path: str) -> int:
+        return await asyncio.to_thread(vbox_snapshot_usage, vm_path)
+
+    async def _up(self, vm_name: str, vm_path: str, log: LogCallback) -> Result:
+        raise NotImplementedError
+
+    async def _halt(self, vm_name: str, vm_path: str, log: LogCallback) -> Result:
+        raise NotImplementedError
+
+    async def _savestate(self, vm_name: str, vm_path: str, log: LogCallback) -> Result:
+        raise NotImplementedError
+
+    async def _destroy(self, vm_name: str, vm_path: str, log: LogCallback) -> Result:
+        raise NotImplementedError
+
+    async def _provision(self, vm_name: str, vm_path: str, provisioner: str, log: LogCallback) -> Result:
+        raise NotImplementedError
+
+    async def _status(self, vm_name: str, vm_path: str) -> str:
+        raise NotImplementedError
+
+    async def _snapshot_save(self, vm_name: str, vm_path: str, snapshot: str, log: LogCallback) -> Result:
+        raise NotImplementedError
+
+    async def _snapshot_restore(self, vm_name: str, vm_path: str, snapshot: str, log: LogCallback) -> Result:
+        raise NotImplementedError
+
+    async def _snapshot_delete(self, vm_name: str, vm_path: str, snapshot: str, log: LogCallback) -> Result:
+        raise NotImplementedError
+#endregion
+
+
+
+#region --- Vagrant Driver ---
+class VagrantDriver(HypervisorDriver):
+    """Runs everything through the vagrant CLI (the original behaviour)."""
+    name = "vagrant"
+
+    async def _up(self, vm_name, vm_path, log):
+        return await asyncio.to_thread(stream_vagrant, vm_path, "up", on_line=log)
+
+    async def _halt(self, vm_name, vm_path, log):
+        return await asyncio.to_thread(stream_vagrant, vm_path, "halt", on_line=log)
+
+    async def _savestate(self, vm_name, vm_path, log):
+        return await asyncio.to_thread(stream_vagrant, vm_path, "suspend", on_line=log)
+
+    async def _destroy(self, vm_name, vm_path, log):
+        return await asyncio.to_thread(stream_vagrant, vm_path, "destroy", "-f", on_line=log)
+
+    async def _provision(self, vm_name, vm_path, provisioner, log):
+        return await asyncio.to_thread(stream_vagrant, vm_path, "provision", "--provision-with", provisioner, on_line=log)
+
+    async def _status(self, vm_name, vm_path):
+        returncode, output = await asyncio.to_thread(stream_vagrant, vm_path, "status", "--machine-readable")
+        # Lines look like: 1700000000,default,state,running
+        for line in output.splitlines():
+            fields = line.split(",")
+            if len(fields) >= 4 and fields[2] == "state":
+                return fields[3]
+        return "unknown"
+
+    async def _snapshot_save(self, vm_name, vm_path, snapshot, log):
+        return await asyncio.to_thread(stream_vagrant, vm_path, "snapshot", "save", snapshot, on_line=log)
+
+    async def _snapshot_restore(self, vm_name, vm_path, snapshot, log):
+        # Boots the VM afterwards; --no-provision keeps the provisioners from running again
+        return await asyncio.to_thread(stream_vagrant, vm_path, "snapshot", "restore", "--no-provision", snapshot, on_line=log)
+
+    async def _snapshot_delete(self, vm_name, vm_path, snapshot, log):
+        return await asyncio.to_thread(stream_vagrant, vm_path, "snapshot", "delete", snapshot, on_line=log)
+#endregion
+
+
+
+#region --- VBoxManage Driver ---
+def vbox_machine_id(vm_path: str) -> str | None:
+    """The VirtualBox UUID Vagrant recorded for this VM, or None if it was never created."""
+    id_file = Path(vm_path) / ".vagrant" / "machines" / "default" / "virtualbox" / "id"
+    if not id_file.exists():
+        return None
+    return id_file.read_text().strip() or None
+
+def run_vboxmanage(*args: str, log: LogCallback = None) -> Result:
+    """
+    Runs a VBoxManage command. Returns (exit code, output).
+    This is a blocking function intended to be run in a thread.
+    """
+    try:
+        result = subprocess.run([VBOXMANAGE_PATH, *args], capture_output=True, text=True)
+        returncode, output = result.returncode, result.stdout + result.stderr
+    except Exception as e:
+        returncode, output = -1, str(e)
+    if log:
+        log(f"$ VBoxManage {' '.join(args)}\n")
+        for line in output.splitlines(keepends=True):
+            log(line)
+    return returncode, output
+
+def vbox_snapshot_usage(vm_path: str) -> int:
+    """
+    Size of the VM's VirtualBox snapshot folder (differencing disks and saved
+    memory), or 0 if it has none.
+    This is a blocking function intended to be run in a thread.
+    """
+    machine_id = vbox_machine_id(vm_path)
+    if machine_id is None:
+        return 0
+    returncode, output = run_vboxmanage("showvminfo", machine_id, "--machinereadable")
+    folder = next((line.split("=", 1)[1].strip('"') for line in output.splitlines() if line.startswith("SnapFldr=")), None)
+    if returncode != 0 or not folder or not Path(folder).is_dir():
+        return 0
+    return sum(f.stat().st_size for f in Path(folder).rglob("*") if f.is_file())
+
+def vbox_state(machine_id: str) -> str:
+    """VMState from `VBoxManage showvminfo`, e.g. running, saved, poweroff."""
+    returncode, output = run_vboxmanage("showvminfo", machine_id, "--machinereadable")
+    if returncode != 0:
+        return "unknown"
+    for line in output.splitlines():
+        if line.startswith("VMState="):
+            return line.split("=", 1)[1].strip('"')
+    return "unknown"
+
+class VBoxManageDriver(VagrantDriver):
+    """
+    Talks to VirtualBox directly for VMs that already exist, skipping vagrant's
+    Ruby startup. Creating (first up), provisioning and destroying still go
+    through vagrant, since those need its box and provisioning logic.
+    """
+    name = "vboxmanage"
+
+    async def _up(self, vm_name, vm_path, log):
+        machine_id = vbox_machine_id(vm_path)
+        if machine_id is None:
+            return await super()._up(vm_name, vm_path, log)
+        state = await asyncio.to_thread(vbox_state, machine_id)
+        if state == "running":
+            return 0, "already running"
+        if state == "paused":
+            return await asyncio.to_thread(run_vboxmanage, "controlvm", machine_id, "resume", log=log)
+        # Also restores a saved state
+        return await asyncio.to_thread(run_vboxmanage, "startvm", machine_id, "--type", "headless", log=log)
+
+    async def _halt(self, vm_name, vm_path, log):
+        machine_id = vbox_machine_id(vm_path)
+        if machine_id is None:
+            return 0, "not created"
+        state = await asyncio.to_thread(vbox_state, machine_id)
+        if state == "saved":
+            # Powered off already, but would resume from its saved state (vagrant halt discards it too)
+            return await asyncio.to_thread(run_vboxmanage, "discardstate", machine_id, log=log)
+        if state == "paused":
+            return await asyncio.to_thread(run_vboxmanage, "controlvm", machine_id, "poweroff", log=log)
+        if state != "running":
+            return 0, "not running"
+        returncode, output = await asyncio.to_thread(run_vboxmanage, "controlvm", machine_id, "acpipowerbutton", log=log)
+        if returncode != 0:
+            return returncode, output
+
+        deadline = time.monotonic() + VBOX_ACPI_TIMEOUT
+        while time.monotonic() < deadline:
+            await asyncio.sleep(1)
+            if await asyncio.to_thread(vbox_state, machine_id) == "poweroff":
+                return 0, output
+        # The guest ignored the ACPI event, so pull the plug (as vagrant halt does)
+        return await asyncio.to_thread(run_vboxmanage, "controlvm", machine_id, "poweroff", log=log)
+
+    async def _savestate(self, vm_name, vm_path, log):
+        machine_id = vbox_machine_id(vm_path)
+        if machine_id is None:
+            return 1, "VM has not been created"
+        return await asyncio.to_thread(run_vboxmanage, "controlvm", machine_id, "savestate", log=log)
+
+    async def _status(self, vm_name, vm_path):
+        machine_id = vbox_machine_id(vm_path)
+        if machine_id is None:
+            return "not_created"
+        return await asyncio.to_thread(vbox_state, machine_id)
+
+    async def _snapshot_save(self, vm_name, vm_path, snapshot, log):
+        machine_id = vbox_machine_id(vm_path)
+        if machine_id is None:
+            return 1, "VM has not been created"
+        return await asyncio.to_thread(run_vboxmanage, "snapshot", machine_id, "take", snapshot, "--live", log=log)
+
+    async def _snapshot_restore(self, vm_name, vm_path, snapshot, log):
+        machine_id = vbox_machine_id(vm_path)
+        if machine_id is None:
+            return 1, "VM has not been created"
+        # VirtualBox only restores into a stopped VM
+        if await asyncio.to_thread(vbox_state, machine_id) in ("running", "paused"):
+            returncode, output = await asyncio.to_thread(run_vboxmanage, "controlvm", machine_id, "poweroff", log=log)
+            if returncode != 0:
+                return returncode, output
+        returncode, output = await asyncio.to_thread(run_vboxmanage, "snapshot", machine_id, "restore", snapshot, log=log)
+        if returncode != 0:
+            return returncode, output
+        return await asyncio.to_thread(run_vboxmanage, "startvm", machine_id, "--type", "headless", log=log)
+
+    async def _snapshot_delete(self, vm_name, vm_path, snapshot, log):
+        machine_id = vbox_machine_id(vm_path)
+        if machine_id is None:
+            return 0, "not created"
+        return await asyncio.to_thread(run_vboxmanage, "snapshot", machine_id, "delete", snapshot, log=log)
+#endregion
+
+
+
+#region --- Simulated Driver ---
+class SimulatedDriver(HypervisorDriver):
+    """In-memory VMs with a fixed delay per operation. For load testing the controller."""
+    name = "sim"
+
+    def __init__(self, latency: float = SIM_DRIVER_LATENCY):
+        super().__init__()
+        self.latency = latency
+        self.states: Dict[str, str] = {}
+        self.snapshots: Dict[str, Dict[str, str]] = {}  # vm -> {snapshot: state when taken}
+
+    async def _transition(self, vm_name: str, state: str, log: LogCallback) -> Result:
+        await asyncio.sleep(self.latency)
+        self.states[vm_name] = state
+        if log:
+            log(f"[sim] {vm_name}: {state}\n")
+        return 0, f"{vm_name}: {state}"
+
+    async def _up(self, vm_name, vm_path, log):
+        return await self._transition(vm_name, "running", log)
+
+    async def _halt(self, vm_name, vm_path, log):
+        return await self._transition(vm_name, "poweroff", log)
+
+    async def _savestate(self, vm_name, vm_path, log):
+        if self.states.get(vm_name) != "running":
+            return 1, f"{vm_name} is not running"
+        return await self._transition(vm_name, "saved", log)
+
+    async def _destroy(self, vm_name, vm_path, log):
+        result = await self._transition(vm_name, "not_created", log)
+        self.states.pop(vm_name, None)
+        return result
+
+    async def _provision(self, vm_name, vm_path, provisioner, log):
+        if self.states.get(vm_name) != "running":
+            return 1, f"{vm_name} is not running"
+        await asyncio.sleep(self.latency)
+        if log:
+            log(f"[sim] {vm_name}: ran provisioner '{provisioner}'\n")
+        return 0, f"{vm_name}: provisioned with {provisioner}"
+
+    async def _status(self, vm_name, vm_path):
+        return self.states.get(vm_name, "not_created")
+
+    async def _snapshot_save(self, vm_name, vm_path, snapshot, log):
+        await asyncio.sleep(self.latency)
+        self.snapshots.setdefault(vm_name, {})[snapshot] = self.states.get(vm_name, "not_created")
+        return 0, f"{vm_name}: saved {snapshot}"
+
+    async def _snapshot_restore(self, vm_name, vm_path, snapshot, log):
+        if snapshot not in self.snapshots.get(vm_name, {}):
+            return 1, f"{vm_name} has no snapshot '{snapshot}'"
+        return await self._transition(vm_name, "running", log)
+
+    async def _snapshot_delete(self, vm_name, vm_path, snapshot, log):
+        await asyncio.sleep(self.latency)
+        self.snapshots.get(vm_name, {}).pop(snapshot, None)
+        return 0, f"{vm_name}: deleted {snapshot}"
+
+    async def snapshot_usage(self, vm_name, vm_path):
+        return 0
+#endregion
+
+
+
+DRIVERS = {
+    VagrantDriver.name: VagrantDriver,
+    VBoxManageDriver.name: VBoxManageDriver,
+    SimulatedDriver.name: SimulatedDriver,
+}
+
+_driver: HypervisorDriver | None = None
+
+def get_driver() -> HypervisorDriver:
+    """The driver selected by HYPERVISOR_DRIVER, created on first use."""
+    global _driver
+    if _driver is None:
+        if HYPERVISOR_DRIVER not in DRIVERS:
+            raise ValueError(f"Unknown HYPERVISOR_DRIVER '{HYPERVISOR_DRIVER}'. Choose one of: {', '.join(DRIVERS)}")
+        _driver = DRIVERS[HYPERVISOR_DRIVER]()
+    return _driver
@@ -0,0 +1,112 @@
+import os
+import time
+import heapq
+import asyncio
+from collections import deque
+from itertools import count
+from typing import Awaitable, Callable, Dict
+
+from dotenv import load_dotenv
+
+from drivers import summarize_latency
+from tracing import span
+
+load_dotenv()
+
+#region -------------Settings--------
+# Lifecycle jobs (boot, stop, suspend, delete, snapshot) a worker runs at once.
+# The rest wait in the fair queue. Each uvicorn worker has its own queue, so a
+# deployment runs up to workers x LIFECYCLE_CONCURRENCY jobs.
+LIFECYCLE_CONCURRENCY = int(os.environ.get("LIFECYCLE_CONCURRENCY", "4"))
+# Queue waits kept per owner for the stats
+LIFECYCLE_WAIT_SAMPLES = int(os.environ.get("LIFECYCLE_WAIT_SAMPLES", "200"))
+#endregion
+
+
+
+#region --- Fair Queue ---
+class FairQueue:
+    """
+    Runs at most `concurrency` jobs at once and dispatches the rest with
+    start-time fair queuing across owners: each job is tagged with a virtual
+    start time of max(now, the owner's previous finish), and finishes 1/weight
+    later. The lowest start tag runs next. An owner who queues fifty jobs
+    therefore waits behind their own earlier jobs, while someone with one job
+    is served after at most one of theirs per other active owner.
+    The queue lives in one process: with several uvicorn workers, fairness
+    holds among the jobs each worker was asked to run, not across workers.
+    """
+    def __init__(self, concurrency: int):
+        self.concurrency = concurrency
+        self._running = 0
+        self._virtual_time = 0.0
+        self._finish: Dict[str, float] = {}
+        self._heap: list = []  # (start tag, seq, owner, future)
+        self._seq = count()
+        self._waits: Dict[str, deque] = {}
+
+    def _tag(self, owner: str, weight: float) -> float:
+        start = max(self._virtual_time, self._finish.get(owner, 0.0))
+        self._finish[owner] = start + 1.0 / max(weight, 0.01)
+        return start
+
+    async def _acquire(self, owner: str, weight: float):
+        start = self._tag(owner, weight)
+        if self._running < self.concurrency and not self._heap:
+            self._running += 1
+            self._virtual_time = start
+            return
+        future = asyncio.get_running_loop().create_future()
+        entry = (start, next(self._seq), owner, future)
+        heapq.heappush(self._heap, entry)
+        try:
+            await future
+        except asyncio.CancelledError:
+            if future.done() and not future.cancelled():
+                self._release()  # It was dispatched just as it was cancelled
+            else:
+                self._heap.remove(entry)
+                heapq.heapify(self._heap)
+            raise
+
+    def _release(self):
+        self._running -= 1
+        while self._heap and self._running < self.concurrency:
+            start, _, owner, future = heapq.heappop(self._heap)
+            if future.done():
+                continue
+            self._running += 1
+            self._virtual_time = start
+            future.set_result(None)
+        if not self._heap and self._running == 0:
+            # Idle: nobody is owed anything any more
+            self._finish.clear()
+
+    async def run(self, owner: str, weight: float, job: Callable[..., Awaitable], *args, **kwargs):
+        """Waits for the owner's turn, then runs job(*args, **kwargs)."""
+        owner = str(owner)
+        queued = time.perf_counter()
+        with span("queue.wait", owner=owner, queued=len(self._heap), running=self._running):
+            await self._acquire(owner, weight)
+        self._waits.setdefault(owner, deque(maxlen=LIFECYCLE_WAIT_SAMPLES)).append(time.perf_counter() - queued)
+        try:
+            return await job(*args, **kwargs)
+        finally:
+            self._release()
+
+    def stats(self) -> dict:
+        """Jobs running and queued, and the queue wait per owner."""
+        queued: Dict[str, int] = {}
+        for _, _, owner, future in self._heap:
+            if not future.done():
+                queued[owner] = queued.get(owner, 0) + 1
+        return {
+            "worker": os.getpid(),
+            "concurrency": self.concurrency,
+            "running": self._running,
+            "queued": queued,
+            "wait_seconds": {owner: summarize_latency(list(waits)) for owner, waits in self._waits.items()},
+        }
+
+LIFECYCLE_QUEUE = FairQueue(LIFECYCLE_CONCURRENCY)
+#endregion
@@ -0,0 +1,377 @@
+import os
+import re
+import time
+import asyncio
+import zlib
+import subprocess
+from pathlib import Path
+from typing import Dict, Iterable, List, Set, Tuple
+
+import psutil
+from dotenv import load_dotenv
+from fastapi import BackgroundTasks
+
+from gateways import get_gateway, gateway_index
+from coordination import is_leader
+from tracing import traced, annotate
+
+load_dotenv()
+
+#region -------------Paths and Shard Settings--------
+BASE_DIR = Path(__file__).parent
+FRP_DIR = BASE_DIR / "frp_0.59.0_windows_amd64"  # Adjust this path as needed
+FRP_EXECUTABLE_PATH = FRP_DIR / "frpc.exe" # Or "frpc" on Linux/macOS
+
+# The hand-written frpc.toml is now only a template: its server section is
+# copied into every shard config. Proxies live in the per-shard files.
+# Each gateway gets its own set of shards, so a client is (gateway, shard).
+FRP_CONFIG_PATH = FRP_DIR / "frpc.toml"
+FRPC_SHARD_DIR = FRP_DIR / "shards"
+
+# Minimum number of frpc clients per gateway. More shards are added once
+# every shard holds FRPC_VMS_PER_SHARD VMs.
+FRPC_SHARD_COUNT = int(os.environ.get("FRPC_SHARD_COUNT", "1"))
+FRPC_VMS_PER_SHARD = int(os.environ.get("FRPC_VMS_PER_SHARD", "25"))
+# "vm": put each new VM on the emptiest shard.
+# "owner": jump-hash the owner id over the current shard count, so a user's VMs
+# share one shard. When a shard is added, only the owners that move to it change.
+FRPC_SHARD_STRATEGY = os.environ.get("FRPC_SHARD_STRATEGY", "vm")
+FRPC_ADMIN_BASE_PORT = int(os.environ.get("FRPC_ADMIN_BASE_PORT", "7400"))
+# Admin ports reserved per gateway, i.e. the most shards a gateway can have.
+# Shard n of gateway i listens on base + i * stride + n.
+FRPC_ADMIN_PORT_STRIDE = int(os.environ.get("FRPC_ADMIN_PORT_STRIDE", "100"))
+
+# How often the leader worker checks that every shard has a running frpc
+FRPC_WATCHDOG_INTERVAL = float(os.environ.get("FRPC_WATCHDOG_INTERVAL", "5"))
+
+FrpcClient = Tuple[str, int]  # (gateway name, shard)
+# Only the processes this worker started. Which frpc is running is shared
+# between workers through per-shard pid files next to the configs.
+frpc_processes: Dict[FrpcClient, subprocess.Popen] = {}
+#endregion
+
+
+
+#region --- Shard Assignment ---
+def shard_count_for(vm_count: int) -> int:
+    """
+    Number of shards needed to hold vm_count VMs. Never more than
+    FRPC_ADMIN_PORT_STRIDE, or the admin ports would overlap the next gateway's.
+    """
+    return min(FRPC_ADMIN_PORT_STRIDE, max(FRPC_SHARD_COUNT, -(-vm_count // FRPC_VMS_PER_SHARD)))
+
+def _jump_hash(key: int, buckets: int) -> int:
+    """Jump consistent hash (Lamping and Veach): growing buckets by one moves only 1/buckets of the keys."""
+    bucket, j = -1, 0
+    while j < buckets:
+        bucket = j
+        key = (key * 2862933555777941757 + 1) & 0xFFFFFFFFFFFFFFFF
+        j = int((bucket + 1) * ((1 << 31) / ((key >> 33) + 1)))
+    return bucket
+
+def pick_shard(owner_id, shard_loads: Dict[int, int]) -> int:
+    """
+    Chooses the shard for a new VM.
+    shard_loads maps shard index -> number of VMs already on it (for one gateway).
+    """
+    total = sum(shard_loads.values())
+    if total >= FRPC_ADMIN_PORT_STRIDE * FRPC_VMS_PER_SHARD:
+        raise Exception(
+            f"This gateway's frpc shards are full ({FRPC_ADMIN_PORT_STRIDE} shards of {FRPC_VMS_PER_SHARD} VMs); "
+            "raise FRPC_ADMIN_PORT_STRIDE or FRPC_VMS_PER_SHARD, or add a gateway."
+        )
+    count = shard_count_for(total + 1)
+    if FRPC_SHARD_STRATEGY == "owner":
+        # crc32 instead of hash() so the result is stable across restarts
+        return _jump_hash(zlib.crc32(str(owner_id).encode()), count)
+    return min(range(count), key=lambda shard: shard_loads.get(shard, 0))
+
+def shard_config_path(gateway: str, shard: int) -> Path:
+    return FRPC_SHARD_DIR / f"frpc-{gateway}-{shard}.toml"
+
+def shard_admin_port(gateway: str, shard: int) -> int:
+    return FRPC_ADMIN_BASE_PORT + gateway_index(gateway) * FRPC_ADMIN_PORT_STRIDE + shard
+#endregion
+
+
+
+#region --- Config File Management ---
+def render_proxy_toml(name: str, local_ip: str, local_port: int, remote_port: int | None = None,
+                      proxy_type: str = "tcp", subdomain: str | None = None) -> str:
+    """
+    Renders a single [[proxies]] block.
+    tcp/udp proxies own a remotePort; http proxies share the gateway's vhost
+    port and are routed by subdomain instead.
+    """
+    routing = f'subdomain = "{subdomain}"' if proxy_type == "http" else f"remotePort = {remote_port}"
+    return f"""
+[[proxies]]
+name = "{name}"
+type = "{proxy_type}"
+localIP = "{local_ip}"
+localPort = {local_port}
+{routing}
+"""
+
+def rule_proxy_type(rule: dict) -> str:
+    """frp proxy type for a stored inbound rule."""
+    if "subdomain" in rule:
+        return "http"
+    if rule.get("type") == "udp":
+        return "udp"
+    return "tcp"
+
+def has_proxy(rule: dict) -> bool:
+    return "remotePort" in rule or "subdomain" in rule
+
+def render_rule_proxy(vm_name: str, private_ip: str, rule: dict) -> str:
+    return render_proxy_toml(
+        f"{vm_name}-{rule['vm_port']}", private_ip, rule["vm_port"],
+        remote_port=rule.get("remotePort"),
+        proxy_type=rule_proxy_type(rule),
+        subdomain=rule.get("subdomain"),
+    )
+
+def render_vm_proxies(vm_name: str, private_ip: str, inbound_rules: List[dict]) -> List[str]:
+    """Renders the proxy blocks for every tunnelled rule of a VM."""
+    return [
+        render_rule_proxy(vm_name, private_ip, rule)
+        for rule in inbound_rules or []
+        if has_proxy(rule)
+    ]
+
+def _shard_header(gateway_name: str, shard: int) -> str:
+    """
+    Builds the server section of a shard config from the frpc.toml template.
+    The server address/port (and token, if set) come from the gateway, and each
+    shard gets its own admin (webServer) port so it can be reloaded alone.
+    The template is expected to use frp's dotted-key style (webServer.port = ...).
+    """
+    gateway = get_gateway(gateway_name)
+    with open(FRP_CONFIG_PATH, "r") as f:
+        server_config = f.read().split("\n[[proxies]]\n")[0]
+
+    overrides = [
+        f'serverAddr = "{gateway.server_addr or gateway.address}"',
+        f"serverPort = {gateway.server_port}",
+        f'webServer.addr = "127.0.0.1"',
+        f"webServer.port = {shard_admin_port(gateway_name, shard)}",
+    ]
+    if gateway.auth_token:
+        overrides.append(f'auth.token = "{gateway.auth_token}"')
+    overridden_keys = {line.split("=")[0].strip() for line in overrides}
+
+    kept_lines = [
+        line for line in server_config.splitlines()
+        if line.split("=")[0].strip() not in overridden_keys
+        and not line.strip().startswith("webServer.")
+    ]
+    # Root-level keys must come before any [table] header in the template
+    return "\n".join(overrides + kept_lines) + "\n"
+
+def write_shard_config(gateway: str, shard: int, proxy_toml_list: List[str]):
+    """
+    Rewrites a shard config from scratch.
+    This is a blocking function intended to be run in a thread.
+    """
+    FRPC_SHARD_DIR.mkdir(parents=True, exist_ok=True)
+    with open(shard_config_path(gateway, shard), "w") as f:
+        f.write(_shard_header(gateway, shard))
+        for proxy_toml in proxy_toml_list:
+            f.write(proxy_toml)
+
+def sync_shard_configs(vms: Iterable, clients: Iterable[FrpcClient]):
+    """
+    Regenerates every shard config from the VM rows, which are the source of truth.
+    Run at startup so configs always match the DB (and so proxies from an old,
+    unsharded frpc.toml are carried over into the shards).
+    """
+    proxies_by_client: Dict[FrpcClient, List[str]] = {client: [] for client in clients}
+    for vm in vms:
+        proxies_by_client.setdefault((vm.gateway, vm.frp_shard), []).extend(
+            render_vm_proxies(vm.name, vm.private_ip, vm.inbound_rules)
+        )
+    for (gateway, shard), proxies in proxies_by_client.items():
+        write_shard_config(gateway, shard, proxies)
+
+@traced("frpc.config.append")
+def _append_proxies_to_config(gateway: str, shard: int, proxy_toml_list: List[str]):
+    """
+    Appends a list of proxy definitions to a shard config.
+    This is a blocking function intended to be run in a thread.
+    """
+    if not shard_config_path(gateway, shard).exists():
+        write_shard_config(gateway, shard, proxy_toml_list)
+        return
+    with open(shard_config_path(gateway, shard), "a") as f:
+        for proxy_toml in proxy_toml_list:
+            f.write(proxy_toml)
+
+@traced("frpc.config.remove")
+def _remove_proxies_from_config(gateway: str, shard: int, proxy_names_to_delete: Set[str]):
+    """
+    Removes proxy sections from a shard config by name.
+    This is a blocking function intended to be run in a thread.
+    """
+    config_path = shard_config_path(gateway, shard)
+    if not config_path.exists():
+        return
+    with open(config_path, "r") as f:
+        content = f.read()
+
+    parts = content.split("\n[[proxies]]\n")
+    server_config = parts[0]
+    proxy_blocks = parts[1:]
+
+    kept_blocks = []
+    for block in proxy_blocks:
+        if not any(f'name = "{name}"' in block for name in proxy_names_to_delete):
+            kept_blocks.append(block)
+
+    new_content = server_config
+    if kept_blocks:
+        new_content += "\n[[proxies]]\n" + "\n[[proxies]]\n".join(kept_blocks)
+
+    with open(config_path, "w") as f:
+        f.write(new_content)
+
+def read_proxy_names(gateway: str, shard: int) -> Set[str]:
+    """
+    Names of the proxies in a shard config.
+    This is a blocking function intended to be run in a thread.
+    """
+    config_path = shard_config_path(gateway, shard)
+    if not config_path.exists():
+        return set()
+    with open(config_path, "r") as f:
+        proxy_blocks = f.read().split("\n[[proxies]]\n")[1:]
+    names = set()
+    for block in proxy_blocks:
+        match = re.search(r'^name = "([^"]*)"', block, re.MULTILINE)
+        if match:
+            names.add(match.group(1))
+    return names
+#endregion
+
+
+
+#region --- FRPC Process Management Functions ---
+def _pid_file(gateway: str, shard: int) -> Path:
+    return shard_config_path(gateway, shard).with_suffix(".pid")
+
+def frpc_pid(gateway: str, shard: int) -> int | None:
+    """PID of the frpc serving this shard, whichever worker started it."""
+    process = frpc_processes.get((gateway, shard))
+    if process:
+        process.poll()  # Reap it if it exited, so it does not linger as a zombie
+    try:
+        pid = int(_pid_file(gateway, shard).read_text())
+        p = psutil.Process(pid)
+        # Guard against the PID having been reused by an unrelated process
+        if p.status() == psutil.STATUS_ZOMBIE or str(shard_config_path(gateway, shard)) not in p.cmdline():
+            return None
+        return pid
+    except (FileNotFoundError, ValueError, psutil.Error):
+        return None
+
+def is_frpc_running(gateway: str, shard: int) -> bool:
+    return frpc_pid(gateway, shard) is not None
+
+def start_frpc(gateway: str, shard: int):
+    if is_frpc_running(gateway, shard):
+        print(f"frpc {gateway}/{shard} is already running.")
+        return
+    config_path = shard_config_path(gateway, shard)
+    if not config_path.exists():
+        write_shard_config(gateway, shard, [])
+    print(f"Starting frpc {gateway}/{shard} with config: {config_path}")
+    process = subprocess.Popen([str(FRP_EXECUTABLE_PATH), "-c", str(config_path)])
+    frpc_processes[(gateway, shard)] = process
+    _pid_file(gateway, shard).write_text(str(process.pid))
+    print(f"frpc {gateway}/{shard} started successfully with PID: {process.pid}")
+
+def stop_frpc(gateway: str, shard: int):
+    frpc_processes.pop((gateway, shard), None)
+    pid = frpc_pid(gateway, shard)
+    _pid_file(gateway, shard).unlink(missing_ok=True)
+    if pid is None:
+        print(f"frpc {gateway}/{shard} is not running or PID not found.")
+        return
+    print(f"Stopping frpc {gateway}/{shard} with PID: {pid}")
+    try:
+        p = psutil.Process(pid)
+        p.terminate()
+        p.wait(timeout=5)
+    except psutil.NoSuchProcess:
+        pass
+    except psutil.TimeoutExpired:
+        print(f"frpc {gateway}/{shard} did not terminate gracefully, killing it.")
+        p.kill()
+    print(f"frpc {gateway}/{shard} stopped.")
+
+def _configured_clients() -> List[FrpcClient]:
+    """Every (gateway, shard) that has a config file."""
+    clients = []
+    for config_path in FRPC_SHARD_DIR.glob("frpc-*.toml"):
+        gateway, _, shard = config_path.stem[len("frpc-"):].rpartition("-")
+        if shard.isdigit():
+            clients.append((gateway, int(shard)))
+    return clients
+
+def frpc_status() -> Dict[str, bool]:
+    """{"gateway/shard": running} for every configured frpc client."""
+    return {f"{gateway}/{shard}": is_frpc_running(gateway, shard) for gateway, shard in sorted(_configured_clients())}
+
+def stop_all_frpc():
+    for gateway, shard in _configured_clients():
+        stop_frpc(gateway, shard)
+
+def ensure_frpc_clients():
+    """Starts frpc for any shard config without a running client (new shards, crashed clients)."""
+    for gateway, shard in _configured_clients():
+        if not is_frpc_running(gateway, shard):
+            start_frpc(gateway, shard)
+
+async def frpc_watchdog():
+    """Leader-only loop around ensure_frpc_clients."""
+    while True:
+        await asyncio.sleep(FRPC_WATCHDOG_INTERVAL)
+        try:
+            await asyncio.to_thread(ensure_frpc_clients)
+        except Exception as e:
+            print(f"[FRPC WATCHDOG] {e}")
+
+@traced("frpc.reload")
+def execute_frpc_reload(gateway: str, shard: int):
+    """Reloads a single shard. Other shards (and their tunnels) are untouched."""
+    annotate(client=f"{gateway}/{shard}")
+    if not is_frpc_running(gateway, shard):
+        # A brand-new shard has no client yet. Only the leader owns frpc
+        # processes; on other workers the leader's watchdog will start it.
+        if is_leader():
+            start_frpc(gateway, shard)
+        else:
+            print(f"frpc {gateway}/{shard} is not running yet; the leader worker will start it.")
+        return
+
+    print(f"Attempting to hot-reload frpc {gateway}/{shard}...")
+    try:
+        # This command tells the running frpc process to reload its config.
+        # It goes through the shard's admin port, so any worker can run it.
+        reload_command = [str(FRP_EXECUTABLE_PATH), "reload", "-c", str(shard_config_path(gateway, shard))]
+        result = subprocess.run(reload_command, capture_output=True, text=True)
+
+        if result.returncode == 0:
+            print(f"frpc {gateway}/{shard} reloaded successfully.")
+        else:
+            print(f"ERROR: frpc {gateway}/{shard} reload failed. Stderr: {result.stderr.strip()}")
+
+    except Exception as e:
+        print(f"An exception occurred while trying to reload frpc {gateway}/{shard}: {e}")
+
+def reload_frpc_background(background_tasks: BackgroundTasks, gateway: str, shard: int):
+    """Schedules a non-blocking reload of one shard."""
+    # We add a tiny delay to ensure the file write has completed before reload.
+    background_tasks.add_task(time.sleep, 1)
+    background_tasks.add_task(execute_frpc_reload, gateway, shard)
+#endregion
@@ -0,0 +1,145 @@
+"""
+A local stand-in for the frpc admin API and the frps dashboard, for checking
+the tunnel stats collector (tunnel_stats.py) without a real frp.
+
+    python frp_standin.py --check
+    python frp_standin.py --port 7400 --proxies web-22 web-80:http dns-53:udp
+
+--check serves the stand-in on a free port, collects stats from it twice,
+checks what collect_tunnel_stats and render_metrics made of them and prints
+the metrics. Without it, the stand-in serves until interrupted, answering
+GET /api/status like frpc and GET /api/proxy/<type> like frps (basic auth
+admin/admin). Every dashboard read adds traffic to each proxy.
+"""
+import os
+import json
+import base64
+import argparse
+import tempfile
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import List
+
+DASHBOARD_USER = "admin"
+DASHBOARD_PASSWORD = "admin"
+# frps prefixes proxy names with the frpc `user`
+FRPS_USER_PREFIX = "nimbus."
+
+
+def parse_proxies(specs: List[str]) -> List[dict]:
+    """"<vm>-<port>[:<type>]" -> proxy dicts, tcp by default."""
+    proxies = []
+    for spec in specs:
+        name, _, proxy_type = spec.partition(":")
+        proxies.append({"name": name, "type": proxy_type or "tcp", "connections": 1, "bytes_in": 0, "bytes_out": 0})
+    return proxies
+
+def make_handler(proxies: List[dict]):
+    lock = threading.Lock()
+    credentials = "Basic " + base64.b64encode(f"{DASHBOARD_USER}:{DASHBOARD_PASSWORD}".encode()).decode()
+
+    class Handler(BaseHTTPRequestHandler):
+        def log_message(self, *args):
+            pass
+
+        def _send(self, status: int, body: dict):
+            payload = json.dumps(body).encode()
+            self.send_response(status)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(payload)))
+            self.end_headers()
+            self.wfile.write(payload)
+
+        def do_GET(self):
+            if self.path == "/api/status":
+                # frpc: {type: [{name, type, status, err, ...}]}
+                status = {}
+                for proxy in proxies:
+                    status.setdefault(proxy["type"], []).append({"name": proxy["name"], "type": proxy["type"], "status": "running", "err": ""})
+                return self._send(200, status)
+            if self.path.startswith("/api/proxy/"):
+                if self.headers.get("Authorization") != credentials:
+                    return self._send(401, {"error": "unauthorized"})
+                proxy_type = self.path[len("/api/proxy/"):]
+                with lock:
+                    answer = []
+                    for proxy in proxies:
+                        if proxy["type"] != proxy_type:
+                            continue
+                        proxy["bytes_in"] += 1024
+                        proxy["bytes_out"] += 4096
+                        answer.append({
+                            "name": FRPS_USER_PREFIX + proxy["name"],
+                            "curConns": proxy["connections"],
+                            "todayTrafficIn": proxy["bytes_in"],
+                            "todayTrafficOut": proxy["bytes_out"],
+                        })
+                return self._send(200, {"proxies": answer})
+            self._send(404, {"error": "not found"})
+
+    return Handler
+
+def serve(port: int, proxies: List[dict]) -> ThreadingHTTPServer:
+    """Starts the stand-in in a daemon thread. Port 0 picks a free one."""
+    server = ThreadingHTTPServer(("127.0.0.1", port), make_handler(proxies))
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+def check(proxies: List[dict]):
+    # Keep the check's stats file away from the real one
+    os.environ["TUNNEL_STATS_PATH"] = os.path.join(tempfile.mkdtemp(), "tunnel_stats.json")
+    from gateways import Gateway
+    from tunnel_stats import collect_tunnel_stats, rule_stats, render_metrics
+
+    server = serve(0, proxies)
+    url = f"http://127.0.0.1:{server.server_address[1]}"
+    gateway = Gateway(name="standin", address="127.0.0.1", dashboard_url=url, dashboard_user=DASHBOARD_USER, dashboard_password=DASHBOARD_PASSWORD)
+    collect = lambda: collect_tunnel_stats(clients=[("standin", 0)], gateways=[gateway], admin_url=lambda gateway, shard: url)
+    try:
+        collect()
+        stats = collect()
+    finally:
+        server.shutdown()
+
+    problems = list(stats["errors"])
+    for proxy in proxies:
+        vm_name, _, port = proxy["name"].rpartition("-")
+        collected = rule_stats(stats, vm_name, {"vm_port": int(port)})
+        if collected is None:
+            problems.append(f"{proxy['name']}: not collected")
+            continue
+        expected = {"status": "running", "connections": proxy["connections"], "bytes_in": proxy["bytes_in"], "bytes_out": proxy["bytes_out"]}
+        for field, value in expected.items():
+            if collected[field] != value:
+                problems.append(f"{proxy['name']}: {field} is {collected[field]!r}, expected {value!r}")
+        if collected["last_active_at"] is None:
+            problems.append(f"{proxy['name']}: no last_active_at")
+
+    metrics = render_metrics(stats)
+    for proxy in proxies:
+        if f'nimbus_tunnel_up{{proxy="{proxy["name"]}"' not in metrics:
+            problems.append(f"{proxy['name']}: missing from the metrics")
+    print(metrics)
+    if problems:
+        raise SystemExit("FAILED\n" + "\n".join(problems))
+    print(f"OK: {len(proxies)} proxies collected and rendered")
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--check", action="store_true", help="Check the collector against the stand-in and exit")
+    parser.add_argument("--port", type=int, default=7400)
+    parser.add_argument("--proxies", nargs="+", default=["demo-22", "demo-80:http", "demo-53:udp"], help="<vm>-<port>[:<type>]")
+    args = parser.parse_args()
+
+    proxies = parse_proxies(args.proxies)
+    if args.check:
+        return check(proxies)
+    server = serve(args.port, proxies)
+    print(f"Serving the frpc admin API and frps dashboard for {len(proxies)} proxies on http://127.0.0.1:{args.port}")
+    try:
+        threading.Event().wait()
+    except KeyboardInterrupt:
+        server.shutdown()
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,124 @@
+import os
+import json
+from functools import lru_cache
+from pathlib import Path
+from typing import Dict, List, Optional
+
+from dotenv import load_dotenv
+from pydantic import BaseModel
+
+load_dotenv()
+
+#region -------------Gateway Registry--------
+BASE_DIR = Path(__file__).parent
+GATEWAYS_CONFIG_PATH = Path(os.environ.get("GATEWAYS_CONFIG_PATH", BASE_DIR / "gateways.json"))
+
+class Gateway(BaseModel):
+    """One frps instance that VM tunnels can be placed on."""
+    name: str
+    address: str                          # Public address users connect to
+    server_addr: Optional[str] = None     # Address frpc dials, defaults to `address`
+    server_port: int = 7000               # frps bindPort
+    auth_token: Optional[str] = None
+    port_start: int = 2222                # Remote port range (inclusive)
+    port_end: int = 2999
+    capacity: Optional[int] = None        # Max tunnels, defaults to the size of the port range
+    security_group_id: Optional[str] = None  # None for gateways without an AWS security group (e.g. local frps)
+    region: str = "ap-south-1"
+    # frps subDomainHost / vhostHTTPPort. Without a subdomain_host, http rules
+    # fall back to plain tcp tunnels.
+    subdomain_host: Optional[str] = None
+    vhost_http_port: int = 80
+    # frps dashboard (webServer), e.g. "http://13.233.204.203:7500". Where set,
+    # tunnel stats include its per-proxy connection and traffic counters.
+    dashboard_url: Optional[str] = None
+    dashboard_user: Optional[str] = None
+    dashboard_password: Optional[str] = None
+
+    @property
+    def max_tunnels(self) -> int:
+        return self.capacity or (self.port_end - self.port_start + 1)
+
+def _default_gateways() -> List[Gateway]:
+    """The single EC2 gateway used before the registry existed."""
+    return [Gateway(
+        name="default",
+        address=os.environ.get("GATEWAY_PUBLIC_IP", "13.233.204.203"),
+        security_group_id=os.environ.get("SECURITY_GROUP_ID"),
+        subdomain_host=os.environ.get("GATEWAY_SUBDOMAIN_HOST"),
+        vhost_http_port=int(os.environ.get("GATEWAY_VHOST_HTTP_PORT", "80")),
+        dashboard_url=os.environ.get("GATEWAY_DASHBOARD_URL"),
+        dashboard_user=os.environ.get("GATEWAY_DASHBOARD_USER"),
+        dashboard_password=os.environ.get("GATEWAY_DASHBOARD_PASSWORD"),
+    )]
+
+def load_gateways() -> List[Gateway]:
+    """
+    Reads gateways.json, a list of Gateway objects. Falls back to the single
+    default gateway when the file does not exist.
+    """
+    if not GATEWAYS_CONFIG_PATH.exists():
+        return _default_gateways()
+    with open(GATEWAYS_CONFIG_PATH, "r") as f:
+        gateways = [Gateway(**entry) for entry in json.load(f)]
+    if not gateways:
+        raise ValueError(f"{GATEWAYS_CONFIG_PATH} does not define any gateways.")
+    return gateways
+
+GATEWAYS: List[Gateway] = load_gateways()
+_GATEWAYS_BY_NAME: Dict[str, Gateway] = {gateway.name: gateway for gateway in GATEWAYS}
+
+def get_gateway(name: str) -> Gateway:
+    try:
+        return _GATEWAYS_BY_NAME[name]
+    except KeyError:
+        raise Exception(f"Gateway '{name}' is not in the gateway registry.")
+
+def gateway_index(name: str) -> int:
+    """Stable position of a gateway in the registry, used to lay out admin ports."""
+    return GATEWAYS.index(get_gateway(name))
+#endregion
+
+
+
+#region --- Placement ---
+def tunnels_needed(gateway: Gateway, rule_types: List[str]) -> int:
+    """
+    Remote ports a VM's rules (by type) take on the gateway. http rules take none
+    where the gateway routes them by subdomain, and one each where it does not.
+    """
+    return sum(1 for rule_type in rule_types if rule_type != "http" or not gateway.subdomain_host)
+
+def pick_gateway(tunnel_loads: Dict[str, int], rule_types: List[str]) -> Gateway:
+    """
+    Picks the least-loaded gateway (by fraction of capacity in use) that still
+    has room for the remote ports the rules need there.
+    tunnel_loads maps gateway name -> number of remote ports already in use.
+    """
+    candidates = [
+        gateway for gateway in GATEWAYS
+        if tunnel_loads.get(gateway.name, 0) + tunnels_needed(gateway, rule_types) <= gateway.max_tunnels
+    ]
+    if not candidates:
+        raise Exception("No tunnel gateway has capacity for this VM.")
+    return min(candidates, key=lambda gateway: tunnel_loads.get(gateway.name, 0) / gateway.max_tunnels)
+
+def public_endpoint(gateway: Gateway, rule: dict) -> Optional[str]:
+    """The address users connect to for a tunnelled rule."""
+    if "subdomain" in rule:
+        port_suffix = "" if gateway.vhost_http_port == 80 else f":{gateway.vhost_http_port}"
+        return f"http://{rule['subdomain']}.{gateway.subdomain_host}{port_suffix}"
+    if "remotePort" not in rule:
+        return None
+    return f"{gateway.address}:{rule['remotePort']}"
+#endregion
+
+
+
+#region --- AWS ---
+@lru_cache(maxsize=None)
+def get_ec2_client(region: str):
+    """One EC2 client per region, shared by every gateway in it. Created on first use."""
+    import boto3
+    return boto3.client("ec2", region_name=region)
+#endregion
@@ -0,0 +1,218 @@
+import os
+import json
+import asyncio
+import hashlib
+from datetime import datetime, timedelta
+from typing import List, Optional, Tuple
+
+from dotenv import load_dotenv
+from sqlalchemy import select, delete
+from sqlalchemy.exc import IntegrityError
+
+from asgi import get_header
+from auth import user_id_from_token
+from database import async_session_factory
+from models import IdempotencyRecord
+
+load_dotenv()
+
+#region -------------Settings--------
+IDEMPOTENCY_ENABLED = os.environ.get("IDEMPOTENCY_ENABLED", "true").lower() == "true"
+# How long a key (and the response stored for it) is kept
+IDEMPOTENCY_TTL_HOURS = float(os.environ.get("IDEMPOTENCY_TTL_HOURS", "24"))
+# A key still in progress after this long belongs to a worker that died; the next retry takes it over
+IDEMPOTENCY_IN_PROGRESS_TIMEOUT = float(os.environ.get("IDEMPOTENCY_IN_PROGRESS_TIMEOUT", "600"))
+# Larger responses are not stored (the key is released instead)
+IDEMPOTENCY_MAX_BODY_BYTES = int(os.environ.get("IDEMPOTENCY_MAX_BODY_BYTES", str(1024 * 1024)))
+# Seconds between sweeps of expired keys on the leader worker
+IDEMPOTENCY_GC_INTERVAL = float(os.environ.get("IDEMPOTENCY_GC_INTERVAL", "3600"))
+IDEMPOTENCY_HEADER = b"idempotency-key"
+IDEMPOTENCY_METHODS = ("POST", "PUT", "PATCH", "DELETE")
+# Login and registration answers carry credentials, which are never stored
+IDEMPOTENCY_EXCLUDED_PREFIXES = ("/auth/",)
+# Answers that say "not now" rather than "done": the key is released so a retry runs again
+RETRYABLE_STATUSES = {401, 408, 409, 423, 425, 429}
+#endregion
+
+
+
+#region --- Key Store ---
+async def claim_key(owner: str, key: str, fingerprint: str, method: str, path: str) -> Optional[IdempotencyRecord]:
+    """
+    Records the key as in progress, or returns the existing record if someone
+    already holds it. The unique (owner, key) constraint decides between
+    concurrent requests, in this worker or another. Expired and abandoned
+    records are replaced.
+    """
+    async with async_session_factory() as db:
+        for _ in range(3):
+            now = datetime.utcnow()
+            db.add(IdempotencyRecord(
+                owner=owner, key=key, method=method, path=path, fingerprint=fingerprint,
+                state="in_progress", created_at=now, expires_at=now + timedelta(hours=IDEMPOTENCY_TTL_HOURS),
+            ))
+            try:
+                await db.commit()
+                return None
+            except IntegrityError:
+                await db.rollback()
+            result = await db.execute(select(IdempotencyRecord).where(IdempotencyRecord.owner == owner, IdempotencyRecord.key == key))
+            existing = result.scalars().first()
+            if existing is None:
+                continue  # Swept or released in the meantime
+            abandoned = existing.state == "in_progress" and existing.created_at < now - timedelta(seconds=IDEMPOTENCY_IN_PROGRESS_TIMEOUT)
+            if existing.expires_at > now and not abandoned:
+                return existing
+            await db.delete(existing)
+            await db.commit()
+    raise Exception(f"Could not claim idempotency key '{key}'")
+
+async def complete_key(owner: str, key: str, status: int, headers: List[Tuple[bytes, bytes]], body: bytes):
+    """Stores the response for replay, or releases the key if a retry should run the request again."""
+    async with async_session_factory() as db:
+        result = await db.execute(select(IdempotencyRecord).where(IdempotencyRecord.owner == owner, IdempotencyRecord.key == key))
+        record = result.scalars().first()
+        if record is None:
+            return
+        if status >= 500 or status in RETRYABLE_STATUSES or len(body) > IDEMPOTENCY_MAX_BODY_BYTES:
+            await db.delete(record)
+        else:
+            record.state = "completed"
+            record.status_code = status
+            record.response_headers = [[name.decode("latin-1"), value.decode("latin-1")] for name, value in headers]
+            record.response_body = body
+        await db.commit()
+
+async def release_key(owner: str, key: str):
+    async with async_session_factory() as db:
+        await db.execute(delete(IdempotencyRecord).where(
+            IdempotencyRecord.owner == owner, IdempotencyRecord.key == key, IdempotencyRecord.state == "in_progress"
+        ))
+        await db.commit()
+
+async def purge_expired_keys() -> int:
+    """Deletes expired keys and their stored responses. Returns how many."""
+    async with async_session_factory() as db:
+        result = await db.execute(delete(IdempotencyRecord).where(IdempotencyRecord.expires_at < datetime.utcnow()))
+        await db.commit()
+        return result.rowcount
+
+async def idempotency_gc_loop():
+    """Leader-only loop around purge_expired_keys."""
+    while True:
+        try:
+            purged = await purge_expired_keys()
+            if purged:
+                print(f"[IDEMPOTENCY] Purged {purged} expired keys")
+        except Exception as e:
+            print(f"[IDEMPOTENCY] Purge failed: {e}")
+        await asyncio.sleep(IDEMPOTENCY_GC_INTERVAL)
+#endregion
+
+
+
+#region --- Middleware ---
+async def _send_json(send, status: int, body: dict, headers: List[Tuple[bytes, bytes]] = ()):
+    payload = json.dumps(body).encode()
+    await send({
+        "type": "http.response.start",
+        "status": status,
+        "headers": [(b"content-type", b"application/json"), (b"content-length", str(len(payload)).encode()), *headers],
+    })
+    await send({"type": "http.response.body", "body": payload})
+
+class IdempotencyMiddleware:
+    """
+    Makes POST/PUT/PATCH/DELETE requests that carry an Idempotency-Key header
+    safe to retry. The first request with a key runs as usual and its response
+    is stored before it is sent. A retry with the same key gets that response
+    back (with "Idempotent-Replayed: true") without running the endpoint again,
+    or 409 while the first one is still being answered. Reusing a key for a
+    different request is a 422. Keys are per user and expire after
+    IDEMPOTENCY_TTL_HOURS.
+    """
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        key = get_header(scope, IDEMPOTENCY_HEADER) if scope["type"] == "http" and IDEMPOTENCY_ENABLED else None
+        if key is None or scope["method"] not in IDEMPOTENCY_METHODS or scope["path"].startswith(IDEMPOTENCY_EXCLUDED_PREFIXES):
+            return await self.app(scope, receive, send)
+        if not 0 < len(key) <= 255:
+            return await _send_json(send, 400, {"detail": "Idempotency-Key must be 1 to 255 characters."})
+
+        # Read the whole body to fingerprint it, then hand it to the app unchanged
+        chunks = []
+        while True:
+            message = await receive()
+            if message["type"] != "http.request":
+                return
+            chunks.append(message.get("body", b""))
+            if not message.get("more_body", False):
+                break
+        body = b"".join(chunks)
+        body_sent = False
+
+        async def replay_receive():
+            nonlocal body_sent
+            if not body_sent:
+                body_sent = True
+                return {"type": "http.request", "body": body, "more_body": False}
+            return await receive()
+
+        user_id = user_id_from_token(get_header(scope, b"authorization"))
+        owner = f"user:{user_id}" if user_id else f"ip:{(scope.get('client') or ('unknown',))[0]}"
+        method, path = scope["method"], scope["path"]
+        fingerprint = hashlib.sha256(b"\n".join([method.encode(), path.encode(), scope.get("query_string", b""), body])).hexdigest()
+
+        try:
+            existing = await claim_key(owner, key, fingerprint, method, path)
+        except Exception as e:
+            # Never let the key store take the endpoint down with it
+            print(f"[IDEMPOTENCY] Key store unavailable, running {method} {path} without it: {e}")
+            return await self.app(scope, replay_receive, send)
+
+        if existing is not None:
+            if existing.fingerprint != fingerprint:
+                return await _send_json(send, 422, {"detail": f"Idempotency-Key '{key}' was already used for a different request ({existing.method} {existing.path})."})
+            if existing.state == "completed":
+                await send({
+                    "type": "http.response.start",
+                    "status": existing.status_code,
+                    "headers": [(name.encode("latin-1"), value.encode("latin-1")) for name, value in existing.response_headers] + [(b"idempotent-replayed", b"true")],
+                })
+                await send({"type": "http.response.body", "body": existing.response_body or b""})
+                return
+            return await _send_json(
+                send, 409,
+                {"detail": f"A request with Idempotency-Key '{key}' is still in progress.", "state": existing.state, "started_at": existing.created_at.isoformat()},
+                [(b"retry-after", b"1")],
+            )
+
+        response = {"status": None, "headers": [], "body": [], "finished": False}
+
+        async def send_wrapper(message):
+            if message["type"] == "http.response.start":
+                response["status"] = message["status"]
+                response["headers"] = message.get("headers", [])
+            elif message["type"] == "http.response.body":
+                response["body"].append(message.get("body", b""))
+                if not message.get("more_body", False):
+                    # Stored before the client sees it, so a retry can never run it twice
+                    response["finished"] = True
+                    try:
+                        await complete_key(owner, key, response["status"], response["headers"], b"".join(response["body"]))
+                    except Exception as e:
+                        print(f"[IDEMPOTENCY] Could not store the response for '{key}': {e}")
+            await send(message)
+
+        try:
+            await self.app(scope, replay_receive, send_wrapper)
+        finally:
+            if not response["finished"]:
+                # The endpoint failed before answering; let a retry run it again
+                try:
+                    await release_key(owner, key)
+                except Exception as e:
+                    print(f"[IDEMPOTENCY] Could not release '{key}': {e}")
+#endregion
@@ -0,0 +1,121 @@
+import os
+import time
+import asyncio
+from datetime import datetime, timezone
+from pathlib import Path
+from typing import Awaitable, Callable, Dict, List, Optional
+
+from dotenv import load_dotenv
+
+from database import async_session_factory
+from crud import get_idle_candidates
+from telemetry import TELEMETRY_ENABLED, read_series
+
+load_dotenv()
+
+#region -------------Settings--------
+IDLE_POLICY_ENABLED = os.environ.get("IDLE_POLICY_ENABLED", "false").lower() == "true"
+# "suspend" saves the VM's memory to disk (fast resume); "stop" shuts it down
+IDLE_ACTION = os.environ.get("IDLE_ACTION", "suspend")
+# A VM must be idle for this long before it is suspended or stopped
+IDLE_THRESHOLD_MINUTES = int(os.environ.get("IDLE_THRESHOLD_MINUTES", "120"))
+# Below these (per-minute averages), a minute counts as idle
+IDLE_CPU_PERCENT = float(os.environ.get("IDLE_CPU_PERCENT", "5"))
+IDLE_NET_KBPS = float(os.environ.get("IDLE_NET_KBPS", "2"))
+IDLE_CHECK_INTERVAL = float(os.environ.get("IDLE_CHECK_INTERVAL", "60"))
+# Share of the threshold window that must have samples. Less means the VM was
+# not watched long enough (e.g. it just booted, or telemetry was down).
+IDLE_MIN_COVERAGE = float(os.environ.get("IDLE_MIN_COVERAGE", "0.9"))
+
+if IDLE_ACTION not in ("suspend", "stop"):
+    raise ValueError(f"IDLE_ACTION must be 'suspend' or 'stop', not '{IDLE_ACTION}'")
+#endregion
+
+
+
+#region --- Tunnel Activity Providers ---
+# A provider takes the candidate VMs and returns {vm name: open tunnel connections}.
+# VMs it knows nothing about are left out. Any connection keeps a VM awake.
+ActivityProvider = Callable[[list], Awaitable[Dict[str, int]]]
+_activity_providers: List[ActivityProvider] = []
+
+def register_activity_provider(provider: ActivityProvider):
+    _activity_providers.append(provider)
+
+async def tunnel_connections(vms: list) -> Dict[str, int]:
+    """Connections per VM, summed over every provider that reported it."""
+    connections: Dict[str, int] = {}
+    results = await asyncio.gather(*(provider(vms) for provider in _activity_providers), return_exceptions=True)
+    for result in results:
+        if isinstance(result, Exception):
+            print(f"[IDLE] Tunnel activity provider failed: {result}")
+            continue
+        for name, count in result.items():
+            connections[name] = connections.get(name, 0) + count
+    return connections
+#endregion
+
+
+
+#region --- Policy ---
+def _peak(points: List[dict], *fields: str) -> Optional[float]:
+    """Highest per-minute value of the summed fields, or None if never measured."""
+    values = [sum(point[f] or 0 for f in fields) for point in points if any(point[f] is not None for f in fields)]
+    return max(values) if values else None
+
+def idle_reason(vms_dir: Path, vm_name: str, active_since: Optional[datetime], connections: Optional[int], now: float) -> Optional[str]:
+    """
+    Why the VM counts as idle, or None if it is busy or there is not enough data.
+    Looks at the per-minute averages over the last IDLE_THRESHOLD_MINUTES, so a
+    VM that was started (or resumed) more recently than that is never idle.
+    This is a blocking function intended to be run in a thread.
+    """
+    window_start = now - IDLE_THRESHOLD_MINUTES * 60
+    if active_since is not None and active_since.replace(tzinfo=timezone.utc).timestamp() > window_start:
+        return None
+    points = read_series(vms_dir, vm_name, "1m", since=window_start)
+    if len(points) < IDLE_THRESHOLD_MINUTES * IDLE_MIN_COVERAGE:
+        return None
+    cpu = _peak(points, "cpu_percent")
+    net = _peak(points, "net_rx_kbps", "net_tx_kbps")
+    if cpu is None or cpu >= IDLE_CPU_PERCENT:
+        return None
+    if net is not None and net >= IDLE_NET_KBPS:
+        return None
+    if connections:
+        return None
+    net_text = f"{net:.1f} kB/s" if net is not None else "not measured"
+    tunnels_text = "no open tunnel connections" if connections == 0 else "tunnel activity unknown"
+    return (
+        f"Idle for {IDLE_THRESHOLD_MINUTES} min: peak CPU {cpu:.1f}% (< {IDLE_CPU_PERCENT:g}%), "
+        f"peak network {net_text} (< {IDLE_NET_KBPS:g} kB/s), {tunnels_text}"
+    )
+
+async def idle_policy_loop(vms_dir: Path, on_idle: Callable[[int, str], Awaitable[None]]):
+    """
+    Leader loop: every IDLE_CHECK_INTERVAL seconds, finds Active VMs that have
+    been idle past the threshold and hands them to on_idle(vm_id, reason),
+    which suspends or stops them according to IDLE_ACTION.
+    """
+    if not TELEMETRY_ENABLED:
+        print("[IDLE] The idle policy needs TELEMETRY_ENABLED=true; not running.")
+        return
+    while True:
+        await asyncio.sleep(IDLE_CHECK_INTERVAL)
+        try:
+            async with async_session_factory() as db:
+                vms = await get_idle_candidates(db)
+            if not vms:
+                continue
+            connections = await tunnel_connections(vms)
+            now = time.time()
+            reasons = await asyncio.gather(
+                *(asyncio.to_thread(idle_reason, vms_dir, vm.name, vm.active_since, connections.get(vm.name), now) for vm in vms)
+            )
+            idle = [(vm, reason) for vm, reason in zip(vms, reasons) if reason]
+            for vm, reason in idle:
+                print(f"[IDLE] Reclaiming '{vm.name}' ({IDLE_ACTION}): {reason}")
+            await asyncio.gather(*(on_idle(vm.id, reason) for vm, reason in idle), return_exceptions=True)
+        except Exception as e:
+            print(f"[IDLE] Idle check failed: {e}")
+#endregion
@@ -1,8 +1,9 @@
 from fastapi_users.db import SQLAlchemyBaseUserTableUUID
 from sqlalchemy.orm import DeclarativeBase, Mapped, mapped_column
-from sqlalchemy import String, Integer, JSON, ForeignKey, Text, UniqueConstraint
+from sqlalchemy import String, Integer, Float, JSON, ForeignKey, Text, UniqueConstraint, Boolean, DateTime, LargeBinary
 from sqlalchemy import Enum
 import enum
+from datetime import datetime
 
 # This is the base class for all your database tables
 class Base(DeclarativeBase):
@@ -10,7 +11,15 @@ class Base(DeclarativeBase):
 
 # This table comes from fastapi-users and handles all user/password logic
 class User(SQLAlchemyBaseUserTableUUID, Base):
-    pass
+    # Exempts all of the user's VMs from the idle policy
+    idle_opt_out: Mapped[bool] = mapped_column(Boolean, default=False, server_default="0")
+    # Per-user quota overrides; NULL means the QUOTA_* default (quotas.py)
+    quota_vms: Mapped[int | None] = mapped_column(Integer, nullable=True)
+    quota_vcpu: Mapped[int | None] = mapped_column(Integer, nullable=True)
+    quota_ram_mb: Mapped[int | None] = mapped_column(Integer, nullable=True)
+    quota_ports: Mapped[int | None] = mapped_column(Integer, nullable=True)
+    # Share of the lifecycle job queue relative to other users (fair_queue.py)
+    fair_share_weight: Mapped[float] = mapped_column(Float, default=1.0, server_default="1")
 
 # This is your new VM table
 class VMStatus(str, enum.Enum):
@@ -19,8 +28,16 @@ class VMStatus(str, enum.Enum):
     active = "Active"
     stopping = "Stopping"
     stopped = "Stopped"
+    suspending = "Suspending"
+    suspended = "Suspended"
+    resuming = "Resuming"
+    restoring = "Restoring"
     deleting = "Deleting"
     error = "Error"
+
+    def __str__(self):
+        # So f-strings show "Active" rather than "VMStatus.active"
+        return self.value
     
 class VM(Base):
     __tablename__ = "vms"
@@ -42,9 +59,95 @@ class VM(Base):
         Enum(VMStatus), default=VMStatus.provisioning, nullable=False
     )
     
+    # Which hypervisor node runs the VM
+    node: Mapped[str] = mapped_column(String(100), default="local", server_default="local")
+    
+    # Which tunnel gateway (frps) and which of its frpc clients hold this VM's proxies
+    gateway: Mapped[str] = mapped_column(String(100), default="default", server_default="default")
+    frp_shard: Mapped[int] = mapped_column(Integer, default=0, server_default="0")
+    
+    # When the VM last became Active; the idle policy only looks at activity since then
+    active_since: Mapped[datetime | None] = mapped_column(DateTime, nullable=True)
+    # Set when the idle policy suspended or stopped the VM; cleared when it is started again
+    idle_reason: Mapped[str | None] = mapped_column(Text, nullable=True)
+    idle_action_at: Mapped[datetime | None] = mapped_column(DateTime, nullable=True)
+    
+    # Trace of the VM's last create, start or resume (see tracing.py)
+    trace_id: Mapped[str | None] = mapped_column(String(32), nullable=True)
+    
+    # The user's custom provisioning script, run once the VM is reachable.
+    # script_status is NULL without a script, else "Pending", "Running",
+    # "Succeeded" or "Failed"; script_output keeps the tail of its output.
+    provisioning_script: Mapped[str | None] = mapped_column(Text, nullable=True)
+    script_status: Mapped[str | None] = mapped_column(String(20), nullable=True)
+    script_exit_code: Mapped[int | None] = mapped_column(Integer, nullable=True)
+    script_started_at: Mapped[datetime | None] = mapped_column(DateTime, nullable=True)
+    script_seconds: Mapped[float | None] = mapped_column(Float, nullable=True)
+    script_output: Mapped[str | None] = mapped_column(Text, nullable=True)
+    script_updated_at: Mapped[datetime | None] = mapped_column(DateTime, nullable=True)  # Saved with the output while it runs
+    
     # This is the critical link back to the user who owns the VM
     owner_id: Mapped[str] = mapped_column(ForeignKey("user.id"))
     
+# One row per boot, so cold boots and resumes can be compared
+class BootTiming(Base):
+    __tablename__ = "boot_timings"
+
+    id: Mapped[int] = mapped_column(primary_key=True)
+    # Not a foreign key: timings outlive the VM
+    vm_name: Mapped[str] = mapped_column(String(100), index=True)
+    owner_id: Mapped[str] = mapped_column(String(36), index=True)
+    node: Mapped[str] = mapped_column(String(100))
+    # "provision" (first boot), "cold_boot" (from Stopped) or "resume" (from Suspended)
+    kind: Mapped[str] = mapped_column(String(20))
+    seconds: Mapped[float]
+    # From the start of `vagrant up` until sshd (and its tunnel) answered; NULL without readiness probing
+    reachable_seconds: Mapped[float | None] = mapped_column(Float, nullable=True)
+    created_at: Mapped[datetime] = mapped_column(DateTime, default=datetime.utcnow)
+
+class Snapshot(Base):
+    __tablename__ = "snapshots"
+
+    id: Mapped[int] = mapped_column(primary_key=True)
+    vm_id: Mapped[int] = mapped_column(ForeignKey("vms.id"), index=True)
+    owner_id: Mapped[str] = mapped_column(ForeignKey("user.id"), index=True)
+    name: Mapped[str] = mapped_column(String(100))
+    description: Mapped[str | None] = mapped_column(Text, nullable=True)
+    # "Creating", "Ready", "Deleting" or "Error"
+    status: Mapped[str] = mapped_column(String(20), default="Creating")
+    # Growth of the VM's snapshot folder when this snapshot was taken
+    size_bytes: Mapped[int] = mapped_column(Integer, default=0)
+    created_at: Mapped[datetime] = mapped_column(DateTime, default=datetime.utcnow)
+
+    __table_args__ = (
+        UniqueConstraint("vm_id", "name", name="uq_vm_snapshot_name"),
+    )
+
+# A request sent with an Idempotency-Key header and, once it was answered, its
+# response, so retries get the same answer (see idempotency.py)
+class IdempotencyRecord(Base):
+    __tablename__ = "idempotency_keys"
+
+    id: Mapped[int] = mapped_column(primary_key=True)
+    # "user:<id>" or "ip:<address>"; keys of different callers never collide
+    owner: Mapped[str] = mapped_column(String(100))
+    key: Mapped[str] = mapped_column(String(255))
+    method: Mapped[str] = mapped_column(String(10))
+    path: Mapped[str] = mapped_column(Text)
+    # sha256 of the method, path, query string and body
+    fingerprint: Mapped[str] = mapped_column(String(64))
+    # "in_progress" until the response is ready, then "completed"
+    state: Mapped[str] = mapped_column(String(20), default="in_progress")
+    status_code: Mapped[int | None] = mapped_column(Integer, nullable=True)
+    response_headers: Mapped[list | None] = mapped_column(JSON, nullable=True)
+    response_body: Mapped[bytes | None] = mapped_column(LargeBinary, nullable=True)
+    created_at: Mapped[datetime] = mapped_column(DateTime, default=datetime.utcnow)
+    expires_at: Mapped[datetime] = mapped_column(DateTime, index=True)
+
+    __table_args__ = (
+        UniqueConstraint("owner", "key", name="uq_idempotency_owner_key"),
+    )
+
 class SSHKey(Base):
     __tablename__ = "ssh_keys"
 
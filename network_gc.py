@@ -0,0 +1,244 @@
+import os
+import time
+import asyncio
+from datetime import datetime, timezone
+from pathlib import Path
+from typing import Dict, List, Set, Tuple
+
+from dotenv import load_dotenv
+
+from database import async_session_factory
+from crud import get_all_vms, get_snapshots_for_vm
+from frp import (
+    _configured_clients,
+    _append_proxies_to_config,
+    _remove_proxies_from_config,
+    read_proxy_names,
+    render_rule_proxy,
+    rule_proxy_type,
+    has_proxy,
+    execute_frpc_reload,
+)
+from gateways import GATEWAYS, get_ec2_client
+from coordination import RESOURCE_LOCK
+
+load_dotenv()
+
+#region -------------Settings--------
+# Seconds between collections on the leader worker; 0 turns the loop off
+NETWORK_GC_INTERVAL = float(os.environ.get("NETWORK_GC_INTERVAL", "3600"))
+# Only report what would be reclaimed, without changing anything
+NETWORK_GC_DRY_RUN = os.environ.get("NETWORK_GC_DRY_RUN", "false").lower() == "true"
+# Also put back proxies and security-group rules that a VM row has but that
+# are missing from frpc or AWS
+NETWORK_GC_REPAIR = os.environ.get("NETWORK_GC_REPAIR", "true").lower() == "true"
+OPEN_CIDR = "0.0.0.0/0"
+#endregion
+
+
+
+#region --- Sources of Truth ---
+SecurityGroup = Tuple[str, str]  # (region, security group id)
+SGRule = Tuple[str, int]         # (protocol, port)
+
+def _security_groups() -> Dict[SecurityGroup, List[Tuple[int, int]]]:
+    """Every gateway security group, with the port ranges it holds tunnels for."""
+    groups: Dict[SecurityGroup, List[Tuple[int, int]]] = {}
+    for gateway in GATEWAYS:
+        if gateway.security_group_id:
+            groups.setdefault((gateway.region, gateway.security_group_id), []).append((gateway.port_start, gateway.port_end))
+    return groups
+
+def describe_tunnel_rules(group: SecurityGroup, port_ranges: List[Tuple[int, int]]) -> Set[SGRule]:
+    """
+    The single-port, open-to-the-world tcp/udp rules of a security group that fall
+    in a gateway port range, i.e. the ones tunnels own. Anything else in the group
+    (SSH to the gateway, frps' bind port, ...) is never touched.
+    One DescribeSecurityGroups call.
+    This is a blocking function intended to be run in a thread.
+    """
+    region, group_id = group
+    response = get_ec2_client(region).describe_security_groups(GroupIds=[group_id])
+    rules = set()
+    for permission in response["SecurityGroups"][0].get("IpPermissions", []):
+        protocol, port = permission.get("IpProtocol"), permission.get("FromPort")
+        if protocol not in ("tcp", "udp") or port is None or port != permission.get("ToPort"):
+            continue
+        if not any(r.get("CidrIp") == OPEN_CIDR for r in permission.get("IpRanges", [])):
+            continue
+        if any(start <= port <= end for start, end in port_ranges):
+            rules.add((protocol, port))
+    return rules
+
+def _ip_permissions(rules, descriptions: Dict[SGRule, str] | None = None) -> List[dict]:
+    permissions = []
+    for protocol, port in sorted(rules):
+        ip_range = {"CidrIp": OPEN_CIDR}
+        if descriptions and descriptions.get((protocol, port)):
+            ip_range["Description"] = descriptions[(protocol, port)]
+        permissions.append({"IpProtocol": protocol, "FromPort": port, "ToPort": port, "IpRanges": [ip_range]})
+    return permissions
+
+def revoke_tunnel_rules(group: SecurityGroup, rules: Set[SGRule]):
+    """Revokes many rules in one call. This is a blocking function intended to be run in a thread."""
+    region, group_id = group
+    get_ec2_client(region).revoke_security_group_ingress(GroupId=group_id, IpPermissions=_ip_permissions(rules))
+
+def authorize_tunnel_rules(group: SecurityGroup, rules: Set[SGRule], descriptions: Dict[SGRule, str]):
+    """Authorizes many rules in one call. This is a blocking function intended to be run in a thread."""
+    region, group_id = group
+    get_ec2_client(region).authorize_security_group_ingress(GroupId=group_id, IpPermissions=_ip_permissions(rules, descriptions))
+#endregion
+
+
+
+#region --- Collector ---
+async def collect_network_garbage(vms_dir: Path, dry_run: bool = True) -> dict:
+    """
+    Compares the VM rows with the shard configs and the gateway security groups
+    and reclaims whatever no VM owns: orphaned proxies (one rewrite and reload per
+    shard), orphaned security-group rules (one revoke per group) and VMs stuck in
+    Deleting whose directory is already gone. With NETWORK_GC_REPAIR, proxies and
+    rules a VM should have but does not are put back the same way.
+    Holds RESOURCE_LOCK throughout, so it never races a create or a rule change.
+    Returns a report of what was found (and, unless dry_run, reclaimed).
+    """
+    started = time.perf_counter()
+    report = {
+        "dry_run": dry_run,
+        "started_at": datetime.now(timezone.utc).isoformat(),
+        "orphan_proxies": [],
+        "missing_proxies": [],
+        "orphan_sg_rules": [],
+        "missing_sg_rules": [],
+        "stuck_vms": [],
+        "errors": [],
+    }
+    groups = _security_groups()
+
+    async with RESOURCE_LOCK:
+        async with async_session_factory() as db:
+            vms = await get_all_vms(db)
+
+            # What the DB says should exist. A VM being deleted right now keeps
+            # its resources until its delete task removes them; one stuck in
+            # Deleting with its directory gone will never get that far.
+            expected_proxies: Dict[Tuple[str, int], Dict[str, str]] = {}  # client -> {name: proxy toml}
+            expected_rules: Dict[SecurityGroup, Dict[SGRule, str]] = {}    # group -> {rule: owner VM}
+            reserved_proxies: Set[Tuple[str, int, str]] = set()
+            reserved_rules: Set[Tuple[SecurityGroup, SGRule]] = set()
+            stuck = []
+            gateways = {gateway.name: gateway for gateway in GATEWAYS}
+            for vm in vms:
+                deleting = vm.status == "Deleting"
+                if deleting and not (vms_dir / vm.name).exists():
+                    stuck.append(vm)
+                    continue
+                gateway = gateways.get(vm.gateway)
+                group = (gateway.region, gateway.security_group_id) if gateway and gateway.security_group_id else None
+                for rule in vm.inbound_rules or []:
+                    name = f"{vm.name}-{rule['vm_port']}"
+                    sg_rule = (rule_proxy_type(rule), rule["remotePort"]) if "remotePort" in rule else None
+                    if deleting:
+                        reserved_proxies.add((vm.gateway, vm.frp_shard, name))
+                        if group and sg_rule:
+                            reserved_rules.add((group, sg_rule))
+                        continue
+                    if has_proxy(rule):
+                        expected_proxies.setdefault((vm.gateway, vm.frp_shard), {})[name] = render_rule_proxy(vm.name, vm.private_ip, rule)
+                    if group and sg_rule:
+                        expected_rules.setdefault(group, {})[sg_rule] = vm.name
+            report["stuck_vms"] = [{"id": vm.id, "name": vm.name, "owner_id": str(vm.owner_id)} for vm in stuck]
+
+            # What frpc and AWS actually have, read in bulk
+            clients = set(await asyncio.to_thread(_configured_clients)) | set(expected_proxies)
+            configured = dict(zip(clients, await asyncio.gather(
+                *(asyncio.to_thread(read_proxy_names, gateway, shard) for gateway, shard in clients)
+            )))
+            described = await asyncio.gather(
+                *(asyncio.to_thread(describe_tunnel_rules, group, ranges) for group, ranges in groups.items()),
+                return_exceptions=True,
+            )
+
+            # Proxies: one rewrite (and one reload) per shard that changed
+            for (gateway, shard), names in sorted(configured.items()):
+                expected = expected_proxies.get((gateway, shard), {})
+                orphans = {name for name in names - set(expected) if (gateway, shard, name) not in reserved_proxies}
+                missing = {name: expected[name] for name in set(expected) - names} if NETWORK_GC_REPAIR else {}
+                report["orphan_proxies"] += [{"gateway": gateway, "shard": shard, "name": name} for name in sorted(orphans)]
+                report["missing_proxies"] += [{"gateway": gateway, "shard": shard, "name": name} for name in sorted(missing)]
+                if dry_run or not (orphans or missing):
+                    continue
+                try:
+                    if orphans:
+                        await asyncio.to_thread(_remove_proxies_from_config, gateway, shard, orphans)
+                    if missing:
+                        await asyncio.to_thread(_append_proxies_to_config, gateway, shard, list(missing.values()))
+                    await asyncio.to_thread(execute_frpc_reload, gateway, shard)
+                except Exception as e:
+                    report["errors"].append(f"frpc {gateway}/{shard}: {e}")
+
+            # Security groups: one revoke and one authorize per group
+            for (group, ranges), actual in zip(groups.items(), described):
+                region, group_id = group
+                if isinstance(actual, Exception):
+                    report["errors"].append(f"Describe {group_id} ({region}): {actual}")
+                    continue
+                expected = expected_rules.get(group, {})
+                orphans = {rule for rule in actual - set(expected) if (group, rule) not in reserved_rules}
+                missing = set(expected) - actual if NETWORK_GC_REPAIR else set()
+                report["orphan_sg_rules"] += [
+                    {"security_group_id": group_id, "region": region, "protocol": protocol, "port": port}
+                    for protocol, port in sorted(orphans)
+                ]
+                report["missing_sg_rules"] += [
+                    {"security_group_id": group_id, "region": region, "protocol": protocol, "port": port, "vm": expected[(protocol, port)]}
+                    for protocol, port in sorted(missing)
+                ]
+                if dry_run:
+                    continue
+                try:
+                    if orphans:
+                        await asyncio.to_thread(revoke_tunnel_rules, group, orphans)
+                    if missing:
+                        descriptions = {rule: f"{expected[rule]} (restored)" for rule in missing}
+                        await asyncio.to_thread(authorize_tunnel_rules, group, missing, descriptions)
+                except Exception as e:
+                    report["errors"].append(f"Update {group_id} ({region}): {e}")
+
+            # Stuck rows go last, once their proxies and rules are gone
+            if stuck and not dry_run:
+                try:
+                    for vm in stuck:
+                        for snapshot in await get_snapshots_for_vm(db, vm.id):
+                            await db.delete(snapshot)
+                        await db.delete(vm)
+                    await db.commit()
+                except Exception as e:
+                    await db.rollback()
+                    report["errors"].append(f"Delete stuck VMs: {e}")
+
+    report["duration_seconds"] = round(time.perf_counter() - started, 3)
+    return report
+
+def summarize_report(report: dict) -> str:
+    verb = "Found" if report["dry_run"] else "Reclaimed"
+    return (
+        f"{verb} {len(report['orphan_proxies'])} orphaned proxies, {len(report['orphan_sg_rules'])} orphaned "
+        f"security-group rules and {len(report['stuck_vms'])} stuck VMs; {len(report['missing_proxies'])} missing "
+        f"proxies, {len(report['missing_sg_rules'])} missing rules, {len(report['errors'])} errors "
+        f"({report['duration_seconds']:.2f}s)"
+    )
+
+async def network_gc_loop(vms_dir: Path):
+    """Leader loop: runs the collector every NETWORK_GC_INTERVAL seconds."""
+    while True:
+        await asyncio.sleep(NETWORK_GC_INTERVAL)
+        try:
+            report = await collect_network_garbage(vms_dir, dry_run=NETWORK_GC_DRY_RUN)
+            print(f"[NETWORK GC] {summarize_report(report)}")
+            for error in report["errors"]:
+                print(f"[NETWORK GC] {error}")
+        except Exception as e:
+            print(f"[NETWORK GC] Collection failed: {e}")
+#endregion
@@ -0,0 +1,224 @@
+import os
+import json
+import asyncio
+import urllib.parse
+import urllib.request
+from pathlib import Path
+from shutil import rmtree
+from typing import Dict, List, Optional, Tuple
+
+import psutil
+from dotenv import load_dotenv
+from pydantic import BaseModel
+
+from drivers import get_driver, LogCallback
+from tracing import traced
+
+load_dotenv()
+
+#region -------------Node Registry--------
+BASE_DIR = Path(__file__).parent
+NODES_CONFIG_PATH = Path(os.environ.get("NODES_CONFIG_PATH", BASE_DIR / "nodes.json"))
+# "binpack": fill the fullest node that still fits. "spread": use the emptiest.
+NODE_PLACEMENT = os.environ.get("NODE_PLACEMENT", "binpack")
+# Seconds to wait for an agent. vagrant up on a fresh box can take many minutes.
+NODE_AGENT_TIMEOUT = float(os.environ.get("NODE_AGENT_TIMEOUT", "1800"))
+
+LOCAL_NODE = "local"
+
+class Node(BaseModel):
+    """A hypervisor host. Nodes without a url are the controller's own machine."""
+    name: str
+    url: Optional[str] = None          # Base URL of the node agent, e.g. http://10.0.0.5:9000
+    token: Optional[str] = None        # Sent as X-Agent-Token
+    reserved_ram_mb: int = 2048        # Kept free for the host itself
+    reserved_cpu: int = 1
+
+    @property
+    def is_local(self) -> bool:
+        return self.url is None
+
+def load_nodes() -> List[Node]:
+    """Reads nodes.json, a list of Node objects. Defaults to just this machine."""
+    if not NODES_CONFIG_PATH.exists():
+        return [Node(name=LOCAL_NODE)]
+    with open(NODES_CONFIG_PATH, "r") as f:
+        nodes = [Node(**entry) for entry in json.load(f)]
+    if not nodes:
+        raise ValueError(f"{NODES_CONFIG_PATH} does not define any nodes.")
+    return nodes
+
+NODES: List[Node] = load_nodes()
+_NODES_BY_NAME: Dict[str, Node] = {node.name: node for node in NODES}
+
+def get_node(name: str) -> Node:
+    try:
+        return _NODES_BY_NAME[name]
+    except KeyError:
+        raise Exception(f"Node '{name}' is not in the node registry.")
+#endregion
+
+
+
+#region --- Agent Client ---
+def _agent_request(node: Node, method: str, path: str, body: dict | None = None, timeout: float = NODE_AGENT_TIMEOUT) -> dict:
+    """
+    Calls a node agent and returns its JSON response.
+    This is a blocking function intended to be run in a thread.
+    """
+    data = json.dumps(body).encode() if body is not None else None
+    request = urllib.request.Request(f"{node.url.rstrip('/')}{path}", data=data, method=method)
+    request.add_header("Content-Type", "application/json")
+    if node.token:
+        request.add_header("X-Agent-Token", node.token)
+    with urllib.request.urlopen(request, timeout=timeout) as response:
+        return json.loads(response.read().decode())
+
+def _local_resources() -> dict:
+    memory = psutil.virtual_memory()
+    cpu_total = psutil.cpu_count(logical=True) or 1
+    return {
+        "cpu_total": cpu_total,
+        "cpu_free": round(cpu_total * (1 - psutil.cpu_percent(interval=None) / 100), 2),
+        "ram_total_mb": memory.total // (1024 * 1024),
+        "ram_free_mb": memory.available // (1024 * 1024),
+    }
+
+async def get_node_resources(node: Node) -> dict:
+    """Total and free CPU/RAM as reported by the node (or measured locally)."""
+    if node.is_local:
+        return _local_resources()
+    return await asyncio.to_thread(_agent_request, node, "GET", "/resources", None, 10)
+
+async def get_agent_latency(node: Node) -> dict:
+    """The remote node's driver name and per-operation latency report."""
+    return await asyncio.to_thread(_agent_request, node, "GET", "/latency", None, 10)
+
+async def get_agent_counters(node: Node, vm_names: List[str]) -> dict:
+    """Raw resource counters of the node's VMs, as telemetry.read_counters returns them."""
+    query = urllib.parse.urlencode({"names": ",".join(vm_names)})
+    return await asyncio.to_thread(_agent_request, node, "GET", f"/samples?{query}", None, 10)
+
+async def _agent_vagrant(node: Node, method: str, path: str, log: LogCallback = None) -> Tuple[int, str]:
+    """Runs an operation on an agent. Its output only arrives once the operation finishes."""
+    result = await asyncio.to_thread(_agent_request, node, method, path)
+    if log:
+        for line in result["output"].splitlines(keepends=True):
+            log(line)
+    return result["returncode"], result["output"]
+#endregion
+
+
+
+#region --- Scheduling ---
+def _capacity_left(node: Node, report: dict, committed: Dict[str, Tuple[int, int]], ram: int, cpu: int) -> Tuple[int, int]:
+    """(RAM MB, vCPUs) the node would have left after adding the VM."""
+    used_cpu, used_ram = committed.get(node.name, (0, 0))
+    ram_left = report["ram_total_mb"] - node.reserved_ram_mb - used_ram - ram
+    cpu_left = report["cpu_total"] - node.reserved_cpu - used_cpu - cpu
+    return ram_left, cpu_left
+
+async def node_has_capacity(node: Node, ram: int, cpu: int, committed: Dict[str, Tuple[int, int]]) -> bool:
+    """Whether a stopped or suspended VM of this size can be started on its node again."""
+    report = await get_node_resources(node)
+    ram_left, cpu_left = _capacity_left(node, report, committed, ram, cpu)
+    return ram_left >= 0 and cpu_left >= 0
+
+async def schedule_node(ram: int, cpu: int, committed: Dict[str, Tuple[int, int]]) -> Node:
+    """
+    Picks a node for a VM needing `ram` MB and `cpu` vCPUs.
+    committed maps node name -> (vCPUs, RAM MB) already allocated to VMs there,
+    taken from the vms table so VMs that are still booting are counted too.
+    Unreachable nodes are skipped.
+    """
+    reports = await asyncio.gather(*(get_node_resources(node) for node in NODES), return_exceptions=True)
+
+    fits = []
+    for node, report in zip(NODES, reports):
+        if isinstance(report, Exception):
+            print(f"[SCHEDULER] Node '{node.name}' is unreachable: {report}")
+            continue
+        ram_left, cpu_left = _capacity_left(node, report, committed, ram, cpu)
+        if ram_left >= 0 and cpu_left >= 0:
+            fits.append((node, ram_left))
+
+    if not fits:
+        raise Exception("No node has enough free CPU and RAM for this VM.")
+    if NODE_PLACEMENT == "spread":
+        return max(fits, key=lambda fit: fit[1])[0]
+    return min(fits, key=lambda fit: fit[1])[0]
+#endregion
+
+
+
+#region --- Lifecycle Routing ---
+@traced("node.write_vagrantfile")
+async def node_write_vagrantfile(node: Node, vm_name: str, vagrantfile_content: str):
+    """Copies the Vagrantfile to a remote node. Local VMs use VMS_DIR directly."""
+    if not node.is_local:
+        await asyncio.to_thread(_agent_request, node, "PUT", f"/vms/{vm_name}", {"vagrantfile": vagrantfile_content}, 30)
+
+@traced("node.up")
+async def node_up(node: Node, vm_name: str, vm_path: str, log: LogCallback = None) -> Tuple[int, str]:
+    if node.is_local:
+        return await get_driver().up(vm_name, vm_path, log)
+    return await _agent_vagrant(node, "POST", f"/vms/{vm_name}/up", log)
+
+@traced("node.halt")
+async def node_halt(node: Node, vm_name: str, vm_path: str, log: LogCallback = None) -> Tuple[int, str]:
+    if node.is_local:
+        return await get_driver().halt(vm_name, vm_path, log)
+    return await _agent_vagrant(node, "POST", f"/vms/{vm_name}/halt", log)
+
+@traced("node.provision")
+async def node_provision(node: Node, vm_name: str, vm_path: str, provisioner: str, log: LogCallback = None) -> Tuple[int, str]:
+    """Runs one named provisioner in the running VM."""
+    if node.is_local:
+        return await get_driver().provision(vm_name, vm_path, provisioner, log)
+    return await _agent_vagrant(node, "POST", f"/vms/{vm_name}/provision/{provisioner}", log)
+
+@traced("node.savestate")
+async def node_savestate(node: Node, vm_name: str, vm_path: str, log: LogCallback = None) -> Tuple[int, str]:
+    """Suspends the VM to disk. node_up resumes it."""
+    if node.is_local:
+        return await get_driver().savestate(vm_name, vm_path, log)
+    return await _agent_vagrant(node, "POST", f"/vms/{vm_name}/savestate", log)
+
+@traced("node.snapshot")
+async def node_snapshot(node: Node, vm_name: str, vm_path: str, action: str, snapshot: str, log: LogCallback = None) -> Tuple[int, str]:
+    """action is "save", "restore" or "delete"."""
+    if node.is_local:
+        return await getattr(get_driver(), f"snapshot_{action}")(vm_name, vm_path, snapshot, log)
+    method, path = {
+        "save": ("POST", f"/vms/{vm_name}/snapshots/{snapshot}"),
+        "restore": ("POST", f"/vms/{vm_name}/snapshots/{snapshot}/restore"),
+        "delete": ("DELETE", f"/vms/{vm_name}/snapshots/{snapshot}"),
+    }[action]
+    return await _agent_vagrant(node, method, path, log)
+
+async def node_snapshot_usage(node: Node, vm_name: str, vm_path: str) -> int:
+    """Bytes used by the VM's snapshots on its node."""
+    if node.is_local:
+        return await get_driver().snapshot_usage(vm_name, vm_path)
+    result = await asyncio.to_thread(_agent_request, node, "GET", f"/vms/{vm_name}/snapshots/usage", None, 30)
+    return result["bytes"]
+
+async def node_status(node: Node, vm_name: str, vm_path: str) -> str:
+    if node.is_local:
+        return await get_driver().status(vm_name, vm_path)
+    result = await asyncio.to_thread(_agent_request, node, "GET", f"/vms/{vm_name}/status", None, 30)
+    return result["status"]
+
+@traced("node.destroy")
+async def node_destroy(node: Node, vm_name: str, vm_path: Path, log: LogCallback = None) -> Tuple[int, str]:
+    """Destroys the VM on its node and removes the controller's copy of its directory."""
+    if node.is_local:
+        result = (0, "")
+        if vm_path.exists():
+            result = await get_driver().destroy(vm_name, str(vm_path), log)
+    else:
+        result = await _agent_vagrant(node, "DELETE", f"/vms/{vm_name}", log)
+    if vm_path.exists():
+        rmtree(vm_path)
+    return result
+#endregion
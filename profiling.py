@@ -0,0 +1,315 @@
+import os
+import re
+import sys
+import json
+import time
+import random
+import asyncio
+import threading
+from collections import Counter
+from datetime import datetime, timezone
+from pathlib import Path
+from typing import Dict, List, Optional
+from uuid import uuid4
+
+from dotenv import load_dotenv
+
+from asgi import get_header
+from auth import user_from_authorization
+
+load_dotenv()
+
+#region -------------Settings--------
+BASE_DIR = Path(__file__).parent
+PROFILE_DIR = Path(os.environ.get("PROFILE_DIR", BASE_DIR / ".profiles"))
+# Share of all requests profiled automatically (0 = only on request)
+PROFILE_SAMPLE_RATE = float(os.environ.get("PROFILE_SAMPLE_RATE", "0"))
+# Admins profile a single request by sending "X-Profile: 1"
+PROFILE_HEADER = b"x-profile"
+PROFILE_INTERVAL_MS = float(os.environ.get("PROFILE_INTERVAL_MS", "5"))
+# Oldest profiles are deleted past either limit
+PROFILE_MAX_FILES = int(os.environ.get("PROFILE_MAX_FILES", "200"))
+PROFILE_MAX_MB = float(os.environ.get("PROFILE_MAX_MB", "100"))
+PROFILE_HOTSPOTS = 15
+PROFILE_ID_PATTERN = re.compile(r"^\d{8}T\d{6}-[0-9a-f]{8}$")
+#endregion
+
+
+
+#region --- Stack Sampling ---
+# Frames of the thread-pool loops that run asyncio.to_thread and sync background
+# tasks. Below them is the work itself; queue/threading frames mean the thread is idle.
+_WORKER_FILES = (os.path.join("concurrent", "futures", "thread.py"), os.path.join("anyio", "_backends", "_asyncio.py"))
+_IDLE_FILES = ("queue.py", "threading.py")
+
+def _frame_label(frame) -> str:
+    code = frame.f_code
+    return f"{getattr(code, 'co_qualname', code.co_name)} ({Path(code.co_filename).name}:{code.co_firstlineno})"
+
+def _running_stack(frame, root) -> Optional[List[str]]:
+    """Labels from root down to frame, or None if root is not on this stack."""
+    labels = []
+    while frame is not None:
+        labels.append(_frame_label(frame))
+        if frame is root:
+            return labels[::-1]
+        frame = frame.f_back
+    return None
+
+def _awaiting_stack(awaitable) -> List[str]:
+    """Labels along the await chain of a suspended coroutine, ending at what it waits on."""
+    labels = []
+    while awaitable is not None:
+        frame = getattr(awaitable, "cr_frame", None) or getattr(awaitable, "gi_frame", None) or getattr(awaitable, "ag_frame", None)
+        if frame is None:
+            break
+        labels.append(_frame_label(frame))
+        awaitable = getattr(awaitable, "cr_await", None) or getattr(awaitable, "gi_yieldfrom", None) or getattr(awaitable, "ag_await", None)
+    labels.append("[waiting]")
+    return labels
+
+def _busy_thread_stacks(frames: dict, skip: set) -> List[List[str]]:
+    """Stacks of pool threads that are running work (not waiting for it)."""
+    stacks = []
+    for thread_id, frame in frames.items():
+        if thread_id in skip:
+            continue
+        chain = []
+        while frame is not None:
+            chain.append(frame)
+            frame = frame.f_back
+        chain.reverse()
+        worker = max((i for i, f in enumerate(chain) if f.f_code.co_filename.endswith(_WORKER_FILES)), default=None)
+        if worker is None:
+            continue
+        if worker + 1 == len(chain):
+            # Inside a work item's run() the work is a C function called straight
+            # from the pool (e.g. time.sleep); anywhere else the thread waits for work
+            if chain[worker].f_code.co_name == "run":
+                stacks.append([_frame_label(chain[worker]), "[native code]"])
+        elif not chain[worker + 1].f_code.co_filename.endswith(_IDLE_FILES):
+            stacks.append([_frame_label(f) for f in chain[worker + 1:]])
+    return stacks
+
+class RequestProfile:
+    """
+    Samples of one request, and of the background tasks it scheduled (Starlette
+    runs them after the response, in the same ASGI call).
+    Each sample is the request's own stack: the running frames if it is on the
+    event loop at that moment, or its await chain if it is suspended, so lock and
+    I/O waits show up as time spent "[waiting]" under the await that blocked.
+    Thread-pool work (asyncio.to_thread, sync background tasks) is sampled under
+    "[threads]"; with concurrent requests that part may include their work too.
+    """
+    def __init__(self, scope: dict, reason: str):
+        self.id = f"{datetime.now(timezone.utc):%Y%m%dT%H%M%S}-{uuid4().hex[:8]}"
+        self.method = scope.get("method", "")
+        self.path = scope.get("path", "")
+        self.reason = reason
+        self.started_at = datetime.now(timezone.utc)
+        self.loop_thread = threading.get_ident()
+        self.coro = None
+        self.phase = "response"
+        self.status: Optional[int] = None
+        self.stacks: Counter = Counter()
+        self.samples = 0
+        self._started = time.perf_counter()
+        self.response_seconds: Optional[float] = None
+        self.total_seconds: Optional[float] = None
+
+    def response_sent(self):
+        self.response_seconds = time.perf_counter() - self._started
+        self.phase = "background"
+
+    def finished(self):
+        self.total_seconds = time.perf_counter() - self._started
+
+    def sample(self, frames: dict, thread_stacks: List[List[str]]):
+        coro = self.coro
+        if coro is None or coro.cr_frame is None:
+            return
+        if coro.cr_running:
+            stack = _running_stack(frames.get(self.loop_thread), coro.cr_frame)
+            if stack is None:
+                return  # Switched tasks between the check and the snapshot
+        else:
+            stack = _awaiting_stack(coro)
+        self.samples += 1
+        self.stacks[";".join([f"[{self.phase}]", *stack])] += 1
+        for thread_stack in thread_stacks:
+            self.stacks[";".join(["[threads]", *thread_stack])] += 1
+
+    def hotspots(self) -> List[dict]:
+        """Where the samples ended: the innermost function, or the await a wait happened in."""
+        leaves: Counter = Counter()
+        for stack, count in self.stacks.items():
+            frames = stack.split(";")
+            leaf = f"{frames[-2]} [waiting]" if frames[-1] == "[waiting]" and len(frames) > 2 else frames[-1]
+            leaves[leaf] += count
+        total = sum(leaves.values()) or 1
+        return [
+            {"frame": leaf, "samples": count, "percent": round(100 * count / total, 1)}
+            for leaf, count in leaves.most_common(PROFILE_HOTSPOTS)
+        ]
+
+    def summary(self) -> dict:
+        return {
+            "id": self.id,
+            "method": self.method,
+            "path": self.path,
+            "status": self.status,
+            "reason": self.reason,
+            "started_at": self.started_at.isoformat(),
+            "response_ms": round(self.response_seconds * 1000, 1) if self.response_seconds is not None else None,
+            "total_ms": round(self.total_seconds * 1000, 1) if self.total_seconds is not None else None,
+            "interval_ms": PROFILE_INTERVAL_MS,
+            "samples": self.samples,
+        }
+
+class _Sampler:
+    """One thread samples every profile in flight, and exits when there are none."""
+    def __init__(self):
+        self._profiles: set = set()
+        self._lock = threading.Lock()
+        self._thread: threading.Thread | None = None
+
+    def add(self, profile: RequestProfile):
+        with self._lock:
+            self._profiles.add(profile)
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name="request-profiler", daemon=True)
+                self._thread.start()
+
+    def remove(self, profile: RequestProfile):
+        with self._lock:
+            self._profiles.discard(profile)
+
+    def _run(self):
+        interval = PROFILE_INTERVAL_MS / 1000
+        while True:
+            with self._lock:
+                profiles = list(self._profiles)
+                if not profiles:
+                    self._thread = None
+                    return
+            frames = sys._current_frames()
+            skip = {threading.get_ident()} | {profile.loop_thread for profile in profiles}
+            thread_stacks = _busy_thread_stacks(frames, skip)
+            for profile in profiles:
+                try:
+                    profile.sample(frames, thread_stacks)
+                except Exception as e:
+                    print(f"[PROFILE] Sampling {profile.id} failed: {e}")
+            del frames
+            time.sleep(interval)
+
+SAMPLER = _Sampler()
+#endregion
+
+
+
+#region --- Profile Store ---
+def save_profile(profile: RequestProfile):
+    """
+    Writes <id>.json (summary and hotspots) and <id>.folded (collapsed stacks, for
+    flamegraph.pl or speedscope), then trims the store to its limits.
+    This is a blocking function intended to be run in a thread.
+    """
+    PROFILE_DIR.mkdir(parents=True, exist_ok=True)
+    with open(PROFILE_DIR / f"{profile.id}.folded", "w") as f:
+        for stack, count in profile.stacks.most_common():
+            f.write(f"{stack} {count}\n")
+    with open(PROFILE_DIR / f"{profile.id}.json", "w") as f:
+        json.dump({**profile.summary(), "hotspots": profile.hotspots()}, f, indent=2)
+    _prune_profiles()
+
+def _prune_profiles():
+    summaries = sorted(PROFILE_DIR.glob("*.json"), key=lambda p: p.name, reverse=True)
+    total_bytes = 0
+    for index, path in enumerate(summaries):
+        folded = path.with_suffix(".folded")
+        try:
+            total_bytes += path.stat().st_size + (folded.stat().st_size if folded.exists() else 0)
+        except FileNotFoundError:
+            continue  # Another worker pruned it first
+        if index >= PROFILE_MAX_FILES or total_bytes > PROFILE_MAX_MB * 1024 * 1024:
+            path.unlink(missing_ok=True)
+            folded.unlink(missing_ok=True)
+
+def list_profiles() -> List[dict]:
+    """
+    Summaries of the stored profiles, newest first.
+    This is a blocking function intended to be run in a thread.
+    """
+    profiles = []
+    for path in sorted(PROFILE_DIR.glob("*.json"), key=lambda p: p.name, reverse=True):
+        try:
+            with open(path) as f:
+                summary = json.load(f)
+        except (OSError, ValueError):
+            continue
+        summary.pop("hotspots", None)
+        profiles.append(summary)
+    return profiles
+
+def profile_path(profile_id: str, suffix: str) -> Optional[Path]:
+    """Path of a stored profile file, or None if the id is malformed or unknown."""
+    if not PROFILE_ID_PATTERN.match(profile_id):
+        return None
+    path = PROFILE_DIR / f"{profile_id}{suffix}"
+    return path if path.exists() else None
+#endregion
+
+
+
+#region --- Middleware ---
+class ProfilingMiddleware:
+    """
+    Profiles a request when an admin sends "X-Profile: 1", or at random with
+    PROFILE_SAMPLE_RATE. Every other request passes straight through. The
+    response of a profiled request carries an X-Profile-Id header.
+    """
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+        reason = None
+        if PROFILE_SAMPLE_RATE > 0 and random.random() < PROFILE_SAMPLE_RATE:
+            reason = "sampled"
+        elif get_header(scope, PROFILE_HEADER) in ("1", "true"):
+            user = await user_from_authorization(get_header(scope, b"authorization"))
+            if user is not None and user.is_superuser:
+                reason = "requested"
+        if reason is None:
+            return await self.app(scope, receive, send)
+        await self._profile(scope, receive, send, reason)
+
+    async def _profile(self, scope, receive, send, reason: str):
+        profile = RequestProfile(scope, reason)
+
+        async def send_wrapper(message):
+            if message["type"] == "http.response.start":
+                profile.status = message["status"]
+                message["headers"] = [*message.get("headers", []), (b"x-profile-id", profile.id.encode())]
+            elif message["type"] == "http.response.body" and not message.get("more_body", False):
+                profile.response_sent()
+            await send(message)
+
+        async def run():
+            await self.app(scope, receive, send_wrapper)
+
+        profile.coro = run()
+        SAMPLER.add(profile)
+        try:
+            await profile.coro
+        finally:
+            SAMPLER.remove(profile)
+            profile.finished()
+            try:
+                await asyncio.to_thread(save_profile, profile)
+                print(f"[PROFILE] {profile.method} {profile.path}: {profile.samples} samples in {profile.total_seconds:.3f}s -> {profile.id}")
+            except Exception as e:
+                print(f"[PROFILE] Could not save profile {profile.id}: {e}")
+#endregion
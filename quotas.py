@@ -0,0 +1,44 @@
+import os
+from typing import Dict, List
+
+from dotenv import load_dotenv
+
+from models import User
+
+load_dotenv()
+
+#region -------------Settings--------
+# Defaults for every user; a user's own quota_* columns override them
+QUOTA_MAX_VMS = int(os.environ.get("QUOTA_MAX_VMS", "10"))
+QUOTA_MAX_VCPU = int(os.environ.get("QUOTA_MAX_VCPU", "16"))
+QUOTA_MAX_RAM_MB = int(os.environ.get("QUOTA_MAX_RAM_MB", "32768"))
+# Gateway remote ports, i.e. tcp/udp tunnels (subdomain-routed http rules use none)
+QUOTA_MAX_PORTS = int(os.environ.get("QUOTA_MAX_PORTS", "20"))
+
+QUOTA_RESOURCES = ("vms", "vcpu", "ram_mb", "ports")
+#endregion
+
+
+
+#region --- Quotas ---
+def quota_limits(user: User) -> Dict[str, int]:
+    """The user's limit on each resource."""
+    return {
+        "vms": user.quota_vms if user.quota_vms is not None else QUOTA_MAX_VMS,
+        "vcpu": user.quota_vcpu if user.quota_vcpu is not None else QUOTA_MAX_VCPU,
+        "ram_mb": user.quota_ram_mb if user.quota_ram_mb is not None else QUOTA_MAX_RAM_MB,
+        "ports": user.quota_ports if user.quota_ports is not None else QUOTA_MAX_PORTS,
+    }
+
+def quota_violations(user: User, usage: Dict[str, int], **requested: int) -> List[str]:
+    """
+    What would go over the user's quota if they took `requested` on top of
+    `usage` (both keyed by QUOTA_RESOURCES). Empty if the request fits.
+    """
+    limits = quota_limits(user)
+    return [
+        f"{resource} {usage.get(resource, 0)} + {amount} > {limits[resource]}"
+        for resource, amount in requested.items()
+        if amount and usage.get(resource, 0) + amount > limits[resource]
+    ]
+#endregion
@@ -0,0 +1,158 @@
+import os
+import re
+import json
+import math
+import time
+import sqlite3
+import asyncio
+import threading
+from pathlib import Path
+from typing import Dict, List, Optional, Tuple
+
+from dotenv import load_dotenv
+
+from asgi import get_header
+from auth import user_id_from_token
+from coordination import LOCK_DIR
+
+load_dotenv()
+
+#region -------------Settings--------
+RATE_LIMIT_ENABLED = os.environ.get("RATE_LIMIT_ENABLED", "true").lower() == "true"
+# Bucket state is shared by every worker through this SQLite file
+RATE_LIMIT_DB = Path(os.environ.get("RATE_LIMIT_DB", LOCK_DIR / "ratelimit.db"))
+# "METHOD /route/{param}" -> {"user": "N/S", "global": "N/S"}. "N/S" is a bucket
+# of N requests that refills at N per S seconds. RATE_LIMITS (JSON, same shape)
+# replaces these defaults route by route.
+DEFAULT_RATE_LIMITS = {
+    "POST /generate-key/{key_name}": {"user": "5/60", "global": "60/60"},
+    "POST /create-vm": {"user": "5/60", "global": "30/60"},
+    "POST /add-inbound-rule/{port}": {"user": "10/60", "global": "60/60"},
+}
+RATE_LIMITS = {**DEFAULT_RATE_LIMITS, **json.loads(os.environ.get("RATE_LIMITS", "{}"))}
+#endregion
+
+
+
+#region --- Rules ---
+class Bucket:
+    def __init__(self, spec: str):
+        capacity, _, seconds = spec.partition("/")
+        self.capacity = float(capacity)
+        self.rate = self.capacity / float(seconds)  # tokens per second
+
+class RouteLimit:
+    def __init__(self, route: str, limits: Dict[str, str]):
+        self.route = route
+        method, _, template = route.partition(" ")
+        self.method = method.upper()
+        # Each {param} matches one path segment
+        literal_parts = re.split(r"\{[^/]+?\}", template)
+        self.pattern = re.compile("^" + "[^/]+".join(re.escape(part) for part in literal_parts) + "$")
+        self.user = Bucket(limits["user"]) if limits.get("user") else None
+        self.global_ = Bucket(limits["global"]) if limits.get("global") else None
+
+    def matches(self, method: str, path: str) -> bool:
+        return method == self.method and bool(self.pattern.match(path))
+
+ROUTE_LIMITS: List[RouteLimit] = [RouteLimit(route, limits) for route, limits in RATE_LIMITS.items()]
+
+def find_route_limit(method: str, path: str) -> Optional[RouteLimit]:
+    return next((limit for limit in ROUTE_LIMITS if limit.matches(method, path)), None)
+#endregion
+
+
+
+#region --- Shared Bucket Store ---
+_local = threading.local()
+
+def _connection() -> sqlite3.Connection:
+    """One connection per thread; the table only holds (key, tokens, updated)."""
+    conn = getattr(_local, "conn", None)
+    if conn is None:
+        RATE_LIMIT_DB.parent.mkdir(parents=True, exist_ok=True)
+        conn = sqlite3.connect(RATE_LIMIT_DB, timeout=5, isolation_level=None)
+        conn.execute("PRAGMA journal_mode=WAL")
+        # Losing a few refills in a crash is harmless; skip the fsyncs
+        conn.execute("PRAGMA synchronous=OFF")
+        conn.execute("CREATE TABLE IF NOT EXISTS buckets (key TEXT PRIMARY KEY, tokens REAL NOT NULL, updated REAL NOT NULL)")
+        _local.conn = conn
+    return conn
+
+def take_tokens(buckets: List[Tuple[str, Bucket]]) -> Tuple[bool, float, Optional[str]]:
+    """
+    Takes one token from every bucket, or from none of them if any is empty.
+    Returns (allowed, seconds until the empty bucket has a token, its key).
+    All buckets are checked in one write transaction, so workers never both
+    spend the last token.
+    This is a blocking function intended to be run in a thread.
+    """
+    conn = _connection()
+    now = time.time()
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        levels = []
+        for key, bucket in buckets:
+            row = conn.execute("SELECT tokens, updated FROM buckets WHERE key = ?", (key,)).fetchone()
+            tokens = bucket.capacity if row is None else min(bucket.capacity, row[0] + (now - row[1]) * bucket.rate)
+            if tokens < 1:
+                conn.execute("ROLLBACK")
+                return False, (1 - tokens) / bucket.rate, key
+            levels.append((key, tokens - 1))
+        conn.executemany("INSERT OR REPLACE INTO buckets (key, tokens, updated) VALUES (?, ?, ?)", [(key, tokens, now) for key, tokens in levels])
+        conn.execute("COMMIT")
+        return True, 0.0, None
+    except BaseException:
+        if conn.in_transaction:
+            conn.execute("ROLLBACK")
+        raise
+#endregion
+
+
+
+#region --- Middleware ---
+class RateLimitMiddleware:
+    """
+    Applies RATE_LIMITS before the route handler runs. Requests are keyed by the
+    user id in their bearer token (no database lookup), or by client address
+    when there is none. Over the limit, the answer is 429 with Retry-After.
+    Routes without a limit pass straight through.
+    """
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        limit = find_route_limit(scope["method"], scope["path"]) if scope["type"] == "http" and RATE_LIMIT_ENABLED else None
+        if limit is None:
+            return await self.app(scope, receive, send)
+
+        user_id = user_id_from_token(get_header(scope, b"authorization"))
+        client = f"user:{user_id}" if user_id else f"ip:{(scope.get('client') or ('unknown',))[0]}"
+        buckets = []
+        if limit.user:
+            buckets.append((f"{limit.route}|{client}", limit.user))
+        if limit.global_:
+            buckets.append((f"{limit.route}|global", limit.global_))
+        try:
+            allowed, retry_after, key = await asyncio.to_thread(take_tokens, buckets)
+        except Exception as e:
+            # The limiter must never take the API down with it
+            print(f"[RATE LIMIT] Bucket store unavailable, letting {limit.route} through: {e}")
+            return await self.app(scope, receive, send)
+        if allowed:
+            return await self.app(scope, receive, send)
+
+        scope_name = "for everyone" if key.endswith("|global") else "for you"
+        seconds = max(1, math.ceil(retry_after))
+        body = json.dumps({"detail": f"Rate limit for {limit.route} reached {scope_name}. Try again in {seconds}s."}).encode()
+        await send({
+            "type": "http.response.start",
+            "status": 429,
+            "headers": [
+                (b"content-type", b"application/json"),
+                (b"content-length", str(len(body)).encode()),
+                (b"retry-after", str(seconds).encode()),
+            ],
+        })
+        await send({"type": "http.response.body", "body": body})
+#endregion
@@ -0,0 +1,135 @@
+import os
+import time
+import random
+import asyncio
+from typing import Dict, List, NamedTuple, Optional
+
+from dotenv import load_dotenv
+
+from frp import rule_proxy_type
+from gateways import get_gateway
+from tracing import span, annotate
+
+load_dotenv()
+
+#region -------------Settings--------
+# Wait for sshd (and the SSH tunnel) before a booted VM becomes Active
+READINESS_ENABLED = os.environ.get("READINESS_ENABLED", "true").lower() == "true"
+# Also check the SSH rule's remotePort on the gateway, through frps and frpc
+READINESS_CHECK_TUNNEL = os.environ.get("READINESS_CHECK_TUNNEL", "true").lower() == "true"
+# A VM that is not reachable this many seconds after `vagrant up` ends goes to Error
+READINESS_TIMEOUT = float(os.environ.get("READINESS_TIMEOUT", "300"))
+# Per attempt: connecting and waiting for the SSH banner
+READINESS_CONNECT_TIMEOUT = float(os.environ.get("READINESS_CONNECT_TIMEOUT", "3"))
+# Wait between failed attempts, doubling from the first to the max
+READINESS_BACKOFF_INITIAL = float(os.environ.get("READINESS_BACKOFF_INITIAL", "0.5"))
+READINESS_BACKOFF_MAX = float(os.environ.get("READINESS_BACKOFF_MAX", "8"))
+# Checks (open sockets) in flight at once in this worker, over all VMs
+READINESS_CONCURRENCY = int(os.environ.get("READINESS_CONCURRENCY", "64"))
+SSH_BANNER_PREFIX = b"SSH-"
+#endregion
+
+
+
+#region --- Checks ---
+class ProbeTarget(NamedTuple):
+    stage: str  # "ssh" (the private IP) or "tunnel" (the gateway)
+    host: str
+    port: int
+
+def readiness_targets(vm) -> List[ProbeTarget]:
+    """What must answer with an SSH banner, in order, before the VM counts as reachable."""
+    targets = [ProbeTarget("ssh", vm.private_ip, 22)]
+    ssh_rule = next(
+        (rule for rule in vm.inbound_rules or [] if rule.get("vm_port") == 22 and rule_proxy_type(rule) == "tcp" and "remotePort" in rule),
+        None,
+    )
+    if READINESS_CHECK_TUNNEL and ssh_rule is not None:
+        targets.append(ProbeTarget("tunnel", get_gateway(vm.gateway).address, ssh_rule["remotePort"]))
+    return targets
+
+_check_slots: Optional[asyncio.Semaphore] = None
+
+async def check_ssh_banner(host: str, port: int) -> Optional[str]:
+    """
+    Connects and reads the server's first line. None if it is an SSH banner,
+    otherwise why not. A banner through a tunnel also proves frps and frpc are
+    up: frps accepts the connection either way but has nothing to send.
+    """
+    global _check_slots
+    if _check_slots is None:
+        _check_slots = asyncio.Semaphore(READINESS_CONCURRENCY)
+    async with _check_slots:
+        writer = None
+        try:
+            reader, writer = await asyncio.wait_for(asyncio.open_connection(host, port), READINESS_CONNECT_TIMEOUT)
+            banner = await asyncio.wait_for(reader.readline(), READINESS_CONNECT_TIMEOUT)
+        except asyncio.TimeoutError:
+            return "timed out"
+        except OSError as e:
+            return e.strerror or type(e).__name__
+        finally:
+            if writer is not None:
+                writer.close()
+        if not banner.startswith(SSH_BANNER_PREFIX):
+            return f"no SSH banner (got {banner[:40]!r})" if banner else "closed without an SSH banner"
+        return None
+#endregion
+
+
+
+#region --- Prober ---
+# VM name -> progress of its probe, for GET /readiness
+_PROBES: Dict[str, dict] = {}
+
+async def wait_until_reachable(vm_name: str, targets: List[ProbeTarget], timeout: float = READINESS_TIMEOUT) -> dict:
+    """
+    Checks each target in turn, retrying with exponential backoff (and a little
+    jitter, so VMs booted together do not retry in lockstep) until it answers or
+    the timeout runs out. Any number of VMs can be probed at once; their checks
+    share READINESS_CONCURRENCY.
+    Returns {"reachable", "seconds", "stages": {stage: seconds until it answered}, "error"}.
+    """
+    started = time.perf_counter()
+    deadline = started + timeout
+    progress = {"stage": None, "attempts": 0, "last_error": None, "started": time.time()}
+    _PROBES[vm_name] = progress
+    stages: Dict[str, float] = {}
+    try:
+        with span("vm.readiness", vm=vm_name, targets=[f"{t.stage} {t.host}:{t.port}" for t in targets]):
+            for target in targets:
+                progress["stage"] = target.stage
+                delay = READINESS_BACKOFF_INITIAL
+                while True:
+                    progress["attempts"] += 1
+                    error = await check_ssh_banner(target.host, target.port)
+                    if error is None:
+                        stages[target.stage] = round(time.perf_counter() - started, 3)
+                        break
+                    progress["last_error"] = f"{target.stage} {target.host}:{target.port}: {error}"
+                    remaining = deadline - time.perf_counter()
+                    if remaining <= 0:
+                        annotate(reachable=False, attempts=progress["attempts"], error=progress["last_error"])
+                        return {"reachable": False, "seconds": round(time.perf_counter() - started, 3), "stages": stages, "error": progress["last_error"]}
+                    await asyncio.sleep(min(delay * random.uniform(0.8, 1.2), remaining))
+                    delay = min(delay * 2, READINESS_BACKOFF_MAX)
+            seconds = round(time.perf_counter() - started, 3)
+            annotate(reachable=True, attempts=progress["attempts"], seconds=seconds)
+            return {"reachable": True, "seconds": seconds, "stages": stages, "error": None}
+    finally:
+        _PROBES.pop(vm_name, None)
+
+def probes_in_flight() -> List[dict]:
+    """The VMs this worker is waiting on, and how far each has got."""
+    now = time.time()
+    return [
+        {
+            "vm": vm_name,
+            "stage": progress["stage"],
+            "attempts": progress["attempts"],
+            "waiting_seconds": round(now - progress["started"], 1),
+            "last_error": progress["last_error"],
+        }
+        for vm_name, progress in sorted(_PROBES.items())
+    ]
+#endregion
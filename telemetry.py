@@ -0,0 +1,325 @@
+import os
+import re
+import math
+import mmap
+import time
+import asyncio
+from pathlib import Path
+from typing import Dict, List, Optional, Tuple
+
+import psutil
+from dotenv import load_dotenv
+
+from drivers import run_vboxmanage, vbox_machine_id
+from nodes import get_node, get_agent_counters
+
+load_dotenv()
+
+#region -------------Settings--------
+TELEMETRY_ENABLED = os.environ.get("TELEMETRY_ENABLED", "true").lower() == "true"
+# Seconds between samples
+TELEMETRY_INTERVAL = float(os.environ.get("TELEMETRY_INTERVAL", "1"))
+# Network rates come from `VBoxManage metrics`, which is too slow to run every second
+TELEMETRY_NET_INTERVAL = float(os.environ.get("TELEMETRY_NET_INTERVAL", "10"))
+# How often to rescan the process table for VMs whose process is not known yet
+TELEMETRY_RESCAN_INTERVAL = float(os.environ.get("TELEMETRY_RESCAN_INTERVAL", "10"))
+
+# Recorded per sample, in this order
+FIELDS = ("cpu_percent", "rss_mb", "disk_read_kbps", "disk_write_kbps", "net_rx_kbps", "net_tx_kbps")
+# (name, seconds per point, points kept). Each tier averages the raw samples.
+TIERS = (
+    ("raw", TELEMETRY_INTERVAL, int(os.environ.get("TELEMETRY_RAW_POINTS", "600"))),
+    ("1m", 60, int(os.environ.get("TELEMETRY_MINUTE_POINTS", "1440"))),
+    ("1h", 3600, int(os.environ.get("TELEMETRY_HOUR_POINTS", "720"))),
+)
+METRICS_FILE_NAME = "metrics.bin"
+#endregion
+
+
+
+#region --- Ring Buffers ---
+# A VM's series live in one file of float64s, mapped into memory, so the leader
+# can write them while every worker reads them. Per tier:
+#   header: head, count, bucket key, bucket samples, per-field sums, per-field counts
+#   rows:   timestamp, one value per field (NaN = not measured)
+_ROW = 1 + len(FIELDS)
+_HEADER = 4 + 2 * len(FIELDS)
+
+def _tier_offsets() -> List[int]:
+    offsets, position = [], 0
+    for _, _, points in TIERS:
+        offsets.append(position)
+        position += _HEADER + points * _ROW
+    return offsets + [position]
+
+_OFFSETS = _tier_offsets()
+_FILE_SIZE = _OFFSETS[-1] * 8
+
+class MetricsRing:
+    """Fixed-size, downsampling time series of one VM, backed by a memory-mapped file."""
+    def __init__(self, path: Path, writable: bool = False):
+        self.path = path
+        if writable:
+            self._file = open(path, "r+b" if path.exists() else "w+b")
+            if os.fstat(self._file.fileno()).st_size != _FILE_SIZE:
+                # New file, or the tier sizes changed: start over
+                self._file.truncate(0)
+                self._file.truncate(_FILE_SIZE)
+            self._mmap = mmap.mmap(self._file.fileno(), _FILE_SIZE)
+        else:
+            self._file = open(path, "rb")
+            if os.fstat(self._file.fileno()).st_size != _FILE_SIZE:
+                self._file.close()
+                raise FileNotFoundError(f"{path} has an unexpected size.")
+            self._mmap = mmap.mmap(self._file.fileno(), _FILE_SIZE, access=mmap.ACCESS_READ)
+        self._data = memoryview(self._mmap).cast("d")
+
+    def close(self):
+        self._data.release()
+        self._mmap.close()
+        self._file.close()
+
+    def _push(self, tier: int, timestamp: float, values: List[float]):
+        d, base, points = self._data, _OFFSETS[tier], TIERS[tier][2]
+        head = int(d[base])
+        row = base + _HEADER + head * _ROW
+        d[row] = timestamp
+        for i, value in enumerate(values):
+            d[row + 1 + i] = value
+        d[base] = (head + 1) % points
+        d[base + 1] = min(d[base + 1] + 1, points)
+
+    def add(self, timestamp: float, values: List[float]):
+        """Records one raw sample and folds it into the coarser tiers' current buckets."""
+        self._push(0, timestamp, values)
+        d, fields = self._data, len(FIELDS)
+        for tier in range(1, len(TIERS)):
+            base, seconds = _OFFSETS[tier], TIERS[tier][1]
+            bucket = float(timestamp // seconds)
+            if d[base + 3] > 0 and d[base + 2] != bucket:
+                # The bucket is complete: store its averages and start the next one
+                sums, counts = base + 4, base + 4 + fields
+                means = [d[sums + i] / d[counts + i] if d[counts + i] else math.nan for i in range(fields)]
+                self._push(tier, d[base + 2] * seconds, means)
+                for i in range(2 * fields):
+                    d[base + 4 + i] = 0.0
+                d[base + 3] = 0.0
+            d[base + 2] = bucket
+            d[base + 3] += 1
+            for i, value in enumerate(values):
+                if not math.isnan(value):
+                    d[base + 4 + i] += value
+                    d[base + 4 + fields + i] += 1
+
+    def series(self, tier: int, since: float = 0) -> List[dict]:
+        """Points of one tier, oldest first, as {"t": epoch seconds, field: value or None}."""
+        d, base, points = self._data, _OFFSETS[tier], TIERS[tier][2]
+        head, count = int(d[base]), int(d[base + 1])
+        result = []
+        for n in range(count):
+            row = base + _HEADER + ((head - count + n) % points) * _ROW
+            if d[row] < since:
+                continue
+            point = {"t": d[row]}
+            for i, field in enumerate(FIELDS):
+                value = d[row + 1 + i]
+                point[field] = None if math.isnan(value) else round(value, 2)
+            result.append(point)
+        return result
+
+def tier_index(name: str) -> int:
+    for index, (tier_name, _, _) in enumerate(TIERS):
+        if tier_name == name:
+            return index
+    raise ValueError(f"Unknown resolution '{name}'. Choose one of: {', '.join(t[0] for t in TIERS)}")
+
+def read_series(vms_dir: Path, vm_name: str, resolution: str, since: float = 0) -> List[dict]:
+    """
+    Reads a VM's series from its metrics file. Empty if it was never sampled.
+    This is a blocking function intended to be run in a thread.
+    """
+    tier = tier_index(resolution)
+    path = vms_dir / vm_name / METRICS_FILE_NAME
+    try:
+        ring = MetricsRing(path)
+    except FileNotFoundError:
+        return []
+    try:
+        return ring.series(tier, since)
+    finally:
+        ring.close()
+#endregion
+
+
+
+#region --- Hypervisor Process Counters ---
+# VirtualBox runs each VM as e.g. `VBoxHeadless --comment <name> --startvm <uuid>`
+_VBOX_PROCESS_HINTS = ("vboxheadless", "virtualboxvm", "vboxsdl")
+_vm_processes: Dict[str, psutil.Process] = {}   # machine id -> process
+_last_rescan = 0.0
+_net_rates: Dict[str, Tuple[float, float]] = {}  # machine id -> (rx, tx) bytes per second
+_last_net_poll = 0.0
+_net_setup_ids: set = set()
+
+def _scan_vm_processes():
+    global _last_rescan
+    _last_rescan = time.monotonic()
+    for proc in psutil.process_iter(["name", "cmdline"]):
+        cmdline = proc.info["cmdline"] or []
+        words = " ".join([proc.info["name"] or "", *cmdline[:1]]).lower()
+        if "--startvm" not in cmdline[:-1] or not any(hint in words for hint in _VBOX_PROCESS_HINTS):
+            continue
+        _vm_processes[cmdline[cmdline.index("--startvm") + 1]] = proc
+
+def _vm_process(machine_id: str) -> Optional[psutil.Process]:
+    proc = _vm_processes.get(machine_id)
+    if proc is not None and proc.is_running():
+        return proc
+    _vm_processes.pop(machine_id, None)
+    if time.monotonic() - _last_rescan >= TELEMETRY_RESCAN_INTERVAL:
+        _scan_vm_processes()
+    return _vm_processes.get(machine_id)
+
+_RATE_UNITS = {"B/s": 1, "kB/s": 1e3, "MB/s": 1e6, "GB/s": 1e9}
+
+def _poll_network_rates(machine_ids: List[str]):
+    """
+    Refreshes _net_rates from VirtualBox's per-VM network metrics, which are
+    reported by VM name, so names are mapped back to machine ids first.
+    """
+    global _last_net_poll
+    _last_net_poll = time.monotonic()
+    new_ids = set(machine_ids) - _net_setup_ids
+    if new_ids:
+        run_vboxmanage("metrics", "setup", "--period", "1", "--samples", "1", "*", "Guest/Network/Rate")
+        _net_setup_ids.update(new_ids)
+    returncode, output = run_vboxmanage("list", "runningvms")
+    if returncode != 0:
+        return
+    ids_by_name = {m.group(1): m.group(2) for m in re.finditer(r'^"(.*)" \{([0-9a-f-]+)\}$', output, re.MULTILINE)}
+    returncode, output = run_vboxmanage("metrics", "query", "*", "Guest/Network/Rate/Rx,Guest/Network/Rate/Tx")
+    if returncode != 0:
+        return
+    rates: Dict[str, List[float]] = {}
+    for line in output.splitlines():
+        match = re.match(r"^(\S+)\s+Guest/Network/Rate/(Rx|Tx)\s+([\d.]+)\s*(\S+)", line)
+        if not match or match.group(1) not in ids_by_name:
+            continue
+        name, direction, value, unit = match.groups()
+        rate = rates.setdefault(ids_by_name[name], [0.0, 0.0])
+        rate[0 if direction == "Rx" else 1] = float(value) * _RATE_UNITS.get(unit, 1)
+    _net_rates.clear()
+    _net_rates.update({machine_id: tuple(rate) for machine_id, rate in rates.items()})
+
+def read_counters(vm_paths: Dict[str, Path]) -> Dict[str, dict]:
+    """
+    Cumulative CPU and disk counters, RSS and network rates of each VM's
+    hypervisor process. VMs without a running process are left out.
+    Used locally by the sampler and remotely through the node agent.
+    This is a blocking function intended to be run in a thread.
+    """
+    machine_ids = {name: vbox_machine_id(str(path)) for name, path in vm_paths.items()}
+    machine_ids = {name: machine_id for name, machine_id in machine_ids.items() if machine_id}
+    if machine_ids and time.monotonic() - _last_net_poll >= TELEMETRY_NET_INTERVAL:
+        try:
+            _poll_network_rates(list(machine_ids.values()))
+        except Exception as e:
+            print(f"[TELEMETRY] Could not read VirtualBox network metrics: {e}")
+
+    counters = {}
+    for name, machine_id in machine_ids.items():
+        proc = _vm_process(machine_id)
+        if proc is None:
+            continue
+        try:
+            with proc.oneshot():
+                cpu = proc.cpu_times()
+                sample = {"cpu_seconds": cpu.user + cpu.system, "rss_bytes": proc.memory_info().rss}
+                try:
+                    io = proc.io_counters()
+                    sample.update(read_bytes=io.read_bytes, write_bytes=io.write_bytes)
+                except (AttributeError, psutil.AccessDenied):
+                    pass  # Not available on macOS
+        except (psutil.NoSuchProcess, psutil.AccessDenied):
+            continue
+        if machine_id in _net_rates:
+            sample["net_rx_bps"], sample["net_tx_bps"] = _net_rates[machine_id]
+        counters[name] = sample
+    return counters
+#endregion
+
+
+
+#region --- Sampler ---
+def _rate(current: dict, previous: dict | None, key: str, elapsed: float, scale: float) -> float:
+    if previous is None or key not in current or key not in previous or elapsed <= 0:
+        return math.nan
+    return max(0.0, current[key] - previous[key]) / elapsed / scale
+
+def _to_values(current: dict, previous: Tuple[float, dict] | None, now: float) -> List[float]:
+    elapsed = now - previous[0] if previous else 0
+    before = previous[1] if previous else None
+    return [
+        _rate(current, before, "cpu_seconds", elapsed, 0.01),   # percent of one host core
+        current["rss_bytes"] / (1024 * 1024),
+        _rate(current, before, "read_bytes", elapsed, 1024),
+        _rate(current, before, "write_bytes", elapsed, 1024),
+        current.get("net_rx_bps", math.nan) / 1024,
+        current.get("net_tx_bps", math.nan) / 1024,
+    ]
+
+async def _node_counters(node_name: str, vm_names: List[str], vms_dir: Path) -> Dict[str, dict]:
+    node = get_node(node_name)
+    if node.is_local:
+        return await asyncio.to_thread(read_counters, {name: vms_dir / name for name in vm_names})
+    return await get_agent_counters(node, vm_names)
+
+async def telemetry_sampler(vms_dir: Path):
+    """
+    Leader loop: samples every Active VM each TELEMETRY_INTERVAL seconds and
+    appends to its metrics file. Files of VMs that stop being Active are closed.
+    """
+    # Imported here so the agent can use read_counters without the controller's DB
+    from database import async_session_factory
+    from crud import get_vms_by_status
+
+    rings: Dict[str, MetricsRing] = {}
+    previous: Dict[str, Tuple[float, dict]] = {}
+    try:
+        while True:
+            started = time.monotonic()
+            try:
+                async with async_session_factory() as db:
+                    vms = await get_vms_by_status(db, "Active")
+                by_node: Dict[str, List[str]] = {}
+                for vm in vms:
+                    by_node.setdefault(vm.node, []).append(vm.name)
+
+                results = await asyncio.gather(
+                    *(_node_counters(node, names, vms_dir) for node, names in by_node.items()), return_exceptions=True
+                )
+                now = time.time()
+                for node, counters in zip(by_node, results):
+                    if isinstance(counters, Exception):
+                        print(f"[TELEMETRY] Could not sample node '{node}': {counters}")
+                        continue
+                    for name, current in counters.items():
+                        if name not in rings:
+                            if not (vms_dir / name).exists():
+                                continue
+                            rings[name] = MetricsRing(vms_dir / name / METRICS_FILE_NAME, writable=True)
+                        rings[name].add(now, _to_values(current, previous.get(name), now))
+                        previous[name] = (now, current)
+
+                active = {vm.name for vm in vms}
+                for name in list(rings):
+                    if name not in active:
+                        rings.pop(name).close()
+                        previous.pop(name, None)
+            except Exception as e:
+                print(f"[TELEMETRY] Sampling failed: {e}")
+            await asyncio.sleep(max(0.0, TELEMETRY_INTERVAL - (time.monotonic() - started)))
+    finally:
+        for ring in rings.values():
+            ring.close()
+#endregion
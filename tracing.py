@@ -0,0 +1,304 @@
+import os
+import re
+import json
+import time
+import queue
+import inspect
+import functools
+import threading
+from collections import deque
+from contextlib import contextmanager
+from contextvars import ContextVar
+from pathlib import Path
+from typing import Dict, List, Optional
+from uuid import uuid4
+
+from dotenv import load_dotenv
+
+from asgi import get_header
+
+load_dotenv()
+
+#region -------------Settings--------
+BASE_DIR = Path(__file__).parent
+TRACE_DIR = Path(os.environ.get("TRACE_DIR", BASE_DIR / ".traces"))
+# "memory" (this worker only), "file" (JSONL under TRACE_DIR, shared by all
+# workers) or "none"
+TRACE_EXPORTER = os.environ.get("TRACE_EXPORTER", "memory")
+# Finished spans kept in memory (for either exporter), newest last
+TRACE_MEMORY_SPANS = int(os.environ.get("TRACE_MEMORY_SPANS", "10000"))
+# spans.jsonl moves to spans.jsonl.1 past this size
+TRACE_FILE_MAX_MB = float(os.environ.get("TRACE_FILE_MAX_MB", "20"))
+TRACE_FILE_NAME = "spans.jsonl"
+TRACE_HEADER = b"x-trace-id"
+TRACE_ID_PATTERN = re.compile(r"^[0-9a-f]{32}$")
+
+if TRACE_EXPORTER not in ("file", "memory", "none"):
+    raise ValueError(f"TRACE_EXPORTER must be 'file', 'memory' or 'none', not '{TRACE_EXPORTER}'")
+#endregion
+
+
+
+#region --- Spans ---
+class Span:
+    """One timed operation. Spans of one trace share a trace_id and link to their parent."""
+    def __init__(self, name: str, trace_id: str, parent_id: Optional[str], attributes: dict):
+        self.name = name
+        self.trace_id = trace_id
+        self.span_id = uuid4().hex[:16]
+        self.parent_id = parent_id
+        self.attributes = attributes
+        self.start = time.time()
+        self.duration: Optional[float] = None
+        self.error: Optional[str] = None
+
+    def set(self, **attributes):
+        self.attributes.update(attributes)
+
+    def end(self, error: Optional[BaseException] = None):
+        if self.duration is not None:
+            return
+        self.duration = time.time() - self.start
+        if error is not None:
+            self.error = f"{type(error).__name__}: {error}"
+        EXPORTER.export(self)
+
+    def to_dict(self) -> dict:
+        return {
+            "trace_id": self.trace_id,
+            "span_id": self.span_id,
+            "parent_id": self.parent_id,
+            "name": self.name,
+            "start": self.start,
+            "duration": self.duration,
+            "attributes": self.attributes,
+            "error": self.error,
+        }
+
+# The span new spans become children of. Copied into asyncio tasks, Starlette
+# background tasks and asyncio.to_thread, so a trace follows the work there.
+_current_span: ContextVar[Optional[Span]] = ContextVar("current_span", default=None)
+
+def current_trace_id() -> Optional[str]:
+    span = _current_span.get()
+    return span.trace_id if span else None
+
+def annotate(**attributes):
+    """Adds attributes to the current span, if there is one."""
+    span = _current_span.get()
+    if span is not None:
+        span.set(**attributes)
+
+def start_span(name: str, trace_id: Optional[str] = None, **attributes) -> Span:
+    """
+    A span under the current one (or the root of a new trace) that is not made
+    current. Call end() on it.
+    """
+    parent = _current_span.get()
+    if parent is not None and trace_id is None:
+        return Span(name, parent.trace_id, parent.span_id, attributes)
+    return Span(name, trace_id or uuid4().hex, None, attributes)
+
+@contextmanager
+def span(name: str, **attributes):
+    """Times the block as a child of the current span; spans started inside it become its children."""
+    s = start_span(name, **attributes)
+    token = _current_span.set(s)
+    try:
+        yield s
+    except BaseException as e:
+        s.end(error=e)
+        raise
+    else:
+        s.end()
+    finally:
+        _current_span.reset(token)
+
+def traced(name: str):
+    """Decorator form of span() for async and plain functions."""
+    def decorator(func):
+        if inspect.iscoroutinefunction(func):
+            @functools.wraps(func)
+            async def async_wrapper(*args, **kwargs):
+                with span(name):
+                    return await func(*args, **kwargs)
+            return async_wrapper
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with span(name):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+#endregion
+
+
+
+#region --- Exporter ---
+class SpanExporter:
+    """
+    Keeps the last TRACE_MEMORY_SPANS finished spans in memory and, with the file
+    exporter, appends each one to TRACE_DIR/spans.jsonl from a writer thread, so
+    ending a span never waits on disk.
+    """
+    def __init__(self):
+        self._recent: deque = deque(maxlen=TRACE_MEMORY_SPANS)
+        self._queue: queue.Queue = queue.Queue(maxsize=10000)
+        self._thread: threading.Thread | None = None
+        self.dropped = 0
+
+    def export(self, span: Span):
+        if TRACE_EXPORTER == "none":
+            return
+        record = span.to_dict()
+        self._recent.append(record)
+        if TRACE_EXPORTER != "file":
+            return
+        if self._thread is None or not self._thread.is_alive():
+            self._thread = threading.Thread(target=self._run, name="span-writer", daemon=True)
+            self._thread.start()
+        try:
+            self._queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+    def flush(self):
+        """Waits until every queued span is on disk (e.g. at shutdown)."""
+        if self._thread is not None and self._thread.is_alive():
+            self._queue.join()
+
+    def _run(self):
+        TRACE_DIR.mkdir(parents=True, exist_ok=True)
+        path = TRACE_DIR / TRACE_FILE_NAME
+        while True:
+            records = [self._queue.get()]
+            # Write out whatever else queued up in the meantime in one go
+            while True:
+                try:
+                    records.append(self._queue.get_nowait())
+                except queue.Empty:
+                    break
+            try:
+                with open(path, "a") as f:
+                    f.write("".join(json.dumps(record, default=str) + "\n" for record in records))
+                    size = f.tell()
+                if size > TRACE_FILE_MAX_MB * 1024 * 1024:
+                    os.replace(path, path.with_name(f"{TRACE_FILE_NAME}.1"))
+            except Exception as e:
+                print(f"[TRACE] Could not write spans: {e}")
+            finally:
+                for _ in records:
+                    self._queue.task_done()
+
+    def read_trace(self, trace_id: str) -> List[dict]:
+        """
+        Every exported span of a trace, in start order.
+        This is a blocking function intended to be run in a thread.
+        """
+        spans: Dict[str, dict] = {s["span_id"]: s for s in list(self._recent) if s["trace_id"] == trace_id}
+        if TRACE_EXPORTER == "file":
+            self.flush()
+            for path in (TRACE_DIR / f"{TRACE_FILE_NAME}.1", TRACE_DIR / TRACE_FILE_NAME):
+                if not path.exists():
+                    continue
+                with open(path) as f:
+                    for line in f:
+                        if trace_id in line:
+                            try:
+                                record = json.loads(line)
+                            except ValueError:
+                                continue
+                            if record["trace_id"] == trace_id:
+                                spans[record["span_id"]] = record
+        return sorted(spans.values(), key=lambda s: s["start"])
+
+EXPORTER = SpanExporter()
+
+def trace_tree(spans: List[dict]) -> List[dict]:
+    """
+    Nests spans under their parents, with times in ms relative to the first span.
+    Spans whose parent was not exported become roots.
+    """
+    if not spans:
+        return []
+    origin = min(s["start"] for s in spans)
+    nodes = {
+        s["span_id"]: {
+            "name": s["name"],
+            "offset_ms": round((s["start"] - origin) * 1000, 1),
+            "duration_ms": round(s["duration"] * 1000, 1) if s["duration"] is not None else None,
+            "attributes": s["attributes"],
+            "error": s["error"],
+            "children": [],
+        }
+        for s in spans
+    }
+    roots = []
+    for s in spans:
+        parent = nodes.get(s["parent_id"]) if s["parent_id"] else None
+        (parent["children"] if parent else roots).append(nodes[s["span_id"]])
+    return roots
+#endregion
+
+
+
+#region --- Instrumentation ---
+def trace_sqlalchemy(sync_engine):
+    """A "db.query" span around every statement run on the engine."""
+    from sqlalchemy import event
+
+    @event.listens_for(sync_engine, "before_cursor_execute")
+    def _before(conn, cursor, statement, parameters, context, executemany):
+        if _current_span.get() is not None:
+            conn.info.setdefault("trace_spans", []).append(start_span("db.query", statement=" ".join(statement.split())[:200]))
+
+    @event.listens_for(sync_engine, "after_cursor_execute")
+    def _after(conn, cursor, statement, parameters, context, executemany):
+        spans = conn.info.get("trace_spans")
+        if spans:
+            spans.pop().end()
+
+    @event.listens_for(sync_engine, "handle_error")
+    def _error(context):
+        spans = context.connection.info.get("trace_spans") if context.connection is not None else None
+        if spans:
+            spans.pop().end(error=context.original_exception)
+
+class TracingMiddleware:
+    """
+    Starts a trace for each HTTP request (or continues the one named by an
+    incoming X-Trace-Id header) and returns its id in X-Trace-Id. The request
+    span ends when the response is sent; background tasks the request scheduled
+    run afterwards as its children, so the trace covers them too.
+    """
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or TRACE_EXPORTER == "none":
+            return await self.app(scope, receive, send)
+        incoming = (get_header(scope, TRACE_HEADER) or "").lower()
+        request_span = start_span(
+            f"{scope['method']} {scope['path']}",
+            trace_id=incoming if TRACE_ID_PATTERN.match(incoming) else None,
+            method=scope["method"], path=scope["path"],
+        )
+
+        async def send_wrapper(message):
+            if message["type"] == "http.response.start":
+                request_span.set(status=message["status"])
+                message["headers"] = [*message.get("headers", []), (TRACE_HEADER, request_span.trace_id.encode())]
+            elif message["type"] == "http.response.body" and not message.get("more_body", False):
+                request_span.end()
+            await send(message)
+
+        token = _current_span.set(request_span)
+        try:
+            await self.app(scope, receive, send_wrapper)
+        except BaseException as e:
+            request_span.end(error=e)
+            raise
+        finally:
+            request_span.end()
+            _current_span.reset(token)
+#endregion
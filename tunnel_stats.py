@@ -0,0 +1,258 @@
+import os
+import json
+import time
+import base64
+import asyncio
+import urllib.request
+from pathlib import Path
+from typing import Callable, Dict, List, Optional
+
+from dotenv import load_dotenv
+
+from frp import FrpcClient, _configured_clients, shard_admin_port
+from gateways import Gateway, GATEWAYS
+from coordination import LOCK_DIR
+
+load_dotenv()
+
+#region -------------Settings--------
+# Seconds between polls on the leader worker; 0 turns collection off
+TUNNEL_STATS_INTERVAL = float(os.environ.get("TUNNEL_STATS_INTERVAL", "30"))
+# Written by the leader, read by every worker
+TUNNEL_STATS_PATH = Path(os.environ.get("TUNNEL_STATS_PATH", LOCK_DIR / "tunnel_stats.json"))
+# Where the frpc admin APIs listen (the shard configs bind them to 127.0.0.1)
+FRPC_ADMIN_HOST = os.environ.get("FRPC_ADMIN_HOST", "127.0.0.1")
+TUNNEL_STATS_TIMEOUT = float(os.environ.get("TUNNEL_STATS_TIMEOUT", "5"))
+# Stats older than this many intervals are not used as evidence of activity
+TUNNEL_STATS_STALE_INTERVALS = 3
+FRPS_PROXY_TYPES = ("tcp", "udp", "http")
+# Bearer token a Prometheus scraper sends to read /metrics; admins can always read it
+METRICS_TOKEN = os.environ.get("METRICS_TOKEN")
+#endregion
+
+
+
+#region --- Sources ---
+def _get_json(url: str, user: Optional[str] = None, password: Optional[str] = None) -> dict:
+    """This is a blocking function intended to be run in a thread."""
+    request = urllib.request.Request(url)
+    if user:
+        credentials = base64.b64encode(f"{user}:{password or ''}".encode()).decode()
+        request.add_header("Authorization", f"Basic {credentials}")
+    with urllib.request.urlopen(request, timeout=TUNNEL_STATS_TIMEOUT) as response:
+        return json.loads(response.read().decode())
+
+def frpc_admin_url(gateway: str, shard: int) -> str:
+    return f"http://{FRPC_ADMIN_HOST}:{shard_admin_port(gateway, shard)}"
+
+def read_frpc_status(admin_url: str) -> Dict[str, dict]:
+    """
+    {proxy name: state} from one frpc client's admin API (GET /api/status).
+    frpc only knows whether each proxy is running, not its traffic.
+    This is a blocking function intended to be run in a thread.
+    """
+    status = _get_json(f"{admin_url.rstrip('/')}/api/status")
+    return {
+        proxy["name"]: {
+            "type": proxy.get("type", proxy_type),
+            "status": proxy.get("status"),
+            "error": proxy.get("err") or None,
+        }
+        for proxy_type, proxies in status.items()
+        for proxy in proxies or []
+    }
+
+def read_frps_traffic(gateway: Gateway) -> Dict[str, dict]:
+    """
+    {proxy name: counters} from the gateway's frps dashboard (GET /api/proxy/<type>).
+    frps counts traffic per day, so the byte counters restart at midnight.
+    This is a blocking function intended to be run in a thread.
+    """
+    traffic = {}
+    for proxy_type in FRPS_PROXY_TYPES:
+        result = _get_json(f"{gateway.dashboard_url.rstrip('/')}/api/proxy/{proxy_type}", gateway.dashboard_user, gateway.dashboard_password)
+        for proxy in result.get("proxies") or []:
+            # frps prefixes names with the frpc `user`, when one is set
+            name = proxy["name"].split(".", 1)[-1]
+            traffic[name] = {
+                "connections": proxy.get("curConns", 0),
+                "bytes_in": proxy.get("todayTrafficIn", 0),
+                "bytes_out": proxy.get("todayTrafficOut", 0),
+            }
+    return traffic
+#endregion
+
+
+
+#region --- Collection ---
+def _proxy_vm(name: str) -> Optional[tuple]:
+    """(vm name, vm port) from a "{vm}-{port}" proxy name, or None for other proxies."""
+    vm_name, _, port = name.rpartition("-")
+    return (vm_name, int(port)) if vm_name and port.isdigit() else None
+
+def collect_tunnel_stats(
+    clients: Optional[List[FrpcClient]] = None,
+    gateways: Optional[List[Gateway]] = None,
+    admin_url: Callable[[str, int], str] = frpc_admin_url,
+) -> dict:
+    """
+    Polls every frpc client and every gateway dashboard once, merges the answers
+    per proxy and writes them to TUNNEL_STATS_PATH. A proxy's last_active_at
+    moves whenever it has open connections or its byte counters changed.
+    clients and gateways default to the configured ones; frp_standin.py passes
+    its own to check the collector without a real frp.
+    This is a blocking function intended to be run in a thread.
+    """
+    previous = load_tunnel_stats().get("proxies", {})
+    now = time.time()
+    proxies: Dict[str, dict] = {}
+    errors: List[str] = []
+
+    for gateway, shard in sorted(_configured_clients() if clients is None else clients):
+        try:
+            states = read_frpc_status(admin_url(gateway, shard))
+        except Exception as e:
+            errors.append(f"frpc {gateway}/{shard}: {e}")
+            continue
+        for name, state in states.items():
+            proxies[name] = {**state, "gateway": gateway, "shard": shard, "connections": None, "bytes_in": None, "bytes_out": None}
+
+    for gateway in GATEWAYS if gateways is None else gateways:
+        if not gateway.dashboard_url:
+            continue
+        try:
+            traffic = read_frps_traffic(gateway)
+        except Exception as e:
+            errors.append(f"frps {gateway.name}: {e}")
+            continue
+        for name, counters in traffic.items():
+            if name in proxies and proxies[name]["gateway"] == gateway.name:
+                proxies[name].update(counters)
+
+    for name, proxy in proxies.items():
+        owner = _proxy_vm(name)
+        proxy["vm"], proxy["vm_port"] = owner if owner else (None, None)
+        before = previous.get(name, {})
+        active = bool(proxy["connections"]) or (
+            proxy["bytes_in"] is not None
+            and (proxy["bytes_in"], proxy["bytes_out"]) != (before.get("bytes_in"), before.get("bytes_out"))
+            and (proxy["bytes_in"] or proxy["bytes_out"])
+        )
+        proxy["last_active_at"] = now if active else before.get("last_active_at")
+
+    stats = {"updated_at": now, "proxies": proxies, "errors": errors}
+    TUNNEL_STATS_PATH.parent.mkdir(parents=True, exist_ok=True)
+    temp_path = TUNNEL_STATS_PATH.with_suffix(f".{os.getpid()}.tmp")
+    with open(temp_path, "w") as f:
+        json.dump(stats, f)
+    os.replace(temp_path, TUNNEL_STATS_PATH)
+    return stats
+
+async def tunnel_stats_loop():
+    """Leader-only loop around collect_tunnel_stats."""
+    while True:
+        try:
+            stats = await asyncio.to_thread(collect_tunnel_stats)
+            for error in stats["errors"]:
+                print(f"[TUNNEL STATS] {error}")
+        except Exception as e:
+            print(f"[TUNNEL STATS] Collection failed: {e}")
+        await asyncio.sleep(TUNNEL_STATS_INTERVAL)
+#endregion
+
+
+
+#region --- Readers ---
+_loaded = {"mtime": None, "stats": {}}
+
+def load_tunnel_stats() -> dict:
+    """
+    The last collected stats ({} before the first collection). Re-read only when
+    the leader has written a new file.
+    This is a blocking function intended to be run in a thread.
+    """
+    try:
+        mtime = TUNNEL_STATS_PATH.stat().st_mtime_ns
+    except FileNotFoundError:
+        return {}
+    if mtime != _loaded["mtime"]:
+        try:
+            with open(TUNNEL_STATS_PATH) as f:
+                _loaded.update(mtime=mtime, stats=json.load(f))
+        except (OSError, ValueError) as e:
+            print(f"[TUNNEL STATS] Could not read {TUNNEL_STATS_PATH}: {e}")
+    return _loaded["stats"]
+
+def rule_stats(stats: dict, vm_name: str, rule: dict) -> Optional[dict]:
+    """A rule's tunnel stats as shown in /list-vms, or None if it has none."""
+    proxy = stats.get("proxies", {}).get(f"{vm_name}-{rule.get('vm_port')}")
+    if proxy is None:
+        return None
+    return {
+        "status": proxy["status"],
+        "error": proxy["error"],
+        "connections": proxy["connections"],
+        "bytes_in": proxy["bytes_in"],
+        "bytes_out": proxy["bytes_out"],
+        "last_active_at": proxy["last_active_at"],
+        "updated_at": stats["updated_at"],
+    }
+
+async def tunnel_activity(vms: list) -> Dict[str, int]:
+    """
+    Idle-policy activity provider: open connections per VM, from recent stats
+    that include frps counters. VMs without such stats are left out.
+    """
+    stats = await asyncio.to_thread(load_tunnel_stats)
+    if not stats or time.time() - stats["updated_at"] > TUNNEL_STATS_STALE_INTERVALS * max(TUNNEL_STATS_INTERVAL, 1):
+        return {}
+    names = {vm.name for vm in vms}
+    connections: Dict[str, int] = {}
+    for proxy in stats["proxies"].values():
+        if proxy["vm"] in names and proxy["connections"] is not None:
+            connections[proxy["vm"]] = connections.get(proxy["vm"], 0) + proxy["connections"]
+    return connections
+#endregion
+
+
+
+#region --- Metrics ---
+def _label_value(value) -> str:
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+def render_metrics(stats: dict) -> str:
+    """The stats in the Prometheus text exposition format."""
+    series = {
+        "nimbus_tunnel_up": ("gauge", "1 if frpc reports the proxy running.", []),
+        "nimbus_tunnel_connections": ("gauge", "Open connections through the tunnel, per frps.", []),
+        "nimbus_tunnel_bytes_in_total": ("counter", "Bytes in through the tunnel today, per frps.", []),
+        "nimbus_tunnel_bytes_out_total": ("counter", "Bytes out through the tunnel today, per frps.", []),
+        "nimbus_tunnel_last_active_timestamp_seconds": ("gauge", "When the tunnel last had connections or traffic.", []),
+    }
+    for name, proxy in sorted(stats.get("proxies", {}).items()):
+        labels = ",".join(
+            f'{key}="{_label_value(value)}"'
+            for key, value in (("proxy", name), ("vm", proxy["vm"] or ""), ("gateway", proxy["gateway"]), ("shard", proxy["shard"]), ("type", proxy["type"]))
+        )
+        values = {
+            "nimbus_tunnel_up": 1 if proxy["status"] == "running" else 0,
+            "nimbus_tunnel_connections": proxy["connections"],
+            "nimbus_tunnel_bytes_in_total": proxy["bytes_in"],
+            "nimbus_tunnel_bytes_out_total": proxy["bytes_out"],
+            "nimbus_tunnel_last_active_timestamp_seconds": proxy["last_active_at"],
+        }
+        for metric, value in values.items():
+            if value is not None:
+                series[metric][2].append(f"{metric}{{{labels}}} {value}")
+
+    lines = []
+    for metric, (metric_type, help_text, samples) in series.items():
+        lines += [f"# HELP {metric} {help_text}", f"# TYPE {metric} {metric_type}", *samples]
+    if stats:
+        lines += [
+            "# HELP nimbus_tunnel_stats_updated_timestamp_seconds When the tunnel stats were last collected.",
+            "# TYPE nimbus_tunnel_stats_updated_timestamp_seconds gauge",
+            f"nimbus_tunnel_stats_updated_timestamp_seconds {stats['updated_at']}",
+        ]
+    return "\n".join(lines) + "\n"
+#endregion
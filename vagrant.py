@@ -0,0 +1,28 @@
+import subprocess
+from typing import Callable, List, Optional, Tuple
+
+
+def stream_vagrant(vm_path: str, *args: str, on_line: Optional[Callable[[str], None]] = None) -> Tuple[int, str]:
+    """
+    Runs `vagrant <args>` in vm_path, echoing its output as it arrives
+    (and passing each line to on_line, if given).
+    Returns (exit code, output). The exit code is -1 if vagrant could not be run.
+    This is a blocking function intended to be run in a thread.
+    """
+    command = " ".join(args)
+    output: List[str] = []
+    try:
+        process = subprocess.Popen(["vagrant", *args], cwd=vm_path, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, text=True)
+        for line in process.stdout:
+            output.append(line)
+            print(f"[VAGRANT {command.upper()}]: {line}", end="")
+            if on_line:
+                on_line(line)
+        process.wait()
+        print(f"[INFO] Vagrant {command} exited with code: {process.returncode}")
+        return process.returncode, "".join(output)
+    except Exception as e:
+        print(f"[ERROR] Exception during Vagrant {command}: {e}")
+        if on_line:
+            on_line(f"Exception during vagrant {command}: {e}\n")
+        return -1, "".join(output) + str(e)
@@ -0,0 +1,176 @@
+import os
+import copy
+import mmap
+import time
+import zlib
+import struct
+from collections import OrderedDict
+from typing import Dict, Optional, Set, Tuple
+
+from dotenv import load_dotenv
+from sqlalchemy import event, inspect
+from sqlalchemy.orm import Session, make_transient_to_detached
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from coordination import LOCK_DIR
+from models import VM
+
+load_dotenv()
+
+#region -------------Settings--------
+VM_CACHE_ENABLED = os.environ.get("VM_CACHE_ENABLED", "true").lower() == "true"
+# VMs kept per worker; the least recently used one is dropped past this
+VM_CACHE_SIZE = int(os.environ.get("VM_CACHE_SIZE", "2048"))
+# Upper bound on an entry's age, for writes made outside this app (e.g. by hand in nimbus.db)
+VM_CACHE_TTL = float(os.environ.get("VM_CACHE_TTL", "300"))
+# Version counters shared by all workers. A VM's key hashes to one slot; a
+# write to the VM bumps it, which makes every worker's copy stale.
+VM_CACHE_VERSIONS = LOCK_DIR / "vm_cache.versions"
+VM_CACHE_SLOTS = int(os.environ.get("VM_CACHE_SLOTS", "4096"))
+#endregion
+
+
+
+#region --- Shared Versions ---
+_COUNTER = struct.Struct("<Q")
+
+class SharedVersions:
+    """
+    A memory-mapped array of VM_CACHE_SLOTS counters in VM_CACHE_VERSIONS.
+    Reads and bumps are plain memory accesses, so they are cheap enough to do
+    on every lookup. Two workers bumping one slot at once may lose an increment,
+    but the slot still changes, which is all a reader checks.
+    """
+    def __init__(self, path, slots: int):
+        self.slots = slots
+        path.parent.mkdir(parents=True, exist_ok=True)
+        size = slots * _COUNTER.size
+        with open(path, "a+b") as f:
+            if os.path.getsize(path) < size:
+                f.truncate(size)
+            self._map = mmap.mmap(f.fileno(), size)
+
+    def slot(self, key: Tuple[str, str]) -> int:
+        # crc32 rather than hash(), which differs between worker processes
+        return zlib.crc32(f"{key[0]}/{key[1]}".encode()) % self.slots
+
+    def get(self, key: Tuple[str, str]) -> int:
+        return _COUNTER.unpack_from(self._map, self.slot(key) * _COUNTER.size)[0]
+
+    def bump(self, key: Tuple[str, str]):
+        offset = self.slot(key) * _COUNTER.size
+        _COUNTER.pack_into(self._map, offset, (_COUNTER.unpack_from(self._map, offset)[0] + 1) % 2**64)
+#endregion
+
+
+
+#region --- VM Cache ---
+_COLUMNS = [attr.key for attr in inspect(VM).column_attrs]
+
+def _cache_key(owner_id, name: str) -> Tuple[str, str]:
+    return str(owner_id), name
+
+class VMCache:
+    """
+    Column values of recently looked-up VMs, keyed by (owner_id, name), in LRU
+    order. Each entry remembers the shared version of its key when it was read
+    from the database; a lookup only uses it while that version is unchanged.
+    """
+    def __init__(self, size: int, ttl: float):
+        self.size = size
+        self.ttl = ttl
+        self._entries: "OrderedDict[Tuple[str, str], Tuple[int, float, dict]]" = OrderedDict()
+        self._versions: Optional[SharedVersions] = None
+        self.hits = 0
+        self.misses = 0
+        self.stale = 0
+        self.evictions = 0
+        self.invalidations = 0
+
+    @property
+    def versions(self) -> SharedVersions:
+        if self._versions is None:
+            self._versions = SharedVersions(VM_CACHE_VERSIONS, VM_CACHE_SLOTS)
+        return self._versions
+
+    def version(self, key: Tuple[str, str]) -> int:
+        return self.versions.get(key)
+
+    def get(self, key: Tuple[str, str]) -> Optional[dict]:
+        entry = self._entries.get(key)
+        if entry is None:
+            self.misses += 1
+            return None
+        version, stored_at, values = entry
+        if version != self.version(key) or time.monotonic() - stored_at > self.ttl:
+            del self._entries[key]
+            self.stale += 1
+            return None
+        self._entries.move_to_end(key)
+        self.hits += 1
+        return values
+
+    def put(self, key: Tuple[str, str], version: int, vm: VM):
+        """Stores vm as of `version`, read before the query that loaded it."""
+        values = {column: copy.deepcopy(getattr(vm, column)) for column in _COLUMNS}
+        self._entries[key] = (version, time.monotonic(), values)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.size:
+            self._entries.popitem(last=False)
+            self.evictions += 1
+
+    def invalidate(self, key: Tuple[str, str]):
+        self.versions.bump(key)
+        self._entries.pop(key, None)
+        self.invalidations += 1
+
+    def stats(self) -> dict:
+        lookups = self.hits + self.misses + self.stale
+        return {
+            "enabled": VM_CACHE_ENABLED,
+            "size": len(self._entries),
+            "max_size": self.size,
+            "hits": self.hits,
+            "misses": self.misses,
+            "stale": self.stale,
+            "evictions": self.evictions,
+            "invalidations": self.invalidations,
+            "hit_ratio": round(self.hits / lookups, 4) if lookups else None,
+        }
+
+VM_CACHE = VMCache(VM_CACHE_SIZE, VM_CACHE_TTL)
+
+async def cached_user_vm(db: AsyncSession, key: Tuple[str, str]) -> Optional[VM]:
+    """The cached VM attached to db (no query), or None on a miss."""
+    values = VM_CACHE.get(key)
+    if values is None:
+        return None
+    vm = VM(**copy.deepcopy(values))
+    make_transient_to_detached(vm)
+    # Hands back the session's own instance if it already loaded this VM
+    return await db.merge(vm, load=False)
+#endregion
+
+
+
+#region --- Invalidation ---
+# Every VM insert, update and delete goes through a Session flush, whichever
+# endpoint, background task or loop made it. The keys are bumped once the
+# transaction commits: bumping at flush time would let another request re-cache
+# the old row before the commit made the new one visible.
+@event.listens_for(Session, "after_flush")
+def _collect_vm_writes(session, flush_context):
+    keys: Set[Tuple[str, str]] = session.info.setdefault("vm_cache_keys", set())
+    for obj in (*session.new, *session.dirty, *session.deleted):
+        if isinstance(obj, VM):
+            keys.add(_cache_key(obj.owner_id, obj.name))
+
+@event.listens_for(Session, "after_commit")
+def _invalidate_vm_writes(session):
+    for key in session.info.pop("vm_cache_keys", ()):
+        VM_CACHE.invalidate(key)
+
+@event.listens_for(Session, "after_rollback")
+def _discard_vm_writes(session):
+    session.info.pop("vm_cache_keys", None)
+#endregion
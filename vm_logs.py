@@ -0,0 +1,169 @@
+import os
+import mmap
+import queue
+import threading
+from datetime import datetime, timezone
+from pathlib import Path
+from typing import Callable, Dict
+
+from dotenv import load_dotenv
+
+load_dotenv()
+
+#region -------------Settings--------
+# Each VM's current log is rotated once it grows past this many bytes
+VM_LOG_MAX_BYTES = int(os.environ.get("VM_LOG_MAX_BYTES", str(5 * 1024 * 1024)))
+# Rotated files kept per VM (lifecycle.log.1 is the newest)
+VM_LOG_BACKUPS = int(os.environ.get("VM_LOG_BACKUPS", "3"))
+# Lines waiting to be written. When full, new lines are dropped rather than
+# blocking the vagrant/driver thread that produced them.
+VM_LOG_QUEUE_SIZE = int(os.environ.get("VM_LOG_QUEUE_SIZE", "10000"))
+# Largest byte range one read may return
+VM_LOG_MAX_READ = int(os.environ.get("VM_LOG_MAX_READ", str(1024 * 1024)))
+LOG_FILE_NAME = "lifecycle.log"
+#endregion
+
+
+
+#region --- Log Store ---
+class VMLogStore:
+    """
+    Per-VM lifecycle logs under <vms_dir>/<vm>/logs. Producers only enqueue;
+    a single writer thread owns the open files, appends and rotates them.
+    """
+    def __init__(self, vms_dir: Path):
+        self.vms_dir = vms_dir
+        self._queue: queue.Queue = queue.Queue(maxsize=VM_LOG_QUEUE_SIZE)
+        self._files: Dict[str, object] = {}
+        self._thread: threading.Thread | None = None
+        self.dropped = 0
+
+    def log_dir(self, vm_name: str) -> Path:
+        return self.vms_dir / vm_name / "logs"
+
+    def log_path(self, vm_name: str, backup: int = 0) -> Path:
+        name = LOG_FILE_NAME if backup == 0 else f"{LOG_FILE_NAME}.{backup}"
+        return self.log_dir(vm_name) / name
+
+    def start(self):
+        if self._thread is None or not self._thread.is_alive():
+            self._thread = threading.Thread(target=self._run, name="vm-log-writer", daemon=True)
+            self._thread.start()
+
+    def stop(self):
+        """Writes out everything queued so far and stops the writer thread."""
+        if self._thread is not None and self._thread.is_alive():
+            self._queue.put(None)
+            self._thread.join()
+        self._thread = None
+
+    def write(self, vm_name: str, stage: str, line: str):
+        """Queues one line for the VM's log. Never blocks."""
+        self.start()
+        timestamp = datetime.now(timezone.utc).strftime("%Y-%m-%dT%H:%M:%S.%fZ")
+        text = f"{timestamp} [{stage}] {line.rstrip(chr(10))}\n"
+        try:
+            self._queue.put_nowait(("write", vm_name, text))
+        except queue.Full:
+            self.dropped += 1
+
+    def writer(self, vm_name: str, stage: str) -> Callable[[str], None]:
+        """A log callback for drivers (see drivers.LogCallback)."""
+        return lambda line: self.write(vm_name, stage, line)
+
+    def close(self, vm_name: str):
+        """
+        Flushes and closes the VM's log file, e.g. before its directory is removed.
+        This is a blocking function intended to be run in a thread.
+        """
+        if self._thread is None or not self._thread.is_alive():
+            return
+        done = threading.Event()
+        self._queue.put(("close", vm_name, done))
+        done.wait()
+
+    def _run(self):
+        while True:
+            item = self._queue.get()
+            if item is None:
+                break
+            action, vm_name, payload = item
+            try:
+                if action == "write":
+                    self._append(vm_name, payload)
+                else:
+                    self._close_file(vm_name)
+                    payload.set()
+            except Exception as e:
+                print(f"[ERROR] Could not write log for VM '{vm_name}': {e}")
+            # Flush once the burst is written instead of after every line
+            if self._queue.empty():
+                for f in self._files.values():
+                    f.flush()
+        for vm_name in list(self._files):
+            self._close_file(vm_name)
+
+    def _append(self, vm_name: str, text: str):
+        data = text.encode("utf-8", errors="replace")
+        f = self._files.get(vm_name)
+        if f is None:
+            if not (self.vms_dir / vm_name).exists():
+                return  # The VM was deleted while its lines were queued
+            self.log_dir(vm_name).mkdir(exist_ok=True)
+            f = self._files[vm_name] = open(self.log_path(vm_name), "ab")
+        if f.tell() > 0 and f.tell() + len(data) > VM_LOG_MAX_BYTES:
+            self._close_file(vm_name)
+            self._rotate(vm_name)
+            f = self._files[vm_name] = open(self.log_path(vm_name), "ab")
+        f.write(data)
+
+    def _rotate(self, vm_name: str):
+        """lifecycle.log -> .1 -> .2 ..., dropping the oldest."""
+        oldest = self.log_path(vm_name, VM_LOG_BACKUPS)
+        if oldest.exists():
+            oldest.unlink()
+        for backup in range(VM_LOG_BACKUPS - 1, -1, -1):
+            path = self.log_path(vm_name, backup)
+            if path.exists():
+                os.replace(path, self.log_path(vm_name, backup + 1))
+
+    def _close_file(self, vm_name: str):
+        f = self._files.pop(vm_name, None)
+        if f is not None:
+            f.close()
+
+    def files(self, vm_name: str) -> list:
+        """Sizes of the VM's log files: index 0 is the current file, then the backups."""
+        sizes = []
+        for backup in range(VM_LOG_BACKUPS + 1):
+            path = self.log_path(vm_name, backup)
+            if not path.exists():
+                break
+            sizes.append({"file": backup, "size": path.stat().st_size})
+        return sizes
+
+    def read(self, vm_name: str, offset: int, limit: int, backup: int = 0) -> dict:
+        """
+        Reads up to limit bytes from offset in one log file, via mmap so only that
+        range is paged in. A negative offset counts from the end of the file.
+        next_offset is where the following read should start (poll it to follow the log).
+        This is a blocking function intended to be run in a thread.
+        """
+        limit = max(0, min(limit, VM_LOG_MAX_READ))
+        path = self.log_path(vm_name, backup)
+        size = path.stat().st_size if path.exists() else 0
+        start = max(0, size + offset) if offset < 0 else min(offset, size)
+        end = min(size, start + limit)
+        data = b""
+        if end > start:
+            with open(path, "rb") as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                data = mm[start:end]
+        return {
+            "file": backup,
+            "offset": start,
+            "next_offset": end,
+            "size": size,
+            "eof": end >= size,
+            "data": data.decode("utf-8", errors="replace"),
+        }
+#endregion